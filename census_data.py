@@ -1,1010 +1,981 @@
-from functools import reduce
+import argparse
+import os
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 from matplotlib.patches import Patch
-import contextily as ctx
 import rasterio
-import exactextract
+
+import census_processing
+import climate_extraction
+import geo_io
+import map_rendering
+from census_processing import (aggregate_amalgamations, amalgamation_members, assign_dominant_zone, assign_zone_levels,
+                               dissolve_amalgamations, eab_distance_features, eab_regulation_flags, load_census_tables,
+                               read_census_table, sweep_summary, threshold_sweep, zone_boundary_distances)
+from climate_extraction import (extract_band_series, extract_weighted_stats, extract_zonal_stats,
+                                impute_from_nearest_pixels, load_row_pixel_areas, pixel_footprint)
+from geo_io import output_paths, write_layers
+from map_rendering import ECOZONE_COLOURS, ECOZONE_GROUPS, ecozone_province_layer, render_multi_ecozone_maps
+from pipeline import Stage, run_pipeline
+from pipeline_cache import file_fingerprint, fingerprint, load_manifest, save_manifest
+
+CENSUS_DIR = 'Datasets/Inputs/2021_census_of_population'
+CENSUS_CACHE_PATH = 'Datasets/Outputs/2021_census_of_population/census_tables.parquet'  # typed, merged census tables
+CENSUS_MANIFEST_PATH = 'Datasets/Outputs/2021_census_of_population/cache_manifest.json'
+URBAN_MIN_POPULATION = 1000  # urban criteria: minimum 2021 population
+URBAN_MIN_DENSITY = 400  # urban criteria: minimum population density (people/km²)
+SWEEP_MIN_POPULATION = []  # threshold sweep, e.g. [500, 1000, 2500]; empty (with SWEEP_MIN_DENSITY) disables it
+SWEEP_MIN_DENSITY = []  # e.g. [200, 300, 400, 500]; an empty list sweeps only the other threshold
+SWEEP_DIR = 'Datasets/Outputs/threshold_sweep'
+OUTPUT_FORMATS = ['parquet', 'gpkg', 'shp']  # geometry outputs: GeoParquet (primary) plus the legacy gpkg/shp copies
+ECODISTRICT_PATH = 'Datasets/Inputs/ecodistrict_shp/ecodistricts.shp'  # finest ecological framework level (optional)
+# level: label column in the ecodistrict layer, finest first; all are rolled up from one overlay with that layer
+ECOLOGICAL_LEVELS = {'ecodistrict': 'ECODISTRIC', 'ecoregion': 'ECOREGION', 'ecozone': 'ECOZONE'}
+CLIMATE_EXTRACTION = 'weights'  # 'weights' (cached sparse CSD×pixel matrix) or 'exactextract' (one uncached pass)
+CLIMATE_CACHE_DIR = 'Datasets/Outputs/climate_cache'  # weight matrices and memory-mapped pixel arrays
+CLIMATE_LOW_COVERAGE_KM2 = 275  # raster footprint flagged 'Low' (≈ 5 pixels of the 5' grid at 50°N)
+CLIMATE_VERY_LOW_COVERAGE_KM2 = 110  # raster footprint flagged 'Very Low' (≈ 2 pixels)
+IMPUTE_NEIGHBOURS = 4  # nearest valid pixels averaged (inverse-distance weighted) for CSDs without raster data
+CLIMATE_SERIES = {}  # name: multi-band raster (e.g. annual/monthly series) streamed to a long-format CSV per CSD
+CLIMATE_SERIES_DIR = 'Datasets/Outputs/climate_series'
+CLIMATE_SERIES_BLOCK_ROWS = 256  # raster rows read per window; bounds peak memory of the series extraction
+BASEMAP_TILES = 'Datasets/Inputs/basemap_tiles'  # local tile cache: {z}/{x}/{y}.png directory or an .mbtiles file
+BASEMAP_TILE_URL = None  # opt-in tile server URL ({z}/{x}/{y}) filling the tile directory once; check its usage policy
+MAP_WORKERS = 4  # processes rendering the multi-ecozone CSD maps
+MULTI_ECOZONE_FIGURES_DIR = 'figures/multi_ecozone_csds'
+MAP_DISPLAY_TOLERANCE = 1000  # metres; simplification of the ecozone/province layer drawn on the national/regional maps
+PIPELINE_CACHE_DIR = 'Datasets/Outputs/pipeline_cache'  # pickled stage results and the manifest of their keys
+PIPELINE_WORKERS = 3  # threads running independent stages (ecozones, EAB and climate) concurrently
+PIPELINE_VERSION = 1  # bump to re-run every stage when nothing hashed changed (e.g. after a library upgrade)
+
+FINER_ECOLOGICAL_LEVELS = {level: column for level, column in ECOLOGICAL_LEVELS.items() if level != 'ecozone'}
+CENSUS_PATHS = [f'{CENSUS_DIR}/{table}.csv' for table in
+                ['population', 'labour', 'indigenous_identity', 'visible_minorities', 'household_income']]
+AMALGAMATION_PATH = f'{CENSUS_DIR}/amalgamated_cities.csv'
+CSD_PATH = 'Datasets/Inputs/census_subdivisions_2021/census_subdivisions_2021.shp'
+ECOZONE_PATH = 'Datasets/Inputs/ecozone_shp/ecozones.shp'
+PROVINCES_PATH = 'Datasets/Inputs/provinces/provinces_simplified_1km.gpkg'
+EAB_PATH = 'Datasets/Inputs/eab_area/eab_areas.shp'
+CLIMATE_RASTERS = {
+    'precip': 'Datasets/Inputs/climate/average_annual_precip_mm_1991_2020.tif',
+    'frostfree': 'Datasets/Inputs/climate/average_annual_frost_free_days_1991_2020.tif',
+    'degree_days': 'Datasets/Inputs/climate/average_annual_degree_growing_days_b10_1991_2020.tif'
+}
+MUNICIPALITIES_PATH = 'Datasets/Outputs/2021_census_of_population/2021_census_of_population_municipalities.csv'
+URBAN_CSDS_STEM = 'Datasets/Outputs/urban_csds/urban_csds'
+CENTROIDS_STEM = 'Datasets/Outputs/urban_csd_centroids/urban_csd_centroids'
+ATTRIBUTES_PATH = 'Datasets/Outputs/urban_csds/urban_csds_attributes.csv'
+MAP_LAYERS_PATH = 'Datasets/Outputs/map_layers/ecozone_provinces.parquet'  # ecozones clipped to provinces, both tiers
+ELIGIBLE_FIGURES_DIR = 'figures/eligible_csds'
+# Regional maps, by the PRUID values of their provinces
+MAP_REGIONS = {
+    "British Columbia": [59],
+    "Prairies": [48, 47, 46],
+    "Ontario": [35],
+    "Québec": [24],
+    "Atlantic Canada": [10, 11, 12, 13]
+}
 
 ## ------------------------------------------------ LOAD AND CLEAN DATA ------------------------------------------------
 #region
 
-# load datasets
-population = pd.read_csv('Datasets/Inputs/2021_census_of_population/population.csv', dtype={'CSDUID': str})
-labour = pd.read_csv('Datasets/Inputs/2021_census_of_population/labour.csv', dtype={'CSDUID': str})
-indigenous_identity = pd.read_csv('Datasets/Inputs/2021_census_of_population/indigenous_identity.csv', dtype={'CSDUID': str})
-visible_minorities = pd.read_csv('Datasets/Inputs/2021_census_of_population/visible_minorities.csv', dtype={'CSDUID': str})
-household_income = pd.read_csv('Datasets/Inputs/2021_census_of_population/household_income.csv', dtype={'CSDUID': str})
+def load_clean():
+    """Merged census tables filtered to the urban, non-Indigenous CSDs (before amalgamation)"""
+    # Load the census tables merged on CSDUID with an explicit schema (integer keys, float64 percentages, nullable
+    # counts); the merged table is cached as Parquet and only rebuilt when one of the CSVs changes
+    df = load_census_tables(CENSUS_PATHS, CENSUS_CACHE_PATH, CENSUS_MANIFEST_PATH)
+
+    print("Columns in merged dataset:")
+    for col in df.columns:
+        print(f"  - {col}")
 
-amalgamated_csds = pd.read_csv('Datasets/Inputs/2021_census_of_population/amalgamated_cities.csv', dtype={'CSDUID': str})
+    print(f"\nTotal number of CSDs in dataset: {len(df)}")
 
-# Drop CSDNAME from all datasets except population
-for dataset in [labour, indigenous_identity, visible_minorities, household_income]:
-    dataset.drop(columns=['CSDNAME'], errors='ignore', inplace=True)
+    # With a threshold sweep, every CSD meeting the loosest thresholds is processed once and each scenario becomes a
+    # mask over those candidates in the save stage (outputs other than the sweep tables keep the baseline thresholds)
+    candidate_population = min([URBAN_MIN_POPULATION] + SWEEP_MIN_POPULATION)
+    candidate_density = min([URBAN_MIN_DENSITY] + SWEEP_MIN_DENSITY)
 
-# Merge all dataframes
-df = reduce(lambda left, right: left.merge(right, on='CSDUID', how='outer'),
-            [population, labour, indigenous_identity, visible_minorities, household_income])
+    # Filter for urban CSDs
+    urban_df = df[(df['Population, 2021'] >= candidate_population)
+                  & (df['Population Density (sq km)'] >= candidate_density)].copy()
 
-print("Columns in merged dataset:")
-for col in df.columns:
-    print(f"  - {col}")
+    # Combined exclusion pattern (exclude CSDs with digits in name, PETIT-ROCHER, or WENDAKE)
+    exclusion_pattern = r'\d|PETIT-ROCHER|WENDAKE'
+    urban_df = urban_df[~urban_df['CSDNAME'].str.contains(exclusion_pattern, case=False, na=False)]
+
+    print(f"Number of urban and non-Indigenous CSDs: {len(urban_df)}")
+
+    return urban_df
 
 #endregion
 
-## --------------------------------------- REMOVE NON-URBAN AND INDIGENOUS CSDs ----------------------------------------
+## --------------------------------------------- HANDLE AMALGAMATED CITIES ---------------------------------------------
 #region
 
-print(f"\nTotal number of CSDs in dataset: {len(df)}")
+def amalgamation(load_clean):
+    """Replace amalgamation members by the merged municipalities in the census table and the CSD polygons"""
+    urban_df = load_clean
+    amalgamated_csds = read_census_table(AMALGAMATION_PATH)
+
+    # Amalgamation table: each row of amalgamated_cities.csv holds the merged municipality's CSDUID and CSDNAME and
+    # the member CSDUIDs it replaces (MEMBER_CSDUIDS); adding an amalgamation is one row in that file
+    amalgamation_table = amalgamation_members(amalgamated_csds)
+
+    # CSDUIDs to remove from urban_df before concatenation
+    to_remove_csduids = set(amalgamation_table['member_CSDUID'])
+
+    print("\nAMALGAMATION PROCESS:")
+    print(f" - CSDUIDs to remove: {sorted(to_remove_csduids)}")
+    print(f" - Rows in amalgamated CSV: {len(amalgamated_csds)}")
+    print(f" - Amalgamated CSDUIDs: {sorted(amalgamated_csds['CSDUID'].unique().tolist())}")
+
+    # ---------- Remove specified CSDs and add amalgamated ones ----------
+    urban_df = urban_df[~urban_df['CSDUID'].isin(to_remove_csduids)].copy()
+    print(f" - Rows after removing specified CSDUIDs: {len(urban_df)}")
+
+    # Census figures of each merged municipality aggregated from all of its members (urban or not; the merged table is
+    # read from the load_clean cache); figures given in the amalgamation table, e.g. published ones, are kept instead
+    census = load_census_tables(CENSUS_PATHS, CENSUS_CACHE_PATH, CENSUS_MANIFEST_PATH)
+    amalgamated_rows = aggregate_amalgamations(census, amalgamation_table, published=amalgamated_csds)
+    table_figures = amalgamated_csds.columns.intersection(amalgamated_rows.columns).drop(['CSDUID', 'CSDNAME'])
+    print(f" - Figures taken from the amalgamation table: {int(amalgamated_csds[table_figures].notna().sum().sum())} "
+          f"(others aggregated from the member CSDs)")
+
+    # Concatenate
+    urban_df = pd.concat([urban_df, amalgamated_rows], axis=0, ignore_index=True, sort=False)
+
+    # Validate no duplicates
+    dup_counts = urban_df['CSDUID'].value_counts()  # ✅ FIXED
+    duplicates = dup_counts[dup_counts > 1]
+    if not duplicates.empty:
+        print("\nERROR: Duplicate CSDUIDs detected!")
+        print(duplicates)
+        raise RuntimeError("Aborting: duplicates found after concatenation.")
+
+    print(f" - Total rows after amalgamation: {len(urban_df)}")
+    print("SUCCESS: Amalgamation complete, no duplicates detected.\n")
+
+    # Import spatial data
+    csd_shp = gpd.read_file(CSD_PATH)
+
+    # Merge the polygons of amalgamated cities (one dissolve over every amalgamation in the table)
+    csd_shp['CSDUID'] = csd_shp['CSDUID'].astype(str)
+    csd_shp = dissolve_amalgamations(csd_shp, amalgamation_table)
+
+    print(f"\nTotal CSDs in shapefile after merging: {len(csd_shp)}")
+
+    # Filter csd_shp to only keep rows that are in urban_csds
+    urban_csd_shp = csd_shp[csd_shp['CSDUID'].isin(urban_df['CSDUID'].astype(str))].copy()
+    print(f"Rows in urban_csd_shp after removing non-urban and Indigenous CSDs: {len(urban_csd_shp)}")
+
+    # Add province names after filtering to urban_csd_shp
+    provinces_territories = {
+        10: "Newfoundland and Labrador",
+        11: "Prince Edward Island",
+        12: "Nova Scotia",
+        13: "New Brunswick",
+        24: "Quebec",
+        35: "Ontario",
+        46: "Manitoba",
+        47: "Saskatchewan",
+        48: "Alberta",
+        59: "British Columbia",
+        60: "Yukon",
+        61: "Northwest Territories",
+        62: "Nunavut"
+    }
 
-# Filter for urban CSDs
-urban_df = df[(df['Population, 2021'] >= 1000) & (df['Population Density (sq km)'] >= 400)].copy()
+    urban_csd_shp['PRUID'] = urban_csd_shp['PRUID'].astype(int)
+    urban_csd_shp['province'] = urban_csd_shp['PRUID'].map(provinces_territories)
 
-# Combined exclusion pattern (exclude CSDs with digits in name, PETIT-ROCHER, or WENDAKE)
-exclusion_pattern = r'\d|PETIT-ROCHER|WENDAKE'
-urban_df = urban_df[~urban_df['CSDNAME'].str.contains(exclusion_pattern, case=False, na=False)]
+    # Calculate area before ecozone assignment
+    urban_csd_shp['area_km2'] = urban_csd_shp.geometry.area / 1_000_000
 
-print(f"Number of urban and non-Indigenous CSDs: {len(urban_df)}")
+    return {'census': urban_df, 'csds': urban_csd_shp, 'amalgamated_csduids': amalgamated_csds['CSDUID'].astype(str)}
 
 #endregion
 
-## --------------------------------------------- HANDLE AMALGAMATED CITIES ---------------------------------------------
+## ----------------------------------------------- IDENTIFY THE ECOZONES -----------------------------------------------
 #region
 
-# CSDUIDs to remove from urban_df before concatenation
-to_remove_csduids = {'4810039', '4717029', '4806011', '4806009'}
-
-# ---------- NORMALIZE KEY COLUMN ----------
-urban_df['CSDUID'] = urban_df['CSDUID'].astype(str).str.strip()  # ✅ ADDED
-amalgamated_csds['CSDUID'] = amalgamated_csds['CSDUID'].astype(str).str.strip()
-
-# ---------- HARMONIZE DTYPES ----------
-# Convert integer columns (counts)
-int_cols = ['Population, 2021', 'Total private dwellings',
-            'Private dwellings occupied by usual residents', 'Aggregate after-tax income of households']
-for col in int_cols:
-    if col in amalgamated_csds.columns:
-        amalgamated_csds[col] = amalgamated_csds[col].astype('int64')
-
-# Convert float columns (percentages, areas, densities)
-float_cols = [
-    'Population percentage change, 2016 to 2021 (%)',
-    'Land Area (sq km)',
-    'Population Density (sq km)',
-    'Proportion of the Labour Force that is Men+ (%)',
-    'Proportion of the Employed Population that is Men+ (%)',
-    'Indigenous identity (%)',
-    'Single Indigenous responses (%)',
-    'First Nations (%)',
-    'Métis (%)',
-    'Inuit (%)',
-    'Multiple Indigenous responses (%)',
-    'Indigenous responses nie (%)',
-    'Non-Indigenous identity (%)',
-    'visible minority population  (%)'
-]
-for col in float_cols:
-    if col in amalgamated_csds.columns:
-        amalgamated_csds[col] = amalgamated_csds[col].astype('float64')
+def ecozones(amalgamation):
+    """Dominant ecozone (and ecoregion/ecodistrict) of every urban CSD and its distance to an ecozone boundary"""
+    urban_csd_shp = amalgamation['csds']
 
-print("\nAMALGAMATION PROCESS:")
-print(f" - CSDUIDs to remove: {sorted(to_remove_csduids)}")
-print(f" - Rows in amalgamated CSV: {len(amalgamated_csds)}")
-print(f" - Amalgamated CSDUIDs: {sorted(amalgamated_csds['CSDUID'].unique())}")
+    if os.path.exists(ECODISTRICT_PATH):
+        # Every level, ecozones included, is rolled up from one overlay with the ecodistrict layer
+        ecodistrict = gpd.read_file(ECODISTRICT_PATH, columns=list(ECOLOGICAL_LEVELS.values()))
+        ecodistrict = ecodistrict.dropna(subset=['geometry']).to_crs(urban_csd_shp.crs)
 
-# ---------- Remove specified CSDs and add amalgamated ones ----------
-urban_df = urban_df[~urban_df['CSDUID'].isin(to_remove_csduids)].copy()
-print(f" - Rows after removing specified CSDUIDs: {len(urban_df)}")
+        # Ecozone codes are named from the ecozone attribute table (no geometry is read)
+        zone_names = gpd.read_file(ECOZONE_PATH, columns=['ECOZONE', 'ZONE_NAME'], ignore_geometry=True)
+        zone_names = zone_names.drop_duplicates('ECOZONE').set_index('ECOZONE')['ZONE_NAME']
+        zone_names = zone_names.replace('Boreal PLain', 'Boreal Plain')
+        ecozone_column = ECOLOGICAL_LEVELS['ecozone']
+        ecodistrict[ecozone_column] = ecodistrict[ecozone_column].map(zone_names)
 
-# Ensure column order matches
-amalgamated_csds = amalgamated_csds[df.columns]
+        ecozone_df = assign_zone_levels(urban_csd_shp, ecodistrict, ECOLOGICAL_LEVELS, detailed_level='ecozone')
+        boundary_zones, boundary_column = ecodistrict, ecozone_column
+    else:
+        print(f"Ecodistrict layer not found at {ECODISTRICT_PATH}; assigning ecozones from {ECOZONE_PATH} "
+              f"and skipping ecoregion and ecodistrict assignment")
+        ecozone = gpd.read_file(ECOZONE_PATH)
+
+        # Ensure ecozone has valid geometries and a CRS
+        ecozone = ecozone.dropna(subset=['geometry']).copy()
+        if ecozone.crs is None:
+            raise ValueError("ecozone layer has no CRS — please set the CRS before proceeding.")
+
+        # Reproject ecozone to the same CRS as csd_urban
+        ecozone = ecozone.to_crs(urban_csd_shp.crs)
+
+        # Fix "Boreal PLain" spelling mistake
+        ecozone['ZONE_NAME'] = ecozone['ZONE_NAME'].replace('Boreal PLain', 'Boreal Plain')
+
+        # Intersection areas of every CSD-ecozone pair in one vectorized pass, then the dominant ecozone (≥50.01%)
+        ecozone_df = assign_dominant_zone(urban_csd_shp, ecozone, 'ZONE_NAME', level='ecozone')
+        boundary_zones, boundary_column = ecozone, 'ZONE_NAME'
+
+    # Merge ecozone assignments
+    csd_urban = urban_csd_shp.merge(ecozone_df, on='CSDUID', how='left')
+
+    print("Assign ecozones:")
+    print(csd_urban[['CSDUID', 'CSDNAME', 'assigned_ecozone', 'dominant_ecozone', 'coverage_pct']].head(
+        10).to_string(index=False))
+
+    # Report CSDs in multiple ecozone
+    multi_ecozone_csds = csd_urban[csd_urban['ecozone_count'] > 1]
+    print(f"\n--- CSDs spanning multiple ecozone: {len(multi_ecozone_csds)} ---")
+    if len(multi_ecozone_csds) > 0:
+        print(multi_ecozone_csds[['CSDUID', 'CSDNAME', 'all_ecozone', 'assigned_ecozone', 'dominant_ecozone',
+                                  'coverage_pct']].to_string(index=False))
+    else:
+        print("None")
+
+    # Report assignment errors
+    error_csds = csd_urban[csd_urban['assignment_error']]
+    print(f"\n--- ERROR: CSDs with no dominant ecozone (< 50% coverage): {len(error_csds)} ---")
+    if len(error_csds) > 0:
+        print(error_csds[['CSDUID', 'CSDNAME', 'all_ecozone', 'coverage_pct']].to_string(index=False))
+        print("\n*** ATTENTION: These CSDs could not be assigned to a single ecozone ***")
+    else:
+        print("None - all multi-ecozone CSDs have a dominant zone")
+
+    if os.path.exists(ECODISTRICT_PATH):
+        print("\n--- Ecological framework levels ---")
+        for level in FINER_ECOLOGICAL_LEVELS:
+            print(f"{level}: {csd_urban[f'assigned_{level}'].nunique()} classes assigned, "
+                  f"{(csd_urban[f'dominant_{level}'] == 'No').sum()} CSDs without a dominant {level}")
 
-# Concatenate
-urban_df = pd.concat([urban_df, amalgamated_csds], axis=0, ignore_index=True, sort=False)
+    # Distance from each CSD centroid to the nearest boundary between two ecozones, from one bulk STRtree nearest query
+    boundary_distances = zone_boundary_distances(urban_csd_shp.assign(geometry=urban_csd_shp.geometry.centroid),
+                                                 boundary_zones, boundary_column, level='ecozone')
+    ecozone_df = ecozone_df.merge(boundary_distances, on='CSDUID', how='left')
 
-# Validate no duplicates
-dup_counts = urban_df['CSDUID'].value_counts()  # ✅ FIXED
-duplicates = dup_counts[dup_counts > 1]
-if not duplicates.empty:
-    print("\nERROR: Duplicate CSDUIDs detected!")
-    print(duplicates)
-    raise RuntimeError("Aborting: duplicates found after concatenation.")
+    print("\nDistance from CSD centroids to the nearest ecozone boundary (km):")
+    print(boundary_distances['ecozone_boundary_distance_km'].describe()[['min', '50%', 'max']].to_string())
 
-print(f" - Total rows after amalgamation: {len(urban_df)}")
-print("SUCCESS: Amalgamation complete, no duplicates detected.\n")
+    return ecozone_df
 
 #endregion
 
-## ----------------------------------------------- IDENTIFY THE ECOZONES -----------------------------------------------
+## ------------------------------------------------ IDENTIFY EAB AREAS -------------------------------------------------
 #region
 
-# Import spatial data
-csd_shp = gpd.read_file('Datasets/Inputs/census_subdivisions_2021/census_subdivisions_2021.shp')
-ecozone = gpd.read_file('Datasets/Inputs/ecozone_shp/ecozones.shp')
-provinces_gdf = gpd.read_file('Datasets/Inputs/provinces/provinces_simplified_1km.gpkg')
-
-# Merge polygons of amalgamated cities
-lloydminster = ['4810039', '4717029']
-black_diamond = ['4806011', '4806009']
-
-# Ensure CSDUID is string
-csd_shp['CSDUID'] = csd_shp['CSDUID'].astype(str)
-
-# Merge Lloydminster
-lloyd_rows = csd_shp[csd_shp['CSDUID'].isin(lloydminster)]
-lloyd_merged = lloyd_rows.iloc[0].copy()
-lloyd_merged['geometry'] = lloyd_rows.geometry.union_all()
-lloyd_merged['CSDNAME'] = 'Lloydminster'
-lloyd_merged['CSDUID'] = '4810039'
-csd_shp = csd_shp[~csd_shp['CSDUID'].isin(lloydminster)]
-csd_shp = gpd.GeoDataFrame(pd.concat([csd_shp, gpd.GeoDataFrame([lloyd_merged], crs=csd_shp.crs)],
-                                     ignore_index=True), crs=csd_shp.crs)
-
-# Merge Black Diamond + Turner Valley -> Diamond Valley
-bd_rows = csd_shp[csd_shp['CSDUID'].isin(black_diamond)]
-bd_merged = bd_rows.iloc[0].copy()
-bd_merged['geometry'] = bd_rows.geometry.union_all()
-bd_merged['CSDNAME'] = 'Diamond Valley'
-bd_merged['CSDUID'] = '4806011'
-csd_shp = csd_shp[~csd_shp['CSDUID'].isin(black_diamond)]
-csd_shp = pd.concat([csd_shp, gpd.GeoDataFrame([bd_merged], crs=csd_shp.crs)], ignore_index=True)
-
-print(f"\nTotal CSDs in shapefile after merging: {len(csd_shp)}")
-
-# Filter csd_shp to only keep rows that are in urban_csds
-urban_csd_shp = csd_shp[csd_shp['CSDUID'].isin(urban_df['CSDUID'])].copy()
-print(f"Rows in urban_csd_shp after removing non-urban and Indigenous CSDs: {len(urban_csd_shp)}")
-
-# Add province names after filtering to urban_csd_shp
-provinces_territories = {
-    10: "Newfoundland and Labrador",
-    11: "Prince Edward Island",
-    12: "Nova Scotia",
-    13: "New Brunswick",
-    24: "Quebec",
-    35: "Ontario",
-    46: "Manitoba",
-    47: "Saskatchewan",
-    48: "Alberta",
-    59: "British Columbia",
-    60: "Yukon",
-    61: "Northwest Territories",
-    62: "Nunavut"
-}
-
-urban_csd_shp['PRUID'] = urban_csd_shp['PRUID'].astype(int)
-urban_csd_shp['province'] = urban_csd_shp['PRUID'].map(provinces_territories)
-
-# Ensure ecozone has valid geometries and a CRS
-ecozone = ecozone.dropna(subset=['geometry']).copy()
-if ecozone.crs is None:
-    raise ValueError("ecozone layer has no CRS — please set the CRS before proceeding.")
-
-# Reproject ecozone to the same CRS as csd_urban
-ecozone = ecozone.to_crs(urban_csd_shp.crs)
-
-# Fix "Boreal PLain" spelling mistake
-ecozone['ZONE_NAME'] = ecozone['ZONE_NAME'].replace('Boreal PLain', 'Boreal Plain')
-
-# Calculate area before ecozone assignment
-urban_csd_shp['area_km2'] = urban_csd_shp.geometry.area / 1_000_000
-
-# Calculate area of intersection for each CSD-ecozone pair
-ecozone_assignments = []
-
-for idx, csd_row in urban_csd_shp.iterrows():
-    csd_id = csd_row['CSDUID']
-    csd_geom = csd_row.geometry
-    csd_area = csd_row['area_km2']
-
-    # Find intersecting ecozone
-    intersecting = ecozone[ecozone.geometry.intersects(csd_geom)]
-
-    if len(intersecting) == 0:
-        ecozone_assignments.append({
-            'CSDUID': csd_id,
-            'assigned_ecozone': 'No ecozone',
-            'ecozone_count': 0,
-            'all_ecozone': 'No ecozone',
-            'dominant_ecozone': 'No',
-            'coverage_pct': 0,
-            'assignment_error': False
-        })
-    elif len(intersecting) == 1:
-        ecozone_assignments.append({
-            'CSDUID': csd_id,
-            'assigned_ecozone': intersecting.iloc[0]['ZONE_NAME'],
-            'ecozone_count': 1,
-            'all_ecozone': intersecting.iloc[0]['ZONE_NAME'],
-            'dominant_ecozone': 'Yes',
-            'coverage_pct': 100.0,
-            'assignment_error': False
-        })
-    else:
-        # Multiple ecozone - calculate coverage percentages
-        coverage_data = []
-        for _, ecozone_row in intersecting.iterrows():
-            intersection = csd_geom.intersection(ecozone_row.geometry)
-            intersection_area_km2 = gpd.GeoSeries([intersection], crs=urban_csd_shp.crs).area.iloc[0] / 1_000_000
-            coverage_pct = (intersection_area_km2 / csd_area) * 100
-            coverage_data.append({
-                'zone_name': ecozone_row['ZONE_NAME'],
-                'coverage_pct': coverage_pct
-            })
-
-        # Sort by coverage
-        coverage_data.sort(key=lambda x: x['coverage_pct'], reverse=True)
-        max_coverage = coverage_data[0]['coverage_pct']
-        all_zones = ' | '.join([z['zone_name'] for z in coverage_data])
-
-        # Check if dominant ecozone covers at least 50.01%
-        if max_coverage >= 50.01:
-            ecozone_assignments.append({
-                'CSDUID': csd_id,
-                'assigned_ecozone': coverage_data[0]['zone_name'],
-                'ecozone_count': len(intersecting),
-                'all_ecozone': all_zones,
-                'dominant_ecozone': 'Yes',
-                'coverage_pct': round(max_coverage, 2),
-                'assignment_error': False
-            })
-        else:
-            ecozone_assignments.append({
-                'CSDUID': csd_id,
-                'assigned_ecozone': 'ERROR: No dominant ecozone',
-                'ecozone_count': len(intersecting),
-                'all_ecozone': all_zones,
-                'dominant_ecozone': 'No',
-                'coverage_pct': round(max_coverage, 2),
-                'assignment_error': True
-            })
-
-# Convert to DataFrame and merge
-ecozone_df = pd.DataFrame(ecozone_assignments)
-csd_urban = urban_csd_shp.merge(ecozone_df, on='CSDUID', how='left')
-
-print("Assign ecozones:")
-print(csd_urban[['CSDUID', 'CSDNAME', 'assigned_ecozone', 'dominant_ecozone', 'coverage_pct']].head(
-    10).to_string(index=False))
-
-# Report CSDs in multiple ecozone
-multi_ecozone_csds = csd_urban[csd_urban['ecozone_count'] > 1]
-print(f"\n--- CSDs spanning multiple ecozone: {len(multi_ecozone_csds)} ---")
-if len(multi_ecozone_csds) > 0:
-    print(multi_ecozone_csds[
-              ['CSDUID', 'CSDNAME', 'all_ecozone', 'assigned_ecozone', 'dominant_ecozone', 'coverage_pct']].to_string(
+def eab(amalgamation):
+    """EAB regulation flags of every urban CSD centroid and its distance to the regulated areas of each year"""
+    csd_urban = amalgamation['csds'][['CSDUID', 'CSDNAME', 'province', 'geometry']]
+
+    # Import spatial data
+    eab_area = gpd.read_file(EAB_PATH)
+
+    # Ensure eab_area has valid geometries and a CRS
+    eab_area = eab_area.dropna(subset=['geometry']).copy()
+    if eab_area.crs is None:
+        raise ValueError("eab_area layer has no CRS — please set the CRS before proceeding.")
+
+    # Reproject eab_area to the same CRS as csd_urban
+    eab_area = eab_area.to_crs(csd_urban.crs)
+
+    print("\nUnique values of date_regul and status_reg in eab_area:")
+    print(f"EAB Area values in 'date_regul': {eab_area['date_regul'].unique()}  dtype: {eab_area['date_regul'].dtype}")
+    print(f"EAB Area values in 'status_reg': {eab_area['status_reg'].unique()}  dtype: {eab_area['status_reg'].dtype}")
+
+    # Create centroids from csd_urban geometries
+    csd_centroids = csd_urban[['CSDUID', 'geometry']].copy()
+    csd_centroids['geometry'] = csd_centroids.geometry.centroid
+
+    # One indexed spatial join of the centroids against the whole EAB layer, pivoted to a Yes/No column for every
+    # regulation year/status pair (in_eab_area_<year>_<status>) plus the first regulated year
+    eab_flags = eab_regulation_flags(csd_centroids, eab_area)
+    eab_flag_columns = [column for column in eab_flags.columns if column.startswith('in_eab_area_')]
+
+    # Regulated areas of interest keep their original column names (2024 Inactive and 2025 Active)
+    eab_flags['in_eab_area_2024'] = eab_flags.get('in_eab_area_2024_Inactive', 'No')
+    eab_flags['in_eab_area_2025'] = eab_flags.get('in_eab_area_2025_Active', 'No')
+
+    # Merge the EAB assignment back to csd_urban
+    csd_urban = csd_urban.merge(eab_flags, on='CSDUID', how='left')
+
+    print("\nCSD centroids within each EAB regulation year/status:")
+    for column in eab_flag_columns:
+        print(f"  {column}: {(csd_urban[column] == 'Yes').sum()}")
+    print(f"  Never regulated: {csd_urban['first_eab_regulated_year'].isna().sum()}")
+
+    # Report results
+    print('\n------- EAB Areas in 2024 -------')
+    eab_count_2024 = (csd_urban['in_eab_area_2024'] == 'Yes').sum()
+    total_count = len(csd_urban)
+    print(f"EAB Area Assignment:")
+    print(f"  CSDs within EAB area: {eab_count_2024}")
+    print(f"  CSDs outside EAB area: {total_count - eab_count_2024}")
+    print(f"  Total CSDs: {total_count}")
+
+    print('\n------- EAB Areas in 2025 -------')
+    eab_count_2025 = (csd_urban['in_eab_area_2025'] == 'Yes').sum()
+    total_count = len(csd_urban)
+    print(f"EAB Area Assignment:")
+    print(f"  CSDs within EAB area: {eab_count_2025}")
+    print(f"  CSDs outside EAB area: {total_count - eab_count_2025}")
+    print(f"  Total CSDs: {total_count}")
+
+    newly_regulated = csd_urban.loc[(csd_urban['in_eab_area_2024'] == 'No') & (csd_urban['in_eab_area_2025'] == 'Yes'),
+                                    'CSDNAME']
+    print(f"\nCSDs that became regulated for EAB (2024: No → 2025: Yes): {newly_regulated.tolist()}")
+
+    # Show some examples
+    print("\nSample assignments:")
+    print(csd_urban[['CSDUID', 'CSDNAME', 'province', 'in_eab_area_2024', 'in_eab_area_2025']].head(10).to_string(
         index=False))
-else:
-    print("None")
-
-# Report assignment errors
-error_csds = csd_urban[csd_urban['assignment_error']]
-print(f"\n--- ERROR: CSDs with no dominant ecozone (< 50% coverage): {len(error_csds)} ---")
-if len(error_csds) > 0:
-    print(error_csds[['CSDUID', 'CSDNAME', 'all_ecozone', 'coverage_pct']].to_string(index=False))
-    print("\n*** ATTENTION: These CSDs could not be assigned to a single ecozone ***")
-else:
-    print("None - all multi-ecozone CSDs have a dominant zone")
 
-#endregion
+    # Distance from each CSD centroid to the nearest EAB regulated area of every year, each from one bulk STRtree
+    # nearest query (0 km when the centroid is inside an EAB area)
+    eab_distances = eab_distance_features(csd_centroids, eab_area)
 
-## ------------------------------------------------ IDENTIFY EAB AREAS -------------------------------------------------
-#region
+    print("\nDistance from CSD centroids to the nearest EAB regulated area (km):")
+    print(eab_distances.drop(columns='CSDUID').describe().loc[['min', '50%', 'max']].T.to_string())
 
-# Import spatial data
-eab_area = gpd.read_file('Datasets/Inputs/eab_area/eab_areas.shp')
-
-# Ensure eab_area has valid geometries and a CRS
-eab_area = eab_area.dropna(subset=['geometry']).copy()
-if eab_area.crs is None:
-    raise ValueError("eab_area layer has no CRS — please set the CRS before proceeding.")
-
-# Reproject eab_area to the same CRS as csd_urban
-eab_area = eab_area.to_crs(csd_urban.crs)
-
-print("\nUnique values of date_regul and status_reg in eab_area:")
-print(f"EAB Area values in 'date_regul': {eab_area['date_regul'].unique()}  dtype: {eab_area['date_regul'].dtype}")
-print(f"EAB Area values in 'status_reg': {eab_area['status_reg'].unique()}  dtype: {eab_area['status_reg'].dtype}")
-
-# Select the eab regulated area of interest (comment in and out)
-eab_area_2025 = eab_area[(eab_area['date_regul'] == '2025') & (eab_area['status_reg'] == 'Active')]
-eab_area_2024 = eab_area[(eab_area['date_regul'] == '2024') & (eab_area['status_reg'] == "Inactive")]
-
-# Create centroids from csd_urban geometries
-csd_centroids = csd_urban.copy()
-csd_centroids['geometry'] = csd_centroids.geometry.centroid
-
-# Check if each centroid is within any EAB area polygon
-csd_centroids['in_eab_area_2024'] = csd_centroids.geometry.apply(
-    lambda point: 'Yes' if any(eab_area_2024.geometry.contains(point)) else 'No'
-)
-csd_centroids['in_eab_area_2025'] = csd_centroids.geometry.apply(
-    lambda point: 'Yes' if any(eab_area_2025.geometry.contains(point)) else 'No'
-)
-
-# Merge the EAB assignment back to csd_urban
-csd_urban = csd_urban.merge(
-    csd_centroids[['CSDUID', 'in_eab_area_2024']],
-    on='CSDUID',
-    how='left'
-)
-csd_urban = csd_urban.merge(
-    csd_centroids[['CSDUID', 'in_eab_area_2025']],
-    on='CSDUID',
-    how='left'
-)
-
-# Report results
-print('\n------- EAB Areas in 2024 -------')
-eab_count_2024 = (csd_urban['in_eab_area_2024'] == 'Yes').sum()
-total_count = len(csd_urban)
-print(f"EAB Area Assignment:")
-print(f"  CSDs within EAB area: {eab_count_2024}")
-print(f"  CSDs outside EAB area: {total_count - eab_count_2024}")
-print(f"  Total CSDs: {total_count}")
-
-print('\n------- EAB Areas in 2025 -------')
-eab_count_2025 = (csd_urban['in_eab_area_2025'] == 'Yes').sum()
-total_count = len(csd_urban)
-print(f"EAB Area Assignment:")
-print(f"  CSDs within EAB area: {eab_count_2025}")
-print(f"  CSDs outside EAB area: {total_count - eab_count_2025}")
-print(f"  Total CSDs: {total_count}")
-
-print(f"\nCSDs that became regulated for EAB (2024: No → 2025: Yes):"
-      f" {csd_urban.loc[(csd_urban['in_eab_area_2024'] == 'No') & (csd_urban['in_eab_area_2025'] == 'Yes'),
-      'CSDNAME'].tolist()}")
-
-# Show some examples
-print("\nSample assignments:")
-print(csd_urban[['CSDUID', 'CSDNAME', 'province', 'in_eab_area_2024', 'in_eab_area_2025']].head(10).to_string(index=False))
+    return {'flags': eab_flags, 'flag_columns': eab_flag_columns, 'distances': eab_distances}
 
 #endregion
 
 ## -------------------- AVERAGE ANNUAL PRECIPITATION, FROST FREE, AND DEGREE GROWING DAYS (Base 10) --------------------
 # region
 
-# File paths for raster data
-precip_path = 'Datasets/Inputs/climate/average_annual_precip_mm_1991_2020.tif'
-frost_free_path = 'Datasets/Inputs/climate/average_annual_frost_free_days_1991_2020.tif'
-degree_days_path = 'Datasets/Inputs/climate/average_annual_degree_growing_days_b10_1991_2020.tif'
+def climate(amalgamation):
+    """Area-weighted climate normals of every urban CSD, imputed where the rasters have no data, and quality flags"""
+    csd_urban = amalgamation['csds'][['CSDUID', 'CSDNAME', 'province', 'area_km2', 'geometry']].copy()
+    csd_columns = list(csd_urban.columns)
 
-print("\n" + "=" * 70)
-print("EXTRACTING CLIMATE DATA FROM RASTERS")
-print("=" * 70)
+    # File paths for raster data
+    precip_path = CLIMATE_RASTERS['precip']
+    frost_free_path = CLIMATE_RASTERS['frostfree']
+    degree_days_path = CLIMATE_RASTERS['degree_days']
 
-# Check raster CRS and resolution
-with rasterio.open(precip_path) as src:
-    raster_crs = src.crs
-    raster_res = src.res
-    raster_bounds = src.bounds
+    print("\n" + "=" * 70)
+    print("EXTRACTING CLIMATE DATA FROM RASTERS")
+    print("=" * 70)
 
-    print(f"\nRaster CRS: {raster_crs}")
-    print(f"Raster resolution: {raster_res[0]:.8f}° × {raster_res[1]:.8f}°")
+    # Check raster CRS and resolution
+    with rasterio.open(precip_path) as src:
+        raster_crs = src.crs
+        raster_res = src.res
 
-    # Calculate pixel area correctly for geographic CRS
-    if raster_crs.is_geographic:
-        # Calculate actual pixel size at raster center latitude
-        from pyproj import Transformer
+        print(f"\nRaster CRS: {raster_crs}")
+        print(f"Raster resolution: {raster_res[0]:.8f}° × {raster_res[1]:.8f}°")
 
-        center_lat = (raster_bounds.bottom + raster_bounds.top) / 2
-        center_lon = (raster_bounds.left + raster_bounds.right) / 2
+        # Geodesic area of one pixel in every raster row (pixels shrink towards the pole on a lon/lat grid)
+        row_pixel_areas = load_row_pixel_areas(precip_path, CLIMATE_CACHE_DIR)
+        print(f"Raster pixel area: {row_pixel_areas.min():.1f} - {row_pixel_areas.max():.1f} km² (geodesic, by row)")
 
-        # Transform corners of one pixel to meters
-        transformer = Transformer.from_crs(raster_crs, "EPSG:3857", always_xy=True)
+        print(f"CSD CRS: {csd_urban.crs}")
 
-        pixel_corners = [
-            (center_lon, center_lat),  # Bottom-left
-            (center_lon + raster_res[0], center_lat),  # Bottom-right
-            (center_lon, center_lat + abs(raster_res[1]))  # Top-left
-        ]
+    # Reproject csd_urban to match raster CRS if needed
+    if csd_urban.crs != raster_crs:
+        print(f"\nReprojecting CSDs from {csd_urban.crs} to {raster_crs}...")
+        csd_urban_reprojected = csd_urban.to_crs(raster_crs)
+    else:
+        csd_urban_reprojected = csd_urban.copy()
+
+    # Ensure CSDUID is a column (not just index) in the reprojected data
+    if 'CSDUID' not in csd_urban_reprojected.columns:
+        csd_urban_reprojected = csd_urban_reprojected.reset_index()
+
+    # Extract every climate raster with area weights: coverage fractions are computed once per CSD and shared. In
+    # 'weights' mode they are stored as a sparse CSD×pixel matrix, so each raster on the same grid is one sparse
+    # product
+    print("\n🔍 Extracting precipitation, frost-free days and degree growing days (area-weighted method)...")
+    if CLIMATE_EXTRACTION == 'weights':
+        climate_results_df = extract_weighted_stats(csd_urban_reprojected, CLIMATE_RASTERS, CLIMATE_CACHE_DIR)
+    elif CLIMATE_EXTRACTION == 'exactextract':
+        climate_results_df = extract_zonal_stats(csd_urban_reprojected, CLIMATE_RASTERS)
+    else:
+        raise ValueError(f"Unknown CLIMATE_EXTRACTION: {CLIMATE_EXTRACTION!r} (expected 'weights' or 'exactextract')")
+
+    # Rename columns for clarity
+    climate_results_df = climate_results_df.rename(columns={
+        'precip_mean': 'avg_annual_precip_mm',
+        'precip_count': 'precip_pixel_count',
+        'frostfree_mean': 'avg_annual_frost_free_days',
+        'frostfree_count': 'frostfree_pixel_count',
+        'degree_days_mean': 'avg_annual_degree_days_b10',
+        'degree_days_count': 'degree_days_pixel_count'
+    })
+
+    # Merge results back to csd_urban
+    print("\n🔗 Merging climate data to CSD dataset...")
+    csd_urban = csd_urban.merge(climate_results_df, on='CSDUID', how='left')
+
+    # Raster fingerprints recorded by the extraction are reused, so the pixel arrays below are found without re-hashing
+    climate_manifest_path = os.path.join(CLIMATE_CACHE_DIR, 'manifest.json')
+    climate_manifest = load_manifest(climate_manifest_path)
+
+    # True data footprint of each CSD on the precipitation grid: coverage-weighted geodesic pixel area and the km² of
+    # the CSD covered by valid pixels (the basis of the climate data quality flags)
+    footprint_df = pixel_footprint(csd_urban_reprojected, precip_path, CLIMATE_CACHE_DIR,
+                                   manifest=climate_manifest).rename(columns={
+        'pixel_area_km2': 'climate_pixel_area_km2',
+        'coverage_km2': 'climate_coverage_km2'
+    })
+    csd_urban = csd_urban.merge(footprint_df, on='CSDUID', how='left')
+
+    # Fill CSDs without raster coverage (e.g. coastal CSDs over nodata pixels) from the inverse-distance-weighted
+    # nearest valid pixels of each raster, found with one KD-tree query per variable
+    climate_variables = {
+        'precip': ('avg_annual_precip_mm', precip_path),
+        'frost_free': ('avg_annual_frost_free_days', frost_free_path),
+        'degree_days': ('avg_annual_degree_days_b10', degree_days_path)
+    }
+    csd_centroids_raster = csd_urban.geometry.centroid.to_crs(raster_crs).values
+    for variable, (column, raster_path) in climate_variables.items():
+        missing = csd_urban[column].isna().to_numpy()
+        csd_urban[f'{variable}_source'] = 'Raster'
+        csd_urban[f'{variable}_impute_distance_km'] = np.nan
+
+        print(f"\n❌ CSDs missing {column} from the raster: {missing.sum()}")
+        if missing.any():
+            print(csd_urban.loc[missing, ['CSDUID', 'CSDNAME', 'province']].sort_values('province').to_string(
+                index=False))
+
+            values, distance_km = impute_from_nearest_pixels(csd_centroids_raster[missing], raster_path,
+                                                             CLIMATE_CACHE_DIR, k=IMPUTE_NEIGHBOURS,
+                                                             manifest=climate_manifest)
+            csd_urban.loc[missing, column] = values
+            csd_urban.loc[missing, f'{variable}_source'] = f'Imputed (IDW of {IMPUTE_NEIGHBOURS} nearest pixels)'
+            csd_urban.loc[missing, f'{variable}_impute_distance_km'] = distance_km.round(2)
+            print(f"  Imputed from nearest valid pixels {distance_km.min():.1f}-{distance_km.max():.1f} km away")
+    save_manifest(climate_manifest, climate_manifest_path)
+
+    # Report results
+    print("\n" + "=" * 70)
+    print("CLIMATE DATA EXTRACTION SUMMARY")
+    print("=" * 70)
+
+    print(f"\n📊 Precipitation statistics:")
+    print(f"  CSDs with data: {csd_urban['avg_annual_precip_mm'].notna().sum()} / {len(csd_urban)}")
+    print(f"  Mean precipitation: {csd_urban['avg_annual_precip_mm'].mean():.1f} mm")
+    print(f"  Range: {csd_urban['avg_annual_precip_mm'].min():.1f} - {csd_urban['avg_annual_precip_mm'].max():.1f} mm")
+
+    print(f"\n📊 Frost-free days statistics:")
+    print(f"  CSDs with data: {csd_urban['avg_annual_frost_free_days'].notna().sum()} / {len(csd_urban)}")
+    print(f"  Mean frost-free days: {csd_urban['avg_annual_frost_free_days'].mean():.1f} days")
+    print(f"  Range: {csd_urban['avg_annual_frost_free_days'].min():.1f} - "
+          f"{csd_urban['avg_annual_frost_free_days'].max():.1f} days")
+
+    print(f"\n📊 Degree growing days statistics:")
+    print(f"  CSDs with data: {csd_urban['avg_annual_degree_days_b10'].notna().sum()} / {len(csd_urban)}")
+    print(f"  Mean degree days: {csd_urban['avg_annual_degree_days_b10'].mean():.1f}")
+    print(f"  Range: {csd_urban['avg_annual_degree_days_b10'].min():.1f} - "
+          f"{csd_urban['avg_annual_degree_days_b10'].max():.1f}")
+
+    # Analyze pixel coverage
+    print(f"\n⚠️  PIXEL COVERAGE ANALYSIS:")
+    pixel_area_range = csd_urban['climate_pixel_area_km2'].agg(['min', 'max', 'median'])
+    print(f"  Effective pixel area per CSD: {pixel_area_range['min']:.1f} - {pixel_area_range['max']:.1f} km² "
+          f"(median {pixel_area_range['median']:.1f})")
+    print(f"\n  Distribution of pixel counts per CSD (based on precipitation pixel counts):")
+
+    pixel_bins = [
+        (1, 1, "1 pixel only"),
+        (2, 2, "2 pixels"),
+        (3, 3, "3 pixels"),
+        (4, 5, "4-5 pixels"),
+        (6, 9, "6-9 pixels"),
+        (10, 20, "10-20 pixels"),
+        (21, 999, "20+ pixels")
+    ]
 
-        corners_meters = [transformer.transform(lon, lat) for lon, lat in pixel_corners]
+    for min_px, max_px, label in pixel_bins:
+        count = ((csd_urban['precip_pixel_count'] >= min_px) &
+                 (csd_urban['precip_pixel_count'] <= max_px)).sum()
+        pct = (count / len(csd_urban)) * 100
+        print(f"    {label:15s}: {count:3d} CSDs ({pct:5.1f}%)")
+
+    # Calculate median pixel count
+    median_pixels = csd_urban['precip_pixel_count'].median()
+    print(f"\n  Median pixels per CSD: {median_pixels:.1f}")
+
+    # Flag CSDs with a small data footprint
+    low_coverage = csd_urban[csd_urban['climate_coverage_km2'] <= CLIMATE_LOW_COVERAGE_KM2].copy()
+    if len(low_coverage) > 0:
+        print(f"\n⚠️  DATA QUALITY WARNING:")
+        print(f"  {len(low_coverage)} CSDs ({len(low_coverage) / len(csd_urban) * 100:.1f}%) are covered by "
+              f"≤{CLIMATE_LOW_COVERAGE_KM2} km² of raster pixels")
+        print(f"  These CSDs have limited spatial resolution for climate estimation")
+        print(f"\n  Examples of low-coverage CSDs:")
+        low_coverage_sample = low_coverage.nsmallest(10, 'area_km2')[
+            ['CSDUID', 'CSDNAME', 'area_km2', 'climate_coverage_km2', 'precip_pixel_count', 'frostfree_pixel_count',
+             'avg_annual_precip_mm', 'avg_annual_frost_free_days', 'avg_annual_degree_days_b10']
+        ]
+        print(low_coverage_sample.to_string(index=False))
+
+    # Add data quality flag
+    csd_urban['climate_data_quality'] = 'Good'
+    csd_urban.loc[csd_urban['climate_coverage_km2'] <= CLIMATE_LOW_COVERAGE_KM2,
+                  'climate_data_quality'] = f'Low (≤{CLIMATE_LOW_COVERAGE_KM2} km²)'
+    csd_urban.loc[csd_urban['climate_coverage_km2'] <= CLIMATE_VERY_LOW_COVERAGE_KM2,
+                  'climate_data_quality'] = f'Very Low (≤{CLIMATE_VERY_LOW_COVERAGE_KM2} km²)'
+
+    quality_counts = csd_urban['climate_data_quality'].value_counts()
+    print(f"\n📋 Climate Data Quality Flags:")
+    for quality, count in quality_counts.items():
+        print(f"  {quality:25s}: {count:3d} CSDs")
+
+    # Show sample of results
+    print("\n📝 Sample climate data (first 10 CSDs sorted by area):")
+    sample_cols = ['CSDUID', 'CSDNAME', 'area_km2', 'avg_annual_precip_mm', 'avg_annual_frost_free_days',
+                   'avg_annual_degree_days_b10', 'climate_data_quality']
+    print(csd_urban.nlargest(10, 'area_km2')[sample_cols].to_string(index=False))
+
+    # Check for completely missing data
+    missing_precip = csd_urban[csd_urban['avg_annual_precip_mm'].isna()]
+    missing_frostfree = csd_urban[csd_urban['avg_annual_frost_free_days'].isna()]
+    missing_degree_days = csd_urban[csd_urban['avg_annual_degree_days_b10'].isna()]
+
+    if len(missing_precip) > 0:
+        print(f"\n❌ ERROR: {len(missing_precip)} CSDs missing precipitation data:")
+        print(missing_precip[['CSDUID', 'CSDNAME', 'province', 'area_km2']].to_string(index=False))
+    else:
+        print(f"\n✅ All CSDs have precipitation data")
 
-        # Calculate dimensions in km
-        pixel_width_km = (corners_meters[1][0] - corners_meters[0][0]) / 1000
-        pixel_height_km = (corners_meters[2][1] - corners_meters[0][1]) / 1000
-        pixel_area_km2 = pixel_width_km * pixel_height_km
+    if len(missing_frostfree) > 0:
+        print(f"\n❌ ERROR: {len(missing_frostfree)} CSDs missing frost-free days data:")
+        print(missing_frostfree[['CSDUID', 'CSDNAME', 'province', 'area_km2']].to_string(index=False))
+    else:
+        print(f"\n✅ All CSDs have frost-free days data")
 
-        print(f"Raster pixel size: ~{pixel_width_km:.1f} km × {pixel_height_km:.1f} km (at {center_lat:.0f}°N)")
-        print(f"Raster pixel area: ~{pixel_area_km2:.1f} km²")
+    if len(missing_degree_days) > 0:
+        print(f"\n❌ ERROR: {len(missing_degree_days)} CSDs missing degree days data:")
+        print(missing_degree_days[['CSDUID', 'CSDNAME', 'province', 'area_km2']].to_string(index=False))
     else:
-        # Projected CRS - resolution is already in meters
-        pixel_width_km = abs(raster_res[0]) / 1000
-        pixel_height_km = abs(raster_res[1]) / 1000
-        pixel_area_km2 = pixel_width_km * pixel_height_km
-        print(f"Raster pixel size: {pixel_width_km:.1f} km × {pixel_height_km:.1f} km")
-        print(f"Raster pixel area: {pixel_area_km2:.1f} km²")
-
-    print(f"CSD CRS: {csd_urban.crs}")
-
-# Reproject csd_urban to match raster CRS if needed
-if csd_urban.crs != raster_crs:
-    print(f"\nReprojecting CSDs from {csd_urban.crs} to {raster_crs}...")
-    csd_urban_reprojected = csd_urban.to_crs(raster_crs)
-else:
-    csd_urban_reprojected = csd_urban.copy()
-
-# Ensure CSDUID is a column (not just index) in the reprojected data
-if 'CSDUID' not in csd_urban_reprojected.columns:
-    csd_urban_reprojected = csd_urban_reprojected.reset_index()
-
-# Extract precipitation with area-weighted mean
-print("\n🔍 Extracting precipitation data (area-weighted method)...")
-precip_results = exactextract.exact_extract(
-    precip_path,
-    csd_urban_reprojected,
-    ['mean', 'count'],
-    include_cols=['CSDUID'],
-    include_geom=False
-)
-
-# Extract frost-free days with area-weighted mean
-print("🔍 Extracting frost-free days data (area-weighted method)...")
-frostfree_results = exactextract.exact_extract(
-    frost_free_path,
-    csd_urban_reprojected,
-    ['mean', 'count'],
-    include_cols=['CSDUID'],
-    include_geom=False
-)
-
-# Extract degree growing days with area-weighted mean
-print("🔍 Extracting degree growing days data (area-weighted method)...")
-degree_days_results = exactextract.exact_extract(
-    degree_days_path,
-    csd_urban_reprojected,
-    ['mean', 'count'],
-    include_cols=['CSDUID'],
-    include_geom=False
-)
-
-# Convert results from GeoJSON format to DataFrame
-print("\n🔧 Processing results...")
-
-
-def extract_properties(results_list):
-    """Extract properties from GeoJSON-like format returned by exactextract"""
-    if isinstance(results_list, list) and len(results_list) > 0:
-        if isinstance(results_list[0], dict) and 'properties' in results_list[0]:
-            # GeoJSON format - extract properties
-            return pd.DataFrame([item['properties'] for item in results_list])
-        else:
-            # Already in correct format
-            return pd.DataFrame(results_list)
-    return pd.DataFrame(results_list)
-
-
-precip_results_df = extract_properties(precip_results)
-frost_free_results_df = extract_properties(frostfree_results)
-degree_days_results_df = extract_properties(degree_days_results)
-
-# Verify CSDUID is present
-if 'CSDUID' not in precip_results_df.columns:
-    print("\n❌ ERROR: CSDUID not in results even after extraction!")
-    print("Available columns:", precip_results_df.columns.tolist())
-    raise ValueError("CSDUID column missing from exactextract results")
-
-# Rename columns for clarity
-precip_results_df = precip_results_df.rename(columns={
-    'mean': 'avg_annual_precip_mm',
-    'count': 'precip_pixel_count'
-})
-
-frost_free_results_df = frost_free_results_df.rename(columns={
-    'mean': 'avg_annual_frost_free_days',
-    'count': 'frostfree_pixel_count'
-})
-
-degree_days_results_df = degree_days_results_df.rename(columns={
-    'mean': 'avg_annual_degree_days_b10',
-    'count': 'degree_days_pixel_count'
-})
-
-# Merge results back to csd_urban
-print("\n🔗 Merging climate data to CSD dataset...")
-csd_urban = csd_urban.merge(precip_results_df, on='CSDUID', how='left')
-csd_urban = csd_urban.merge(frost_free_results_df, on='CSDUID', how='left')  # <- frost-free merged
-csd_urban = csd_urban.merge(degree_days_results_df, on='CSDUID', how='left')
-
-# Report results
-print("\n" + "=" * 70)
-print("CLIMATE DATA EXTRACTION SUMMARY")
-print("=" * 70)
-
-print(f"\n📊 Precipitation statistics:")
-print(f"  CSDs with data: {csd_urban['avg_annual_precip_mm'].notna().sum()} / {len(csd_urban)}")
-print(f"  Mean precipitation: {csd_urban['avg_annual_precip_mm'].mean():.1f} mm")
-print(f"  Range: {csd_urban['avg_annual_precip_mm'].min():.1f} - {csd_urban['avg_annual_precip_mm'].max():.1f} mm")
-
-print(f"\n📊 Frost-free days statistics:")
-print(f"  CSDs with data: {csd_urban['avg_annual_frost_free_days'].notna().sum()} / {len(csd_urban)}")
-print(f"  Mean frost-free days: {csd_urban['avg_annual_frost_free_days'].mean():.1f} days")
-print(f"  Range: {csd_urban['avg_annual_frost_free_days'].min():.1f} - {csd_urban['avg_annual_frost_free_days'].max():.1f} days")
-
-# List CSDUIDs missing frost-free days data
-missing_frostfree = csd_urban[csd_urban['avg_annual_frost_free_days'].isna()]
-
-print(f"\n❌ CSDs missing frost-free days data: {len(missing_frostfree)}")
-
-if len(missing_frostfree) > 0:
-    print(
-        missing_frostfree[
-            ['CSDUID', 'CSDNAME', 'province']
-        ].sort_values('province')
-        .to_string(index=False)
-    )
-else:
-    print("✅ No CSDs missing frost-free days data")
-
-frost_free_override = {
-    '5917015': 213,  # Central Saanich, 48.5753° N, 123.4454° W, Victoria (Airport)
-    '5917021': 213,  # Saanich, 48.4528° N, 123.3755° W, Victoria (Airport)
-    '5917030': 213,  # Oak Bay, 48.4265° N, 123.3141° W,
-    '5917034': 213,  # Victoria
-    '5917040': 213,  # Esquimalt, 48.4358° N, 123.4112° W
-    '5917041': 213,  # Colwood, 48.4288° N, 123.4889° W
-    '5917047': 213,  # View Royal, 48.4528° N, 123.4348° W
-    '5919012': 213,  # Duncan, 48.7787° N, 123.7079° W
-    '5929005': 235,  # Gibsons, 49.3974° N, 123.5152° W
-}
+        print(f"\n✅ All CSDs have degree growing days data")
 
-mask = csd_urban['avg_annual_frost_free_days'].isna()
-
-csd_urban.loc[mask, 'avg_annual_frost_free_days'] = (
-    csd_urban.loc[mask, 'CSDUID']
-    .map(frost_free_override)
-)
-
-# Flag these as imputed
-csd_urban.loc[mask, 'frost_free_source'] = 'Imputed (coastal override)'
-csd_urban.loc[~mask, 'frost_free_source'] = 'Raster'
-
-
-print(f"\n📊 Degree growing days statistics:")
-print(f"  CSDs with data: {csd_urban['avg_annual_degree_days_b10'].notna().sum()} / {len(csd_urban)}")
-print(f"  Mean degree days: {csd_urban['avg_annual_degree_days_b10'].mean():.1f}")
-print(
-    f"  Range: {csd_urban['avg_annual_degree_days_b10'].min():.1f} - {csd_urban['avg_annual_degree_days_b10'].max():.1f}")
-
-# Analyze pixel coverage
-print(f"\n⚠️  PIXEL COVERAGE ANALYSIS:")
-print(f"  Pixel size: ~{pixel_width_km:.1f} km (E-W) × ~{pixel_height_km:.1f} km (N-S)")
-print(f"  Pixel area: ~{pixel_area_km2:.1f} km² per pixel")
-print(f"\n  Distribution of pixel counts per CSD (based on precipitation pixel counts):")
-
-pixel_bins = [
-    (1, 1, "1 pixel only"),
-    (2, 2, "2 pixels"),
-    (3, 3, "3 pixels"),
-    (4, 5, "4-5 pixels"),
-    (6, 9, "6-9 pixels"),
-    (10, 20, "10-20 pixels"),
-    (21, 999, "20+ pixels")
-]
+    print("\n" + "=" * 70)
+    print("✅ CLIMATE DATA EXTRACTION COMPLETE")
+    print("=" * 70)
 
-for min_px, max_px, label in pixel_bins:
-    count = ((csd_urban['precip_pixel_count'] >= min_px) &
-             (csd_urban['precip_pixel_count'] <= max_px)).sum()
-    pct = (count / len(csd_urban)) * 100
-    print(f"    {label:15s}: {count:3d} CSDs ({pct:5.1f}%)")
-
-# Calculate median pixel count
-median_pixels = csd_urban['precip_pixel_count'].median()
-print(f"\n  Median pixels per CSD: {median_pixels:.1f}")
-
-# Flag CSDs with very low pixel counts
-low_coverage = csd_urban[csd_urban['precip_pixel_count'] <= 5].copy()
-if len(low_coverage) > 0:
-    print(f"\n⚠️  DATA QUALITY WARNING:")
-    print(f"  {len(low_coverage)} CSDs ({len(low_coverage) / len(csd_urban) * 100:.1f}%) are covered by ≤5 pixels")
-    print(f"  These CSDs have limited spatial resolution for climate estimation")
-    print(f"\n  Examples of low-coverage CSDs:")
-    low_coverage_sample = low_coverage.nsmallest(10, 'area_km2')[
-        ['CSDUID', 'CSDNAME', 'area_km2', 'precip_pixel_count',
-         'frostfree_pixel_count', 'avg_annual_precip_mm', 'avg_annual_frost_free_days', 'avg_annual_degree_days_b10']
-    ]
-    print(low_coverage_sample.to_string(index=False))
-
-# Add data quality flag
-csd_urban['climate_data_quality'] = 'Good'
-csd_urban.loc[csd_urban['precip_pixel_count'] <= 5, 'climate_data_quality'] = 'Low (≤5 pixels)'
-csd_urban.loc[csd_urban['precip_pixel_count'] <= 2, 'climate_data_quality'] = 'Very Low (≤2 pixels)'
-
-quality_counts = csd_urban['climate_data_quality'].value_counts()
-print(f"\n📋 Climate Data Quality Flags:")
-for quality, count in quality_counts.items():
-    print(f"  {quality:25s}: {count:3d} CSDs")
-
-# Show sample of results
-print("\n📝 Sample climate data (first 10 CSDs sorted by area):")
-sample_cols = ['CSDUID', 'CSDNAME', 'area_km2', 'avg_annual_precip_mm', 'avg_annual_frost_free_days',
-               'avg_annual_degree_days_b10', 'climate_data_quality']
-print(csd_urban.nlargest(10, 'area_km2')[sample_cols].to_string(index=False))
-
-# Check for completely missing data
-missing_precip = csd_urban[csd_urban['avg_annual_precip_mm'].isna()]
-missing_frostfree = csd_urban[csd_urban['avg_annual_frost_free_days'].isna()]
-missing_degree_days = csd_urban[csd_urban['avg_annual_degree_days_b10'].isna()]
-
-if len(missing_precip) > 0:
-    print(f"\n❌ ERROR: {len(missing_precip)} CSDs missing precipitation data:")
-    print(missing_precip[['CSDUID', 'CSDNAME', 'province', 'area_km2']].to_string(index=False))
-else:
-    print(f"\n✅ All CSDs have precipitation data")
-
-if len(missing_frostfree) > 0:
-    print(f"\n❌ ERROR: {len(missing_frostfree)} CSDs missing frost-free days data:")
-    print(missing_frostfree[['CSDUID', 'CSDNAME', 'province', 'area_km2']].to_string(index=False))
-else:
-    print(f"\n✅ All CSDs have frost-free days data")
-
-if len(missing_degree_days) > 0:
-    print(f"\n❌ ERROR: {len(missing_degree_days)} CSDs missing degree days data:")
-    print(missing_degree_days[['CSDUID', 'CSDNAME', 'province', 'area_km2']].to_string(index=False))
-else:
-    print(f"\n✅ All CSDs have degree growing days data")
-
-print("\n" + "=" * 70)
-print("✅ CLIMATE DATA EXTRACTION COMPLETE")
-print("=" * 70)
+    # Multi-band climate series: each series is streamed band by band over windows of the CSD extent; rows are
+    # (CSDUID, band, mean, count)
+    if CLIMATE_SERIES:
+        os.makedirs(CLIMATE_SERIES_DIR, exist_ok=True)
+    for series_name, series_path in CLIMATE_SERIES.items():
+        series_csv = os.path.join(CLIMATE_SERIES_DIR, f'{series_name}_by_csd.csv')
+        extract_band_series(csd_urban, series_path, series_csv, CLIMATE_CACHE_DIR, block_rows=CLIMATE_SERIES_BLOCK_ROWS)
+        print(f"Saved {series_name} series to: {series_csv}")
+
+    climate_columns = [column for column in csd_urban.columns if column not in csd_columns]
+    return pd.DataFrame(csd_urban[['CSDUID'] + climate_columns])
 
 # endregion
 
 ## --------------------------------------------------- SAVE OUTPUTS ----------------------------------------------------
 #region
 
-urban_df.to_csv('Datasets/Outputs/2021_census_of_population/2021_census_of_population_municipalities.csv', index=False)
-print(f"\nFinal urban dataset saved to "
-      f"'Datasets/Outputs/2021_census_of_population/2021_census_of_population_municipalities.csv' ({len(urban_df)} rows)")
-
-# Create a copy with shortened column names for shapefile compatibility
-csd_urban_shp = csd_urban.copy()
-csd_urban_shp = csd_urban_shp.rename(columns={
-    'assigned_ecozone': 'assign_eco',
-    'ecozone_count': 'eco_count',
-    'all_ecozone': 'all_eco',
-    'dominant_ecozone': 'dom_eco',
-    'coverage_pct': 'cover_pct',
-    'assignment_error': 'assign_err',
-    'avg_annual_precip_mm': 'precip_mm',
-    'avg_annual_degree_days_b10': 'deg_day10',
-    'avg_annual_frost_free_days': 'ff_days',
-    'in_eab_area_2024': 'eab_area_2024',
-    'in_eab_area_2025': 'eab_area_2025'
-})
-
-# Save polygons (both formats)
-urban_shp_path = 'Datasets/Outputs/urban_csds/urban_csds.shp'
-csd_urban_shp.to_file(urban_shp_path, driver="ESRI Shapefile")
-print(f"Saved polygons (shapefile) to: {urban_shp_path}")
-
-urban_gpkg_path = 'Datasets/Outputs/urban_csds/urban_csds.gpkg'
-csd_urban.to_file(urban_gpkg_path, driver="GPKG")
-print(f"Saved polygons (geopackage) to: {urban_gpkg_path}")
-
-# Save centroids (both formats)
-centroids_shp = csd_urban_shp.copy()
-centroids_shp["geometry"] = centroids_shp.geometry.centroid
-centroid_shp_path = 'Datasets/Outputs/urban_csd_centroids/urban_csd_centroids.shp'
-centroids_shp.to_file(centroid_shp_path, driver="ESRI Shapefile")
-print(f"Saved centroids (shapefile) to: {centroid_shp_path}")
-
-centroids_gpkg = csd_urban.copy()
-centroids_gpkg["geometry"] = centroids_gpkg.geometry.centroid
-centroid_gpkg_path = 'Datasets/Outputs/urban_csd_centroids/urban_csd_centroids.gpkg'
-centroids_gpkg.to_file(centroid_gpkg_path, driver="GPKG")
-print(f"Saved centroids (geopackage) to: {centroid_gpkg_path}")
-
-# Save attribute table as CSV (with full column names)
-csv_data = csd_urban[['CSDUID', 'CSDNAME', 'PRUID', 'province', 'area_km2',
-                      'assigned_ecozone', 'dominant_ecozone', 'coverage_pct',
-                      'in_eab_area_2024', 'in_eab_area_2025', 'avg_annual_precip_mm', 'avg_annual_frost_free_days',
-                      'avg_annual_degree_days_b10']].copy()
-csv_path = 'Datasets/Outputs/urban_csds/urban_csds_attributes.csv'
-csv_data.to_csv(csv_path, index=False)
-print(f"Saved attribute table to: {csv_path}")
+def save_outputs(amalgamation, ecozones, eab, climate):
+    """Join the stage results into the final urban CSD layers and tables, with the optional threshold sweep"""
+    urban_df = amalgamation['census']
+    csd_urban = (amalgamation['csds']
+                 .merge(ecozones, on='CSDUID', how='left')
+                 .merge(eab['flags'], on='CSDUID', how='left')
+                 .merge(eab['distances'], on='CSDUID', how='left')
+                 .merge(climate, on='CSDUID', how='left'))
+    eab_flag_columns = eab['flag_columns']
+    proximity_columns = ([column for column in eab['distances'].columns if column != 'CSDUID']
+                         + ['ecozone_boundary_distance_km'])
+
+    # Urban threshold sweep scenarios (the candidate CSDs were selected with the loosest thresholds in load_clean)
+    sweep_enabled = bool(SWEEP_MIN_POPULATION or SWEEP_MIN_DENSITY)
+    sweep_population = SWEEP_MIN_POPULATION or [URBAN_MIN_POPULATION]
+    sweep_density = SWEEP_MIN_DENSITY or [URBAN_MIN_DENSITY]
+    if sweep_enabled:
+        print("\n" + "=" * 70)
+        print("URBAN THRESHOLD SWEEP")
+        print("=" * 70)
+        os.makedirs(SWEEP_DIR, exist_ok=True)
+
+        # All attributes were computed once for the candidate CSDs; each scenario is a mask over them
+        urban_thresholds = urban_df[['CSDUID', 'Population, 2021', 'Population Density (sq km)']].astype(
+            {'CSDUID': str})
+        candidates = csd_urban[['CSDUID', 'CSDNAME', 'province', 'area_km2', 'assigned_ecozone', 'avg_annual_precip_mm',
+                                'avg_annual_frost_free_days', 'avg_annual_degree_days_b10']].merge(
+            urban_thresholds, on='CSDUID', how='left'
+        )
+        amalgamated_csduids = amalgamation['amalgamated_csduids']
+
+        baseline_csduids = threshold_sweep(candidates, [URBAN_MIN_POPULATION], [URBAN_MIN_DENSITY],
+                                           amalgamated_csduids)['CSDUID']
+        eligible_sets = threshold_sweep(candidates, sweep_population, sweep_density, amalgamated_csduids)
+        summary = sweep_summary(eligible_sets, baseline_csduids)
+        ecozones_by_scenario = (pd.crosstab(eligible_sets['scenario'], eligible_sets['assigned_ecozone'])
+                                .reindex(summary['scenario']).reset_index())
+
+        eligible_sets.to_csv(f'{SWEEP_DIR}/eligible_csds_by_scenario.csv', index=False)
+        summary.to_csv(f'{SWEEP_DIR}/scenario_summary.csv', index=False)
+        ecozones_by_scenario.to_csv(f'{SWEEP_DIR}/scenario_ecozones.csv', index=False)
+        # Candidate polygons, e.g. as CSD_PATH for a single roads.py run that covers every scenario
+        write_layers(csd_urban, f'{SWEEP_DIR}/candidate_csds', ['parquet'])
+
+        print(f"\n{len(summary)} scenarios over {len(candidates)} candidate CSDs (baseline: population ≥ "
+              f"{URBAN_MIN_POPULATION}, density ≥ {URBAN_MIN_DENSITY}, {len(baseline_csduids)} CSDs)")
+        print(summary[['scenario', 'n_csds', 'population', 'added_vs_baseline',
+                       'removed_vs_baseline']].to_string(index=False))
+        print(f"Saved sweep tables and candidate polygons to: {SWEEP_DIR}")
+
+        # Every other output keeps the baseline eligible set
+        csd_urban = csd_urban[csd_urban['CSDUID'].isin(baseline_csduids)].reset_index(drop=True)
+        urban_df = urban_df[urban_df['CSDUID'].astype(str).isin(baseline_csduids)].reset_index(drop=True)
+
+    urban_df.to_csv(MUNICIPALITIES_PATH, index=False)
+    print(f"\nFinal urban dataset saved to '{MUNICIPALITIES_PATH}' ({len(urban_df)} rows)")
+
+    # Shortened column names for shapefile compatibility (only applied when 'shp' is requested)
+    shp_columns = {
+        'assigned_ecozone': 'assign_eco',
+        'ecozone_count': 'eco_count',
+        'all_ecozone': 'all_eco',
+        'dominant_ecozone': 'dom_eco',
+        'coverage_pct': 'cover_pct',
+        'assignment_error': 'assign_err',
+        'avg_annual_precip_mm': 'precip_mm',
+        'avg_annual_degree_days_b10': 'deg_day10',
+        'avg_annual_frost_free_days': 'ff_days',
+        'precip_source': 'precip_src',
+        'frost_free_source': 'ff_src',
+        'degree_days_source': 'dd_src',
+        'precip_impute_distance_km': 'precip_imp',
+        'frost_free_impute_distance_km': 'ff_imp_km',
+        'degree_days_impute_distance_km': 'dd_imp_km',
+        'climate_pixel_area_km2': 'px_area_km',
+        'climate_coverage_km2': 'clim_km2',
+        'in_eab_area_2024': 'eab_area_2024',
+        'in_eab_area_2025': 'eab_area_2025',
+        'assigned_ecoregion': 'assign_er',
+        'ecoregion_coverage_pct': 'er_cov_pct',
+        'dominant_ecoregion': 'dom_er',
+        'assigned_ecodistrict': 'assign_ed',
+        'ecodistrict_coverage_pct': 'ed_cov_pct',
+        'dominant_ecodistrict': 'dom_ed',
+        'first_eab_regulated_year': 'eab_first',
+        # Every EAB year/status flag, e.g. in_eab_area_2024_Inactive -> eab24_Inac
+        **{column: f"eab{column.split('_')[3][-2:]}_{column.split('_')[4][:4]}" for column in eab_flag_columns},
+        'ecozone_boundary_distance_km': 'ez_bnd_km',
+        # Nearest EAB area per year, e.g. eab_distance_km_2024 -> eab24_km
+        **{column: f"eab{column[-2:]}_km" for column in proximity_columns if column.startswith('eab_distance_km_')}
+    }
 
-#endregion
+    # Save polygons (GeoParquet, plus any legacy formats requested in OUTPUT_FORMATS)
+    urban_paths = write_layers(csd_urban, URBAN_CSDS_STEM, OUTPUT_FORMATS, shp_columns=shp_columns)
+    for output_format, output_path in urban_paths.items():
+        print(f"Saved polygons ({output_format}) to: {output_path}")
+
+    # Save centroids
+    urban_centroids = csd_urban.copy()
+    urban_centroids["geometry"] = urban_centroids.geometry.centroid
+    centroid_paths = write_layers(urban_centroids, CENTROIDS_STEM, OUTPUT_FORMATS, shp_columns=shp_columns)
+    for output_format, output_path in centroid_paths.items():
+        print(f"Saved centroids ({output_format}) to: {output_path}")
+
+    # Save attribute table as CSV (with full column names)
+    # Ecoregion/ecodistrict columns are only present when the ecodistrict layer was available
+    level_columns = [column for level in FINER_ECOLOGICAL_LEVELS
+                     for column in (f'assigned_{level}', f'{level}_coverage_pct') if column in csd_urban.columns]
+    csv_data = csd_urban[['CSDUID', 'CSDNAME', 'PRUID', 'province', 'area_km2',
+                          'assigned_ecozone', 'dominant_ecozone', 'coverage_pct',
+                          'in_eab_area_2024', 'in_eab_area_2025', 'avg_annual_precip_mm', 'avg_annual_frost_free_days',
+                          'avg_annual_degree_days_b10', 'first_eab_regulated_year'] + level_columns
+                         + proximity_columns].copy()
+    csv_data.to_csv(ATTRIBUTES_PATH, index=False)
+    print(f"Saved attribute table to: {ATTRIBUTES_PATH}")
+
+    return csd_urban
 
-exit()
+#endregion
 
-## ----------------------------------------- MAP CSDs WITHIN MULTIPLE ECOZONES -----------------------------------------
+## ---------------------------------------------------- MAP OUTPUTS ----------------------------------------------------
 #region
 
-# Define ecozone colours organized by groups
-ecozone_groups = {
-    'Arctic': {
-        'Arctic Cordillera': '#bac3e0',
-        'Northern Arctic': '#FAF9F6',
-        'Southern Arctic': '#e6f1ff',
-    },
-    'Subarctic': {
-        'Taiga Shield': '#ffe4c9',
-        'Hudson Plain': '#98d4ff',
-    },
-    'Forested': {
-        'MixedWood Plain': '#818c3c',
-        'Boreal Shield': '#25591f',
-        'Boreal Plain': '#487a67',
-        'Taiga Cordillera': '#a7bc30',
-        'Taiga Plain': '#b5d79f',
-        'Boreal Cordillera': '#147453',
-    },
-    'Mountain': {
-        'Montane Cordillera': '#969797',
-    },
-    'Prairie': {
-        'Prairie': '#b08962',
-    },
-    'Maritime': {
-        'Pacific Maritime': '#064273',
-        'Atlantic Maritime': '#1da2d8',
-    }
-}
-
-# Flatten the dictionary for plotting
-ecozone_colours = {zone: color for group in ecozone_groups.values() for zone, color in group.items()}
+def map_layers():
+    """Ecozones clipped to the provinces once, with a simplified display tier; every map filters this layer"""
+    ecozone = gpd.read_file(ECOZONE_PATH).dropna(subset=['geometry'])
+    ecozone['ZONE_NAME'] = ecozone['ZONE_NAME'].replace('Boreal PLain', 'Boreal Plain')
+    provinces_gdf = gpd.read_file(PROVINCES_PATH)
+
+    ecozone_clipped = ecozone_province_layer(ecozone, provinces_gdf, MAP_DISPLAY_TOLERANCE)
+    os.makedirs(os.path.dirname(MAP_LAYERS_PATH), exist_ok=True)
+    ecozone_clipped.to_parquet(MAP_LAYERS_PATH, index=False)
+    print(f"Clipped {len(ecozone)} ecozones to {len(provinces_gdf)} provinces: {len(ecozone_clipped)} pieces "
+          f"(saved to {MAP_LAYERS_PATH})")
+    return ecozone_clipped
+
+
+def maps(save, map_layers):
+    """Maps of the CSDs spanning multiple ecozones and of the eligible CSDs nationally and by region (paths returned)"""
+    csd_urban = save
+    # Drawn from the simplified tier; regional layers below are PRUID filters of it
+    ecozone_clipped = map_layers.set_geometry('display_geometry')
+    multi_ecozone_csds = csd_urban[csd_urban['ecozone_count'] > 1]
+    urban_centroids = csd_urban.copy()
+    urban_centroids["geometry"] = urban_centroids.geometry.centroid
+
+    ecozone = gpd.read_file(ECOZONE_PATH).dropna(subset=['geometry']).to_crs(csd_urban.crs)
+    ecozone['ZONE_NAME'] = ecozone['ZONE_NAME'].replace('Boreal PLain', 'Boreal Plain')
+    provinces_gdf = gpd.read_file(PROVINCES_PATH)
+
+    # One PNG per CSD spanning multiple ecozones, rendered headlessly across MAP_WORKERS processes; basemap tiles come
+    # from the local tile cache; tiles it lacks are only downloaded (once, up front) when BASEMAP_TILE_URL is set
+    if len(multi_ecozone_csds) > 0:
+        print(f"\nGenerating maps for {len(multi_ecozone_csds)} CSDs spanning multiple ecozone...")
+        figure_paths = render_multi_ecozone_maps(multi_ecozone_csds, ecozone, MULTI_ECOZONE_FIGURES_DIR, BASEMAP_TILES,
+                                                 BASEMAP_TILE_URL, n_workers=MAP_WORKERS)
+        print(f"Completed mapping {len(multi_ecozone_csds)} CSDs with multiple ecozone "
+              f"(saved to {MULTI_ECOZONE_FIGURES_DIR}).\n")
+    else:
+        figure_paths = []
+        print("\nNo CSDs span multiple ecozone - no maps to generate.\n")
 
-# Map CSDs with multiple ecozone
-if len(multi_ecozone_csds) > 0:
-    print(f"\nGenerating maps for {len(multi_ecozone_csds)} CSDs spanning multiple ecozone...")
+    # Create figure and axis
+    fig, ax = plt.subplots(figsize=(16, 10))
 
-    for idx, row in multi_ecozone_csds.iterrows():
-        csd_geom = row.geometry
-        csd_name = row['CSDNAME']
-        csd_id = row['CSDUID']
+    # Plot provinces as base layer (with edges)
+    provinces_gdf.plot(ax=ax, facecolor='none', edgecolor='black', linewidth=1.5)
 
-        # Find which ecozone intersect this specific CSD
-        intersecting_ecozone = ecozone[ecozone.geometry.intersects(csd_geom)].copy()
+    # Plot ecozone with custom colors
+    for zone_name, color in ECOZONE_COLOURS.items():
+        ecozone_subset = ecozone_clipped[ecozone_clipped['ZONE_NAME'] == zone_name]
+        if not ecozone_subset.empty:
+            ecozone_subset.plot(ax=ax,
+                               color=color,
+                               alpha=0.55,
+                               edgecolor='darkgray',
+                               linewidth=0.5)
 
-        # Create figure
-        fig, ax = plt.subplots(figsize=(12, 10))
+    print(f"Number of CSDs to plot: {len(urban_centroids)}")
 
-        # Plot the ecozones that intersect this CSD with custom colors
-        intersecting_ecozone_3857 = intersecting_ecozone.to_crs(epsg=3857)
-        for zone_name, color in ecozone_colours.items():
-            ecozone_subset = intersecting_ecozone_3857[intersecting_ecozone_3857['ZONE_NAME'] == zone_name]
-            if not ecozone_subset.empty:
-                ecozone_subset.plot(
-                    ax=ax,
-                    color=color,
-                    alpha=0.35,
-                    edgecolor='black',
-                    linewidth=2
-                )
-
-        # Plot the CSD boundary on top
-        csd_3857 = gpd.GeoSeries([csd_geom], crs=csd_urban.crs).to_crs(epsg=3857)
-        csd_3857.plot(
-            ax=ax,
-            edgecolor='red',
-            facecolor='none',
-            linewidth=4
-        )
+    # Plot CSDs as black points
+    urban_centroids.plot(ax=ax,
+                       color='black',
+                       markersize=25,
+                       alpha=0.7)
 
-        # Add ecozone labels
-        for _, ecozone_row in intersecting_ecozone.iterrows():
-            # Get centroid of the intersection for label placement
-            intersection = csd_geom.intersection(ecozone_row.geometry)
-            if not intersection.is_empty:
-                centroid = intersection.centroid
-                centroid_3857 = gpd.GeoSeries([centroid], crs=csd_urban.crs).to_crs(epsg=3857).iloc[0]
-
-                ax.annotate(
-                    ecozone_row['ZONE_NAME'],
-                    xy=(centroid_3857.x, centroid_3857.y),
-                    fontsize=12,
-                    fontweight='bold',
-                    ha='center',
-                    bbox=dict(boxstyle='round,pad=0.5', facecolor='yellow', alpha=0.7)
-                )
-
-        # Zoom to CSD extent with buffer
-        bounds = csd_3857.total_bounds  # [minx, miny, maxx, maxy]
-        width = bounds[2] - bounds[0]
-        height = bounds[3] - bounds[1]
-        buffer = max(width, height) * 0.1  # 10% buffer
-
-        ax.set_xlim(bounds[0] - buffer, bounds[2] + buffer)
-        ax.set_ylim(bounds[1] - buffer, bounds[3] + buffer)
-
-        # Add basemap
-        ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik)
-
-        # Set title and formatting
-        ax.set_title(f'{csd_name} (CSDUID: {csd_id})\nEcozones: {row["all_ecozone"]}',
-                     fontsize=14, fontweight='bold', pad=20)
-        ax.set_axis_off()
+    # Create combined legend with grouped ecozone
+    combined_legend_elements = []
 
-        plt.tight_layout()
-        plt.show()
+    # Add ecozone by group
+    for group_name, zones in ECOZONE_GROUPS.items():
+        # Add group header (bold text, no patch)
+        combined_legend_elements.append(Patch(facecolor='none', edgecolor='none',
+                                             label=f'$\\bf{{{group_name}}}$ $\\bf{{ecozone}}$'))
+        # Add each zone in the group (indented with spaces)
+        for zone_name, color in zones.items():
+            if zone_name in ecozone['ZONE_NAME'].values:
+                combined_legend_elements.append(Patch(facecolor=color, alpha=0.5,
+                                                     edgecolor='darkgray',
+                                                     label=f'  {zone_name}'))
+
+    # Add a separator
+    combined_legend_elements.append(Patch(facecolor='none', edgecolor='none', label=''))
 
-    print(f"Completed mapping {len(multi_ecozone_csds)} CSDs with multiple ecozone.\n")
-else:
-    print("\nNo CSDs span multiple ecozone - no maps to generate.\n")
+    # Add municipality legend element
+    combined_legend_elements.append(
+        Line2D([0], [0], marker='o', color='w', markerfacecolor='black',
+               markersize=10, alpha=0.6, label='$\\bf{Eligible\\ Municipality}$')
+    )
 
-#endregion
+    # Add the combined legend
+    ax.legend(handles=combined_legend_elements,
+             loc='center left',
+             bbox_to_anchor=(1, 0.5),
+             fontsize=12,
+             title='Legend',
+             framealpha=0.9)
 
-## ----------------------------------------- MAP THE URBAN CSDs WITH ECOZONES ------------------------------------------
-#region
+    # Remove axes
+    ax.set_axis_off()
 
-# Create figure and axis
-fig, ax = plt.subplots(figsize=(16, 10))
-
-# Plot provinces as base layer (with edges)
-provinces_gdf.plot(ax=ax, facecolor='none', edgecolor='black', linewidth=1.5)
-
-# Flatten the dictionary for plotting
-ecozone_colours = {zone: color for group in ecozone_groups.values() for zone, color in group.items()}
-
-# Clip ecozones to province boundaries
-ecozone_clipped = gpd.overlay(ecozone, provinces_gdf, how='intersection')
-
-# Map colors to ecozone
-ecozone_clipped['color'] = ecozone_clipped['ZONE_NAME'].map(ecozone_colours)
-
-# Plot ecozone with custom colors
-for zone_name, color in ecozone_colours.items():
-    ecozone_subset = ecozone_clipped[ecozone_clipped['ZONE_NAME'] == zone_name]
-    if not ecozone_subset.empty:
-        ecozone_subset.plot(ax=ax,
-                           color=color,
-                           alpha=0.55,
-                           edgecolor='darkgray',
-                           linewidth=0.5)
-
-print(f"Number of CSDs to plot: {len(centroids_gpkg)}")
-
-# Plot CSDs as black points
-centroids_gpkg.plot(ax=ax,
-                   color='black',
-                   markersize=25,
-                   alpha=0.7)
-
-# Create combined legend with grouped ecozone
-combined_legend_elements = []
-
-# Add ecozone by group
-for group_name, zones in ecozone_groups.items():
-    # Add group header (bold text, no patch)
-    combined_legend_elements.append(Patch(facecolor='none', edgecolor='none',
-                                         label=f'$\\bf{{{group_name}}}$ $\\bf{{ecozone}}$'))
-    # Add each zone in the group (indented with spaces)
-    for zone_name, color in zones.items():
-        if zone_name in ecozone['ZONE_NAME'].values:
-            combined_legend_elements.append(Patch(facecolor=color, alpha=0.5,
+    plt.tight_layout()
+    national_path = f'{ELIGIBLE_FIGURES_DIR}/eligible_csds_nationally.pdf'
+    plt.savefig(national_path)
+    plt.close(fig)
+    figure_paths.append(national_path)
+
+    # Function to create legend elements
+    def create_legend_elements(ecozone_in_region):
+        """Create legend elements for ecozone and municipalities present in the region"""
+        legend_elements = []
+
+        # Add ecozone by group
+        for group_name, zones in ECOZONE_GROUPS.items():
+            zones_in_region = [z for z in zones.keys() if z in ecozone_in_region]
+            if zones_in_region:
+                # Add group header
+                legend_elements.append(Patch(facecolor='none', edgecolor='none',
+                                             label=f'$\\bf{{{group_name}}}$ $\\bf{{ecozone}}$'))
+                # Add each zone in the group
+                for zone_name in zones_in_region:
+                    color = zones[zone_name]
+                    legend_elements.append(Patch(facecolor=color, alpha=0.5,
                                                  edgecolor='darkgray',
                                                  label=f'  {zone_name}'))
 
-# Add a separator
-combined_legend_elements.append(Patch(facecolor='none', edgecolor='none', label=''))
+        # Add separator
+        legend_elements.append(Patch(facecolor='none', edgecolor='none', label=''))
 
-# Add municipality legend element
-combined_legend_elements.append(
-    Line2D([0], [0], marker='o', color='w', markerfacecolor='black',
-           markersize=10, alpha=0.6, label='$\\bf{Eligible\\ Municipality}$')
-)
+        # Add municipality legend element
+        legend_elements.append(
+            Line2D([0], [0], marker='o', color='w', markerfacecolor='black',
+                   markersize=10, alpha=0.6, label='$\\bf{Eligible\\ Municipality}$')
+        )
 
-# Add the combined legend
-ax.legend(handles=combined_legend_elements,
-         loc='center left',
-         bbox_to_anchor=(1, 0.5),
-         fontsize=12,
-         title='Legend',
-         framealpha=0.9)
+        return legend_elements
 
-# Remove axes
-ax.set_axis_off()
 
-plt.tight_layout()
-plt.savefig('figures/eligible_csds/eligible_csds_nationally.pdf')
-plt.show()
+    # Create a plot for each region
+    for region_name, pruid_list in MAP_REGIONS.items():
+        # Filter provinces for this region
+        region_provinces = provinces_gdf[provinces_gdf['PRUID'].astype(int).isin(pruid_list)]
 
-# Define regions using PRUID values directly
-regions = {
-    "British Columbia": [59],
-    "Prairies": [48, 47, 46],
-    "Ontario": [35],
-    "Québec": [24],
-    "Atlantic Canada": [10, 11, 12, 13]
-}
+        if region_provinces.empty:
+            print(f"Warning: No provinces found for {region_name}")
+            continue
 
-# Function to create legend elements
-def create_legend_elements(ecozone_in_region):
-    """Create legend elements for ecozone and municipalities present in the region"""
-    legend_elements = []
+        # Ecozone pieces already clipped to this region's provinces
+        region_ecozone_clipped = ecozone_clipped[ecozone_clipped['PRUID'].isin(pruid_list)]
 
-    # Add ecozone by group
-    for group_name, zones in ecozone_groups.items():
-        zones_in_region = [z for z in zones.keys() if z in ecozone_in_region]
-        if zones_in_region:
-            # Add group header
-            legend_elements.append(Patch(facecolor='none', edgecolor='none',
-                                         label=f'$\\bf{{{group_name}}}$ $\\bf{{ecozone}}$'))
-            # Add each zone in the group
-            for zone_name in zones_in_region:
-                color = zones[zone_name]
-                legend_elements.append(Patch(facecolor=color, alpha=0.5,
-                                             edgecolor='darkgray',
-                                             label=f'  {zone_name}'))
-
-    # Add separator
-    legend_elements.append(Patch(facecolor='none', edgecolor='none', label=''))
+        # Filter communities by PRUID
+        region_communities = urban_centroids[urban_centroids['PRUID'].isin(pruid_list)]
 
-    # Add municipality legend element
-    legend_elements.append(
-        Line2D([0], [0], marker='o', color='w', markerfacecolor='black',
-               markersize=10, alpha=0.6, label='$\\bf{Eligible\\ Municipality}$')
-    )
+        # Create figure and axis
+        fig, ax = plt.subplots(figsize=(16, 9))
 
-    return legend_elements
+        # Plot provinces as base layer
+        region_provinces.plot(ax=ax,
+                              facecolor='none',
+                              edgecolor='black',
+                              linewidth=1.5)
 
+        # Plot ecozone with custom colors
+        ecozone_in_region = []
+        for zone_name, color in ECOZONE_COLOURS.items():
+            ecozone_subset = region_ecozone_clipped[region_ecozone_clipped['ZONE_NAME'] == zone_name]
+            if not ecozone_subset.empty:
+                ecozone_in_region.append(zone_name)
+                ecozone_subset.plot(ax=ax,
+                                    color=color,
+                                    alpha=0.55,
+                                    edgecolor='darkgray',
+                                    linewidth=0.5)
+
+        # Plot CSDs for this region only
+        region_communities.plot(ax=ax,
+                               color='black',
+                               markersize=60,
+                               alpha=0.7)
+
+        # Create and add legend (without title)
+        legend_elements = create_legend_elements(ecozone_in_region)
+        ax.legend(handles=legend_elements,
+                  loc='center left',
+                  bbox_to_anchor=(1, 0.5),
+                  fontsize=12,
+                  framealpha=0.9)
+
+        # Remove axes (no title added)
+        ax.set_axis_off()
 
-# Create a plot for each region
-for region_name, pruid_list in regions.items():
-    # Filter provinces for this region
-    region_provinces = provinces_gdf[provinces_gdf['PRUID'].astype(int).isin(pruid_list)]
+        # Adjust layout and save
+        plt.tight_layout()
+        filename = f'{ELIGIBLE_FIGURES_DIR}/eligible_csds_{region_name}.pdf'
+        plt.savefig(filename, bbox_inches='tight')
+        print(f"Saved: {filename}")
+        plt.close(fig)
+        figure_paths.append(filename)
 
-    if region_provinces.empty:
-        print(f"Warning: No provinces found for {region_name}")
-        continue
+    return figure_paths
 
-    # Filter ecozone by spatial intersection with region provinces
-    region_ecozone = ecozone[ecozone.geometry.intersects(region_provinces.union_all())]
+#endregion
 
-    # Filter communities by PRUID
-    region_communities = centroids_gpkg[centroids_gpkg['PRUID'].isin(pruid_list)]
+## ----------------------------------------------------- PIPELINE ------------------------------------------------------
+#region
 
-    # Create figure and axis
-    fig, ax = plt.subplots(figsize=(16, 9))
+SWEEP_OUTPUTS = [f'{SWEEP_DIR}/{name}' for name in ['eligible_csds_by_scenario.csv', 'scenario_summary.csv',
+                                                    'scenario_ecozones.csv', 'candidate_csds.parquet']]
+
+# Each stage is re-run when its function, declared input files, parameters or upstream results change; any edit to this
+# script (a constant or a non-stage helper included) or to a helper module re-runs every stage (see main)
+STAGES = [
+    Stage('load_clean', load_clean, files=CENSUS_PATHS,
+          params=[URBAN_MIN_POPULATION, URBAN_MIN_DENSITY, SWEEP_MIN_POPULATION, SWEEP_MIN_DENSITY, CENSUS_CACHE_PATH,
+                  CENSUS_MANIFEST_PATH]),
+    Stage('amalgamation', amalgamation, inputs=['load_clean'], files=[AMALGAMATION_PATH, CSD_PATH] + CENSUS_PATHS,
+          params=[CENSUS_CACHE_PATH, CENSUS_MANIFEST_PATH]),
+    Stage('ecozones', ecozones, inputs=['amalgamation'], files=[ECOZONE_PATH, ECODISTRICT_PATH],
+          params=ECOLOGICAL_LEVELS),
+    Stage('eab', eab, inputs=['amalgamation'], files=[EAB_PATH]),
+    Stage('climate', climate, inputs=['amalgamation'],
+          files=list(CLIMATE_RASTERS.values()) + list(CLIMATE_SERIES.values()),
+          params=[CLIMATE_RASTERS, CLIMATE_EXTRACTION, CLIMATE_CACHE_DIR, CLIMATE_LOW_COVERAGE_KM2,
+                  CLIMATE_VERY_LOW_COVERAGE_KM2, IMPUTE_NEIGHBOURS, CLIMATE_SERIES, CLIMATE_SERIES_DIR,
+                  CLIMATE_SERIES_BLOCK_ROWS],
+          outputs=[os.path.join(CLIMATE_SERIES_DIR, f'{name}_by_csd.csv') for name in CLIMATE_SERIES]),
+    Stage('save', save_outputs, inputs=['amalgamation', 'ecozones', 'eab', 'climate'],
+          params=[OUTPUT_FORMATS, URBAN_MIN_POPULATION, URBAN_MIN_DENSITY, SWEEP_MIN_POPULATION, SWEEP_MIN_DENSITY,
+                  SWEEP_DIR, ECOLOGICAL_LEVELS],
+          outputs=[MUNICIPALITIES_PATH, ATTRIBUTES_PATH, *output_paths(URBAN_CSDS_STEM, OUTPUT_FORMATS).values(),
+                   *output_paths(CENTROIDS_STEM, OUTPUT_FORMATS).values()]
+                  + (SWEEP_OUTPUTS if SWEEP_MIN_POPULATION or SWEEP_MIN_DENSITY else [])),
+    # Maps are only drawn when targeted (--stage maps)
+    Stage('map_layers', map_layers, files=[ECOZONE_PATH, PROVINCES_PATH], params=MAP_DISPLAY_TOLERANCE,
+          outputs=[MAP_LAYERS_PATH], on_demand=True),
+    Stage('maps', maps, inputs=['save', 'map_layers'], files=[ECOZONE_PATH, PROVINCES_PATH], on_demand=True,
+          main_thread=True,
+          params=[BASEMAP_TILES, BASEMAP_TILE_URL, MAP_WORKERS, MULTI_ECOZONE_FIGURES_DIR, MAP_REGIONS],
+          outputs=[f'{ELIGIBLE_FIGURES_DIR}/eligible_csds_{region}.pdf' for region in ['nationally', *MAP_REGIONS]],
+          # The multi-ecozone PNGs are named after their CSDs, so every path maps() returns is recorded as an output
+          result_outputs=lambda figure_paths: figure_paths),
+]
 
-    # Plot provinces as base layer
-    region_provinces.plot(ax=ax,
-                          facecolor='none',
-                          edgecolor='black',
-                          linewidth=1.5)
 
-    # Clip ecozones to regional province boundaries
-    region_ecozone_clipped = gpd.overlay(region_ecozone, region_provinces, how='intersection')
+def main():
+    parser = argparse.ArgumentParser(description="Urban CSD pipeline: only stages whose inputs changed are re-run")
+    parser.add_argument('--stage', choices=[stage.name for stage in STAGES],
+                        help="bring only this stage (and the stages it depends on) up to date")
+    parser.add_argument('--force', action='store_true', help="re-run the targeted stage (or all stages) even if cached")
+    parser.add_argument('--workers', type=int, default=PIPELINE_WORKERS, help="threads for independent stages")
+    args = parser.parse_args()
 
-    # Plot ecozone with custom colors
-    ecozone_in_region = []
-    for zone_name, color in ecozone_colours.items():
-        ecozone_subset = region_ecozone_clipped[region_ecozone_clipped['ZONE_NAME'] == zone_name]
-        if not ecozone_subset.empty:
-            ecozone_in_region.append(zone_name)
-            ecozone_subset.plot(ax=ax,
-                                color=color,
-                                alpha=0.55,
-                                edgecolor='darkgray',
-                                linewidth=0.5)
-
-    # Plot CSDs for this region only
-    region_communities.plot(ax=ax,
-                           color='black',
-                           markersize=60,
-                           alpha=0.7)
-
-    # Create and add legend (without title)
-    legend_elements = create_legend_elements(ecozone_in_region)
-    ax.legend(handles=legend_elements,
-              loc='center left',
-              bbox_to_anchor=(1, 0.5),
-              fontsize=12,
-              framealpha=0.9)
-
-    # Remove axes (no title added)
-    ax.set_axis_off()
+    # This script (its constants and non-stage code included) and the helper modules are part of every stage key
+    code_files = [__file__] + [module.__file__ for module in (census_processing, climate_extraction, geo_io,
+                                                              map_rendering)]
+    code_version = fingerprint(PIPELINE_VERSION, [file_fingerprint(path) for path in code_files])
+    run_pipeline(STAGES, PIPELINE_CACHE_DIR, target=args.stage, force=args.force, max_workers=args.workers,
+                 code_version=code_version)
 
-    # Adjust layout and save
-    plt.tight_layout()
-    filename = f'figures/eligible_csds/eligible_csds_{region_name}.pdf'
-    plt.savefig(filename, bbox_inches='tight')
-    print(f"Saved: {filename}")
-    plt.show()
-    plt.close()
 
-#endregion
\ No newline at end of file
+if __name__ == '__main__':
+    main()
+
+#endregion
@@ -0,0 +1,393 @@
+import os
+from functools import reduce
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from pipeline_cache import file_fingerprint, fingerprint, is_cached, load_manifest, record_stage
+
+# Column types of the 2021 Census of Population tables; every other column is a percentage, read as
+# float64 so the published municipalities and attribute CSVs keep the source values
+CENSUS_COLUMN_TYPES = {
+    'CSDUID': 'int32',
+    'CSDNAME': 'string',
+    'MEMBER_CSDUIDS': 'string',  # amalgamation table: ';'-separated CSDUIDs merged into the row's CSDUID
+    'Population, 2021': 'Int32',  # counts are nullable: suppressed CSDs have no values
+    'Total private dwellings': 'Int32',
+    'Private dwellings occupied by usual residents': 'Int32',
+    'Aggregate after-tax income of households': 'Int64',
+    'Land Area (sq km)': 'float64',
+    'Population Density (sq km)': 'float64',
+}
+# Census columns summed over the members of an amalgamation (its density and percentages are derived from these)
+CENSUS_SUM_COLUMNS = ['Population, 2021', 'Total private dwellings', 'Private dwellings occupied by usual residents',
+                      'Aggregate after-tax income of households', 'Land Area (sq km)']
+CENSUS_CACHE_VERSION = 2  # bump when the census schema or merge logic changes so the cached table is rebuilt
+
+## --------------------------------------------------- Census Tables ---------------------------------------------------
+# region
+
+
+def read_census_table(path):
+    """Read one census CSV with the Arrow engine, typed by CENSUS_COLUMN_TYPES (other columns float64)"""
+    table = pd.read_csv(path, engine='pyarrow')
+    table.columns = table.columns.str.lstrip('\ufeff')
+    return table.astype({column: CENSUS_COLUMN_TYPES.get(column, 'float64') for column in table.columns})
+
+
+def load_census_tables(table_paths, cache_path, manifest_path):
+    """Outer join of the census tables on CSDUID with harmonised types, cached as Parquet
+
+    CSDNAME is kept from the first table only and stored as a categorical. The cached table is reused until the
+    content of any input CSV (or CENSUS_CACHE_VERSION) changes.
+    """
+    manifest = load_manifest(manifest_path)
+    key = fingerprint('census_tables', CENSUS_CACHE_VERSION, CENSUS_COLUMN_TYPES,
+                      [file_fingerprint(path, manifest) for path in table_paths])
+    if is_cached(manifest, 'census_tables', key, [cache_path]):
+        return pd.read_parquet(cache_path)
+
+    tables = [read_census_table(path) for path in table_paths]
+    tables = tables[:1] + [table.drop(columns=['CSDNAME'], errors='ignore') for table in tables[1:]]
+    merged = reduce(lambda left, right: left.merge(right, on='CSDUID', how='outer'), tables)
+    merged['CSDNAME'] = merged['CSDNAME'].astype('category')
+
+    tmp_path = cache_path + '.tmp'
+    merged.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    record_stage(manifest, 'census_tables', key, [cache_path], manifest_path)
+    return merged
+
+# endregion
+
+## --------------------------------------------------- Amalgamations ---------------------------------------------------
+# region
+
+
+def amalgamation_members(amalgamations, members_column='MEMBER_CSDUIDS'):
+    """One row per member CSDUID of every amalgamation, with the CSDUID and CSDNAME of the municipality it joins"""
+    members = amalgamations.assign(member=amalgamations[members_column].str.split(';')).explode('member')
+    return pd.DataFrame({
+        'member_CSDUID': members['member'].str.strip().astype('int32').values,
+        'CSDUID': members['CSDUID'].values,
+        'CSDNAME': members['CSDNAME'].astype(str).values,
+    })
+
+
+def dissolve_amalgamations(csds, members):
+    """Replace the member polygons of every amalgamation with one dissolved polygon carrying the target CSDUID/name
+
+    All amalgamations are applied with a single dissolve and one concat. Other attributes come from the first member
+    in layer order. CSDUIDs in `csds` are strings, as in the census subdivision layer.
+    """
+    targets = members.set_index('member_CSDUID')['CSDUID']
+    target = csds['CSDUID'].astype('int32').map(targets)
+    in_amalgamation = target.notna().to_numpy()
+
+    dissolved = (csds[in_amalgamation].assign(CSDUID=target[in_amalgamation].astype('int32').astype(str))
+                 .dissolve(by='CSDUID', aggfunc='first', sort=False))
+    # Target names, in the amalgamation table order
+    names = members.drop_duplicates('CSDUID').set_index('CSDUID')['CSDNAME']
+    names.index = names.index.astype(str)
+    dissolved = dissolved.reindex(names.index.intersection(dissolved.index, sort=False))
+    dissolved['CSDNAME'] = names
+    dissolved = dissolved.reset_index()[csds.columns]
+
+    return pd.concat([csds[~in_amalgamation], dissolved], ignore_index=True)
+
+
+def aggregate_amalgamations(census, members, published=None):
+    """Census rows of the amalgamated municipalities, aggregated from the rows of their member CSDs
+
+    Counts and land area are summed and the density is recomputed from the sums; the 2016-2021 change is recomputed
+    from the members' 2016 populations and the other percentages, whose denominators are not in the tables, are
+    population-weighted means. A figure is missing when any member lacks it. Non-null figures of `published` (e.g.
+    the amalgamation table rows, keyed by CSDUID) take precedence over the aggregates.
+    """
+    population, density = 'Population, 2021', 'Population Density (sq km)'
+    change = 'Population percentage change, 2016 to 2021 (%)'
+    weighted_columns = [column for column in census.columns if column not in CENSUS_COLUMN_TYPES and column != change]
+
+    rows = members[['CSDUID', 'member_CSDUID']].merge(
+        census.drop(columns='CSDNAME').rename(columns={'CSDUID': 'member_CSDUID'}), on='member_CSDUID', how='left')
+    member_population = rows[population].astype('float64')
+    terms = pd.DataFrame({column: rows[column].astype('float64') for column in CENSUS_SUM_COLUMNS})
+    terms['population_2016'] = member_population / (1 + rows[change] / 100)
+    for column in weighted_columns:
+        terms[column] = rows[column] * member_population
+
+    grouped = terms.groupby(rows['CSDUID'], sort=False)
+    sums = grouped.sum(min_count=1).where(grouped.count().eq(grouped.size(), axis=0))
+    aggregated = sums[CENSUS_SUM_COLUMNS].copy()
+    aggregated[density] = sums[population] / sums['Land Area (sq km)']
+    aggregated[change] = (sums[population] / sums['population_2016'] - 1) * 100
+    for column in weighted_columns:
+        aggregated[column] = sums[column] / sums[population]
+
+    if published is not None:
+        published = published.set_index('CSDUID').reindex(aggregated.index)
+        for column in aggregated.columns.intersection(published.columns):
+            aggregated[column] = published[column].astype('float64').fillna(aggregated[column])
+
+    names = members.drop_duplicates('CSDUID').set_index('CSDUID')['CSDNAME']
+    aggregated = aggregated.assign(CSDNAME=names).reset_index()
+    value_types = census.dtypes.drop('CSDNAME')
+    return aggregated[census.columns].astype(value_types.to_dict())
+
+# endregion
+
+## ------------------------------------------------- Zone Assignment ---------------------------------------------------
+# region
+
+
+def zone_overlaps(csds, zones, zone_columns):
+    """Every intersecting CSD/zone polygon pair from one bulk spatial-index query
+
+    Returns one row per pair (CSDUID, zone row position, zone labels, pair count of the CSD), ordered by CSD and zone.
+    """
+    csd_idx, zone_idx = zones.sindex.query(csds.geometry.values, predicate='intersects')
+    order = np.lexsort((zone_idx, csd_idx))
+    csd_idx, zone_idx = csd_idx[order], zone_idx[order]
+
+    return pd.DataFrame({
+        'csd_idx': csd_idx,
+        'CSDUID': csds['CSDUID'].values[csd_idx],
+        'zone_idx': zone_idx,
+        **{zone_column: zones[zone_column].values[zone_idx] for zone_column in zone_columns},
+        'zone_count': np.bincount(csd_idx, minlength=len(csds))[csd_idx],
+    })
+
+
+def _dominant_zone_table(coverage, csds, zone_column, level, dominance_pct):
+    """Dominant zone columns of every CSD (in csds order) from its (csd_idx, zone, zone_count, coverage_pct) rows"""
+    # Largest coverage first within each CSD; ties keep the row order
+    coverage = coverage.sort_values(['csd_idx', 'coverage_pct'], ascending=[True, False], kind='stable')
+    assignments = coverage.assign(CSDUID=csds['CSDUID'].values[coverage['csd_idx']]).groupby('CSDUID', sort=False).agg(
+        top_zone=(zone_column, 'first'),
+        zone_count=('zone_count', 'first'),
+        all_zones=(zone_column, ' | '.join),
+        max_coverage=('coverage_pct', 'first'),
+    )
+
+    dominant = assignments['max_coverage'] >= dominance_pct
+    assignments = pd.DataFrame({
+        f'assigned_{level}': assignments['top_zone'].where(dominant, f'ERROR: No dominant {level}'),
+        f'{level}_count': assignments['zone_count'],
+        f'all_{level}': assignments['all_zones'],
+        f'dominant_{level}': np.where(dominant, 'Yes', 'No'),
+        'coverage_pct': np.where(assignments['zone_count'] > 1, assignments['max_coverage'].round(2), 100.0),
+        'assignment_error': ~dominant,
+    }, index=assignments.index)
+
+    # CSDs that intersect no zone at all
+    assignments = assignments.reindex(csds['CSDUID'].values)
+    no_zone = assignments[f'{level}_count'].isna()
+    assignments.loc[no_zone, [f'assigned_{level}', f'all_{level}']] = f'No {level}'
+    assignments.loc[no_zone, [f'{level}_count', 'coverage_pct']] = 0
+    assignments.loc[no_zone, f'dominant_{level}'] = 'No'
+    assignments.loc[no_zone, 'assignment_error'] = False
+
+    return (assignments.astype({f'{level}_count': 'int64', 'assignment_error': bool})
+            .rename_axis('CSDUID').reset_index())
+
+
+def assign_dominant_zone(csds, zones, zone_column, level, dominance_pct=50.01):
+    """Assign each CSD the zone that covers most of its area, with the same rules as the per-CSD loop it replaces
+
+    A CSD intersecting a single zone polygon gets it with 100 % coverage; otherwise the polygon covering at least
+    dominance_pct of the CSD (area_km2) wins, or the CSD is flagged as an assignment error. Intersection areas are
+    computed in one vectorized pass, only for CSDs that intersect several zone polygons.
+    """
+    overlaps = zone_overlaps(csds, zones, [zone_column])
+
+    multi = overlaps['zone_count'].values > 1
+    csd_geoms = np.asarray(csds.geometry.values)
+    zone_geoms = np.asarray(zones.geometry.values)
+    overlap_km2 = shapely.area(shapely.intersection(csd_geoms[overlaps['csd_idx'].values[multi]],
+                                                    zone_geoms[overlaps['zone_idx'].values[multi]])) / 1_000_000
+
+    overlaps['coverage_pct'] = 100.0
+    overlaps.loc[multi, 'coverage_pct'] = overlap_km2 / csds['area_km2'].values[overlaps['csd_idx'].values[multi]] * 100
+
+    return _dominant_zone_table(overlaps, csds, zone_column, level, dominance_pct)
+
+
+def assign_zone_levels(csds, zones, level_columns, dominance_pct=50.01, detailed_level=None):
+    """Dominant class and coverage at every level of a nested zone hierarchy from one overlay with its finest layer
+
+    level_columns maps each level to the column of `zones` holding its label, e.g. {'ecodistrict': 'ECODISTRIC',
+    'ecoregion': 'ECOREGION'}. Intersection areas are computed once for the finest polygons and summed per label at
+    every level, so coarser levels only cost a groupby. Returns assigned_<level>, <level>_coverage_pct (share of the
+    CSD area_km2) and dominant_<level> (Yes if the assigned class covers at least dominance_pct) for every CSD.
+    detailed_level (e.g. 'ecozone') gets the assign_dominant_zone columns instead, with its classes as the zones.
+    """
+    overlaps = zone_overlaps(csds, zones, list(level_columns.values()))
+
+    csd_geoms = np.asarray(csds.geometry.values)
+    zone_geoms = np.asarray(zones.geometry.values)
+    overlaps['overlap_km2'] = shapely.area(shapely.intersection(csd_geoms[overlaps['csd_idx'].values],
+                                                                zone_geoms[overlaps['zone_idx'].values])) / 1_000_000
+
+    assignments = pd.DataFrame({'CSDUID': csds['CSDUID'].values})
+    for level, zone_column in level_columns.items():
+        # Roll the finest-level areas up to this level's classes, then keep the largest class per CSD
+        coverage = overlaps.groupby(['csd_idx', zone_column], sort=False)['overlap_km2'].sum().reset_index()
+        coverage['coverage_pct'] = coverage['overlap_km2'] / csds['area_km2'].values[coverage['csd_idx']] * 100
+        # Labels are stored as text so numeric framework IDs and the 'No <level>' marker share one column type
+        coverage[zone_column] = coverage[zone_column].astype(str)
+
+        if level == detailed_level:
+            # A CSD within a single class is fully covered by it, as for a single zone polygon
+            coverage['zone_count'] = coverage.groupby('csd_idx')['csd_idx'].transform('size')
+            coverage.loc[coverage['zone_count'] == 1, 'coverage_pct'] = 100.0
+            assignments = _dominant_zone_table(coverage, csds, zone_column, level, dominance_pct).merge(
+                assignments, on='CSDUID', how='right')
+            continue
+
+        top = (coverage.sort_values(['csd_idx', 'coverage_pct'], ascending=[True, False], kind='stable')
+               .drop_duplicates('csd_idx').set_index('csd_idx').reindex(range(len(csds))))
+
+        assignments[f'assigned_{level}'] = top[zone_column].fillna(f'No {level}').values
+        assignments[f'{level}_coverage_pct'] = top['coverage_pct'].round(2).fillna(0).values
+        assignments[f'dominant_{level}'] = np.where(top['coverage_pct'] >= dominance_pct, 'Yes', 'No')
+
+    return assignments
+
+# endregion
+
+## ---------------------------------------------- EAB Regulated Areas --------------------------------------------------
+# region
+
+
+def eab_regulation_flags(centroids, eab_area, year_column='date_regul', status_column='status_reg'):
+    """Flag every CSD centroid for every regulation year/status pair in the EAB layer from one indexed spatial join
+
+    Returns one row per CSDUID with an in_eab_area_<year>_<status> column ('Yes'/'No') for each pair found in the
+    layer and first_eab_regulated_year, the earliest year of any EAB polygon containing the centroid.
+    """
+    eab_area = eab_area[[year_column, status_column, 'geometry']].copy()
+    eab_area['flag'] = ('in_eab_area_' + eab_area[year_column].astype(str).str.strip() + '_'
+                        + eab_area[status_column].astype(str).str.strip())
+
+    joined = gpd.sjoin(centroids[['CSDUID', 'geometry']], eab_area, how='inner', predicate='within')
+    joined = joined.reset_index(drop=True)
+
+    flags = (pd.crosstab(joined['CSDUID'], joined['flag']) > 0).reindex(
+        index=centroids['CSDUID'].values, columns=sorted(eab_area['flag'].unique()), fill_value=False
+    )
+    flags = flags.apply(lambda flag: np.where(flag, 'Yes', 'No'))
+
+    regulated_years = pd.to_numeric(joined[year_column], errors='coerce').groupby(joined['CSDUID']).min()
+    flags['first_eab_regulated_year'] = regulated_years.reindex(flags.index).astype('Int64')
+
+    return flags.rename_axis('CSDUID').reset_index().rename_axis(columns=None)
+
+# endregion
+
+## ----------------------------------------------- Nearest Distances ---------------------------------------------------
+# region
+
+
+def nearest_distance_km(geoms, targets):
+    """Distance (km) from every geometry to its nearest target, from one bulk STRtree nearest query
+
+    Geometries inside or touching a target get 0; NaN is returned for every geometry when there are no targets.
+    """
+    distances = np.full(len(geoms), np.nan)
+    targets = np.asarray(targets)
+    if len(targets) == 0:
+        return distances
+
+    (geom_idx, _), distance_m = shapely.STRtree(targets).query_nearest(
+        np.asarray(geoms), return_distance=True, all_matches=False
+    )
+    distances[geom_idx] = distance_m / 1000
+    return distances
+
+
+def interior_zone_boundaries(zones, zone_column):
+    """Line segments shared by neighbouring polygons of different zones (coastlines and outer edges excluded)"""
+    left, right = zones.sindex.query(zones.geometry.values, predicate='intersects')
+    labels = zones[zone_column].values
+    neighbours = (left < right) & (labels[left] != labels[right])
+
+    boundaries = shapely.boundary(np.asarray(zones.geometry.values))
+    shared = shapely.get_parts(shapely.intersection(boundaries[left[neighbours]], boundaries[right[neighbours]]))
+    return shared[shapely.get_dimensions(shared) == 1]
+
+
+def eab_distance_features(centroids, eab_area, year_column='date_regul'):
+    """Distances (km) from every CSD centroid to the nearest EAB regulated area of each regulation year
+
+    Returns one row per CSDUID with eab_distance_km_<year> for every regulation year in the EAB layer (any status).
+    """
+    points = np.asarray(centroids.geometry.values)
+    features = pd.DataFrame({'CSDUID': centroids['CSDUID'].values})
+
+    years = eab_area[year_column].astype(str).str.strip()
+    for year in sorted(years.unique()):
+        features[f'eab_distance_km_{year}'] = nearest_distance_km(points, eab_area.geometry.values[(years == year).values])
+    return features.round({column: 3 for column in features.columns if column != 'CSDUID'})
+
+
+def zone_boundary_distances(centroids, zones, zone_column, level='ecozone'):
+    """Distances (km) from every CSD centroid to the nearest boundary between two different zones
+
+    Returns one row per CSDUID with <level>_boundary_distance_km.
+    """
+    distances = nearest_distance_km(np.asarray(centroids.geometry.values), interior_zone_boundaries(zones, zone_column))
+    return pd.DataFrame({'CSDUID': centroids['CSDUID'].values, f'{level}_boundary_distance_km': distances.round(3)})
+
+# endregion
+
+## -------------------------------------------------- Threshold Sweep --------------------------------------------------
+# region
+
+
+def threshold_sweep(csds, population_thresholds, density_thresholds, always_eligible=(),
+                    population_column='Population, 2021', density_column='Population Density (sq km)'):
+    """Eligible CSDs under every (minimum population, minimum density) pair, from one broadcast boolean mask
+
+    Returns a long table with one row per scenario and eligible CSD: scenario (e.g. 'pop1000_dens400'),
+    min_population, min_density and the columns of `csds`. CSDUIDs in always_eligible (amalgamations) pass every
+    scenario.
+    """
+    population = csds[population_column].to_numpy(dtype=float, na_value=np.nan)
+    density = csds[density_column].to_numpy(dtype=float, na_value=np.nan)
+    min_population = np.asarray(population_thresholds, dtype=float)
+    min_density = np.asarray(density_thresholds, dtype=float)
+
+    # (scenario population, scenario density, CSD) mask; NaN populations or densities fail every threshold
+    eligible = ((population[None, None, :] >= min_population[:, None, None])
+                & (density[None, None, :] >= min_density[None, :, None])
+                | csds['CSDUID'].isin(always_eligible).to_numpy()[None, None, :])
+    population_idx, density_idx, csd_idx = np.nonzero(eligible)
+
+    scenarios = np.array([[f'pop{p:g}_dens{d:g}' for d in min_density] for p in min_population])
+    sets = csds.iloc[csd_idx].reset_index(drop=True)
+    sets.insert(0, 'scenario', scenarios[population_idx, density_idx])
+    sets.insert(1, 'min_population', min_population[population_idx])
+    sets.insert(2, 'min_density', min_density[density_idx])
+    return sets
+
+
+def sweep_summary(eligible_sets, baseline_csduids, group_column='province',
+                  population_column='Population, 2021', area_column='area_km2'):
+    """One row per scenario: eligible CSDs, total population and area, change against the baseline set, and the
+    number of eligible CSDs in each group_column class (n_<class>)"""
+    eligible_sets = eligible_sets.assign(in_baseline=eligible_sets['CSDUID'].isin(baseline_csduids))
+    summary = eligible_sets.groupby(['scenario', 'min_population', 'min_density'], sort=False).agg(
+        n_csds=('CSDUID', 'size'),
+        population=(population_column, 'sum'),
+        area_km2=(area_column, 'sum'),
+        n_in_baseline=('in_baseline', 'sum'),
+    ).reset_index()
+    summary['added_vs_baseline'] = summary['n_csds'] - summary['n_in_baseline']
+    summary['removed_vs_baseline'] = len(set(baseline_csduids)) - summary['n_in_baseline']
+
+    by_group = pd.crosstab(eligible_sets['scenario'], eligible_sets[group_column]).add_prefix('n_')
+    return summary.drop(columns='n_in_baseline').merge(by_group, left_on='scenario', right_index=True, how='left')
+
+# endregion
@@ -0,0 +1,355 @@
+import os
+from contextlib import ExitStack
+
+import exactextract
+import numpy as np
+import pandas as pd
+import pyproj
+import rasterio
+import shapely
+from exactextract.raster import NumPyRasterSource, RasterioRasterSource
+from rasterio.windows import Window
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from pipeline_cache import data_fingerprint, file_fingerprint, fingerprint, load_manifest, save_manifest
+
+EARTH_RADIUS_KM = 6371.0088  # mean Earth radius, for distances between lon/lat pixel centres
+
+## --------------------------------------------------- Raster Grids ----------------------------------------------------
+# region
+
+
+def raster_grid(path):
+    """Grid of a raster file as (CRS WKT, affine transform, (rows, cols)); rasters on the same grid align exactly"""
+    with rasterio.open(path) as src:
+        return src.crs.to_wkt(), tuple(src.transform)[:6], src.shape
+
+
+def check_aligned(raster_paths):
+    """Raise if the rasters ({name: path}) do not share one CRS, transform and shape; return the common grid"""
+    grids = {name: raster_grid(path) for name, path in raster_paths.items()}
+    reference_name, reference_grid = next(iter(grids.items()))
+    misaligned = [name for name, grid in grids.items() if grid != reference_grid]
+    if misaligned:
+        raise ValueError(f"Rasters {misaligned} are not on the grid of '{reference_name}' (CRS, transform and shape "
+                         f"must match); resample them to a common grid before extraction")
+    return reference_grid
+
+# endregion
+
+## ------------------------------------------------- Zonal Extraction --------------------------------------------------
+# region
+
+
+def extract_zonal_stats(zones, raster_paths, id_column='CSDUID', ops=('mean', 'count')):
+    """Area-weighted zonal statistics of several aligned rasters from a single exactextract pass
+
+    raster_paths maps a short name to each raster file ({'precip': path, ...}). Polygon/pixel coverage fractions are
+    computed once per zone and shared by every raster, and the result is returned directly as a DataFrame with one
+    row per zone: id_column plus <name>_<op> for every raster and op (e.g. precip_mean, precip_count).
+    """
+    check_aligned(raster_paths)
+
+    with ExitStack() as stack:
+        sources = [RasterioRasterSource(stack.enter_context(rasterio.open(path)), name=name)
+                   for name, path in raster_paths.items()]
+        stats = exactextract.exact_extract(sources, zones[[id_column, 'geometry']], list(ops),
+                                           include_cols=[id_column], output='pandas')
+
+    columns = [f'{name}_{op}' for name in raster_paths for op in ops]
+    return pd.DataFrame(stats)[[id_column] + columns]
+
+# endregion
+
+## ---------------------------------------------- Sparse Coverage Weights ----------------------------------------------
+# region
+
+
+def _grid_source(src):
+    """exactextract source covering every cell of a raster's grid with no nodata, so coverage ignores the values"""
+    bounds = src.bounds
+    return NumPyRasterSource(np.ones(src.shape, dtype=np.uint8), bounds.left, bounds.bottom, bounds.right, bounds.top,
+                             srs_wkt=src.crs.to_wkt())
+
+
+def coverage_weight_matrix(zones, grid_path):
+    """Sparse (zones × pixels) CSR matrix of exact polygon/pixel coverage fractions on the grid of grid_path
+
+    Row i is the zone in row i of `zones` and column j is pixel j of the raster in row-major order. Every pixel a
+    polygon touches is kept whatever its value, so the matrix serves any raster on the same grid.
+    """
+    with rasterio.open(grid_path) as src:
+        n_pixels = src.width * src.height
+        cells = exactextract.exact_extract(_grid_source(src), zones[['geometry']], ['cell_id', 'coverage'],
+                                           output='pandas')
+
+    rows = np.repeat(np.arange(len(zones)), cells['cell_id'].map(len).to_numpy())
+    pixel_ids = np.concatenate([np.asarray(ids, dtype=np.int64) for ids in cells['cell_id']])
+    coverage = np.concatenate([np.asarray(fractions, dtype=np.float64) for fractions in cells['coverage']])
+    return sparse.csr_matrix((coverage, (rows, pixel_ids)), shape=(len(zones), n_pixels))
+
+
+def load_weight_matrix(zones, grid_path, cache_dir, id_column='CSDUID'):
+    """Coverage weight matrix of the zones on a raster grid, built once and then read from cache_dir
+
+    The cache file is keyed by the grid (CRS, transform, shape) and a fingerprint of the zone IDs and geometries, so
+    it is rebuilt only when one of them changes.
+    """
+    key = fingerprint('coverage_weights', raster_grid(grid_path), zones[id_column].astype(str).tolist(),
+                      data_fingerprint(shapely.to_wkb(zones.geometry.values)))
+    matrix_path = os.path.join(cache_dir, f'coverage_weights_{key}.npz')
+    if os.path.exists(matrix_path):
+        return sparse.load_npz(matrix_path)
+
+    weights = coverage_weight_matrix(zones, grid_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, f'coverage_weights_{key}.tmp.npz')
+    sparse.save_npz(tmp_path, weights)
+    os.replace(tmp_path, matrix_path)
+    return weights
+
+
+def pixel_array(raster_path, cache_dir, manifest=None, band=1):
+    """Memory-mapped float32 copy of one raster band in row-major pixel order (nodata as NaN), cached in cache_dir
+
+    The copy is written block by block and keyed by the raster's content fingerprint.
+    """
+    key = fingerprint('pixels', file_fingerprint(raster_path, manifest), band)
+    array_path = os.path.join(cache_dir, f'pixels_{key}.npy')
+    if not os.path.exists(array_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = os.path.join(cache_dir, f'pixels_{key}.tmp.npy')
+        with rasterio.open(raster_path) as src:
+            pixels = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(src.height, src.width))
+            for _, window in src.block_windows(band):
+                block = src.read(band, window=window, masked=True).astype(np.float32).filled(np.nan)
+                pixels[window.row_off:window.row_off + window.height,
+                       window.col_off:window.col_off + window.width] = block
+            pixels.flush()
+            del pixels
+        os.replace(tmp_path, array_path)
+
+    return np.load(array_path, mmap_mode='r').reshape(-1)
+
+
+def weighted_zonal_stats(weights, pixels):
+    """Coverage-weighted mean and count of valid pixels per zone: mean = W @ (v · valid) / W @ valid
+
+    Only the pixels referenced by the weight matrix are read from the (memory-mapped) pixel array; NaN pixels are
+    excluded, matching exactextract's mean and count.
+    """
+    used = np.unique(weights.indices)
+    used_weights = sparse.csr_matrix((weights.data, np.searchsorted(used, weights.indices), weights.indptr),
+                                     shape=(weights.shape[0], len(used)))
+
+    values = np.asarray(pixels[used], dtype=np.float64)
+    valid = ~np.isnan(values)
+    count = used_weights @ valid.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (used_weights @ np.where(valid, values, 0.0)) / count
+    return mean, count
+
+
+def extract_weighted_stats(zones, raster_paths, cache_dir, id_column='CSDUID'):
+    """Same output as extract_zonal_stats, from the cached sparse weight matrix and memory-mapped pixel arrays
+
+    The exact polygon/pixel intersection runs only when the zones or the grid change; each raster then costs one
+    sparse matrix-vector product (plus a one-off block-wise copy to .npy the first time it is seen).
+    """
+    check_aligned(raster_paths)
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = load_manifest(manifest_path)
+
+    weights = load_weight_matrix(zones, next(iter(raster_paths.values())), cache_dir, id_column)
+    stats = pd.DataFrame({id_column: zones[id_column].values})
+    for name, path in raster_paths.items():
+        stats[f'{name}_mean'], stats[f'{name}_count'] = weighted_zonal_stats(
+            weights, pixel_array(path, cache_dir, manifest)
+        )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    save_manifest(manifest, manifest_path)
+    return stats
+
+# endregion
+
+## ----------------------------------------------- Band Series Streaming -----------------------------------------------
+# region
+
+
+def _strip_weights(weights, width, block_rows):
+    """Split a weight matrix into row strips of the raster covering the zones, each with weights local to its window
+
+    Returns [(window, weights)] where the window spans the zones' column range and at most block_rows raster rows,
+    and the strip matrix maps zones to the window's pixels in row-major order. Strips without coverage are skipped.
+    """
+    if weights.nnz == 0:
+        return []
+
+    zone_rows = np.repeat(np.arange(weights.shape[0]), np.diff(weights.indptr))
+    pixel_rows, pixel_cols = np.divmod(weights.indices, width)
+    col_off, row_end = pixel_cols.min(), pixel_rows.max() + 1
+    window_width = pixel_cols.max() + 1 - col_off
+
+    strips = []
+    for row_off in range(pixel_rows.min(), row_end, block_rows):
+        height = min(block_rows, row_end - row_off)
+        in_strip = (pixel_rows >= row_off) & (pixel_rows < row_off + height)
+        if not in_strip.any():
+            continue
+        local_pixels = (pixel_rows[in_strip] - row_off) * window_width + pixel_cols[in_strip] - col_off
+        strip = sparse.csr_matrix((weights.data[in_strip], (zone_rows[in_strip], local_pixels)),
+                                  shape=(weights.shape[0], height * window_width))
+        strips.append((Window(col_off, row_off, window_width, height), strip))
+    return strips
+
+
+def extract_band_series(zones, raster_path, output_path, cache_dir, id_column='CSDUID', band_labels=None,
+                        block_rows=256):
+    """Stream area-weighted means of every band of a multi-band raster to a long-format CSV
+
+    Writes one row per zone and band (id_column, band, mean, count). The band label comes from band_labels, the band
+    descriptions or the band number. Bands are read one window of at most block_rows rows at a time, inside the
+    rows and columns covered by the zones. Each band's weighted sums are accumulated and appended to the CSV before
+    the next band, so peak memory depends on the block size and not the number of bands. Zones are reprojected to
+    the raster CRS if needed. The coverage weights come from the cached sparse weight matrix.
+    """
+    with rasterio.open(raster_path) as src:
+        if zones.crs != src.crs:
+            zones = zones.to_crs(src.crs)
+        weights = load_weight_matrix(zones, raster_path, cache_dir, id_column)
+        strips = _strip_weights(weights, src.width, block_rows)
+        labels = band_labels or [description or str(band) for band, description in enumerate(src.descriptions, 1)]
+        if len(labels) != src.count:
+            raise ValueError(f"{len(labels)} band labels given for {src.count} bands in {raster_path}")
+
+        with open(output_path, 'w', newline='') as f:
+            pd.DataFrame(columns=[id_column, 'band', 'mean', 'count']).to_csv(f, index=False)
+            for band, label in enumerate(labels, 1):
+                weighted_sum = np.zeros(len(zones))
+                count = np.zeros(len(zones))
+                for window, strip in strips:
+                    values = src.read(band, window=window, masked=True).astype(np.float64).filled(np.nan).reshape(-1)
+                    valid = ~np.isnan(values)
+                    weighted_sum += strip @ np.where(valid, values, 0.0)
+                    count += strip @ valid.astype(np.float64)
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    mean = weighted_sum / count
+                pd.DataFrame({id_column: zones[id_column].values, 'band': label, 'mean': mean, 'count': count}).to_csv(
+                    f, header=False, index=False
+                )
+
+    return output_path
+
+# endregion
+
+## --------------------------------------------- Nearest-Pixel Imputation ----------------------------------------------
+# region
+
+
+def _distance_coordinates(x, y, geographic):
+    """Coordinates in km whose straight-line distances approximate ground distances
+
+    Geographic (lon/lat) coordinates are placed on a sphere in Earth-centred (ECEF) space, where the chord is within
+    0.1 % of the great-circle distance up to ~500 km; projected coordinates are assumed to be in metres.
+    """
+    if not geographic:
+        return np.column_stack([x, y]) / 1000
+    lon, lat = np.radians(x), np.radians(y)
+    return EARTH_RADIUS_KM * np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def impute_from_nearest_pixels(points, raster_path, cache_dir, k=4, power=2, manifest=None):
+    """Inverse-distance-weighted mean of the k valid pixels nearest to each point, and the distance to the nearest
+
+    points are shapely points in the raster CRS. The centres of all valid (non-nodata) pixels go into one KD-tree that
+    is queried for every point at once. Returns (values, distance_km) arrays aligned with points.
+    """
+    with rasterio.open(raster_path) as src:
+        transform, width, geographic = src.transform, src.width, src.crs.is_geographic
+
+    pixels = pixel_array(raster_path, cache_dir, manifest)
+    valid_ids = np.flatnonzero(~np.isnan(pixels))
+    pixel_rows, pixel_cols = np.divmod(valid_ids, width)
+    pixel_x, pixel_y = transform * (pixel_cols + 0.5, pixel_rows + 0.5)
+
+    tree = cKDTree(_distance_coordinates(pixel_x, pixel_y, geographic))
+    distance_km, neighbours = tree.query(
+        _distance_coordinates(shapely.get_x(points), shapely.get_y(points), geographic), k=k
+    )
+    distance_km, neighbours = distance_km.reshape(len(points), k), neighbours.reshape(len(points), k)
+
+    weights = 1 / np.maximum(distance_km, 1e-9) ** power
+    values = np.asarray(pixels[valid_ids[neighbours]], dtype=np.float64)
+    return (weights * values).sum(axis=1) / weights.sum(axis=1), distance_km[:, 0]
+
+# endregion
+
+## ---------------------------------------------------- Pixel Areas ----------------------------------------------------
+# region
+
+
+def row_pixel_areas_km2(transform, height, crs):
+    """Area (km²) of one pixel in every row of a raster grid, geodesic on the CRS ellipsoid for lon/lat grids
+
+    The area of a lon/lat cell between latitudes φ1 and φ2 is Δλ·b²/2·[q(φ2) − q(φ1)], with
+    q(φ) = sin φ / (1 − e² sin² φ) + ln((1 + e sin φ) / (1 − e sin φ)) / (2e), the exact ellipsoidal zone area.
+    Projected grids get their constant cell area.
+    """
+    if not crs.is_geographic:
+        return np.full(height, abs(transform.a * transform.e) / 1_000_000)
+
+    ellipsoid = pyproj.CRS.from_user_input(crs.to_wkt()).ellipsoid
+    semi_minor = ellipsoid.semi_minor_metre
+    eccentricity = np.sqrt(1 - (semi_minor / ellipsoid.semi_major_metre) ** 2)
+
+    sin_lat = np.sin(np.radians(transform.f + transform.e * np.arange(height + 1)))
+    if eccentricity == 0:
+        q = 2 * sin_lat
+    else:
+        q = (sin_lat / (1 - eccentricity ** 2 * sin_lat ** 2)
+             + np.log((1 + eccentricity * sin_lat) / (1 - eccentricity * sin_lat)) / (2 * eccentricity))
+    return np.abs(np.diff(q)) * np.radians(abs(transform.a)) * semi_minor ** 2 / 2 / 1_000_000
+
+
+def load_row_pixel_areas(raster_path, cache_dir):
+    """Per-row pixel areas (km²) of a raster's grid, computed once and cached in cache_dir keyed by the grid"""
+    key = fingerprint('row_pixel_areas', raster_grid(raster_path))
+    areas_path = os.path.join(cache_dir, f'row_pixel_areas_{key}.npy')
+    if os.path.exists(areas_path):
+        return np.load(areas_path)
+
+    with rasterio.open(raster_path) as src:
+        areas = row_pixel_areas_km2(src.transform, src.height, src.crs)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(areas_path, areas)
+    return areas
+
+
+def pixel_footprint(zones, raster_path, cache_dir, id_column='CSDUID', manifest=None):
+    """Effective pixel area and area covered by valid pixels (both km²) of every zone on a raster
+
+    The effective pixel area is the coverage-weighted mean geodesic area of the pixels a zone touches; the covered
+    area sums coverage fraction × pixel area over its non-nodata pixels, i.e. the zone's true data footprint.
+    """
+    with rasterio.open(raster_path) as src:
+        width = src.width
+    weights = load_weight_matrix(zones, raster_path, cache_dir, id_column)
+    areas = load_row_pixel_areas(raster_path, cache_dir)
+    pixels = pixel_array(raster_path, cache_dir, manifest)
+
+    zone_of_entry = np.repeat(np.arange(len(zones)), np.diff(weights.indptr))
+    entry_km2 = weights.data * areas[weights.indices // width]
+    entry_valid = ~np.isnan(pixels[weights.indices])
+
+    touched = np.bincount(zone_of_entry, weights=weights.data, minlength=len(zones))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pixel_area_km2 = np.bincount(zone_of_entry, weights=entry_km2, minlength=len(zones)) / touched
+    coverage_km2 = np.bincount(zone_of_entry, weights=entry_km2 * entry_valid, minlength=len(zones))
+
+    return pd.DataFrame({id_column: zones[id_column].values, 'pixel_area_km2': pixel_area_km2,
+                         'coverage_km2': coverage_km2})
+
+# endregion
@@ -0,0 +1,111 @@
+import json
+import os
+
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Supported geometry output formats and their file extensions; GeoParquet is the primary artifact
+GEO_FORMATS = {'parquet': '.parquet', 'gpkg': '.gpkg', 'shp': '.shp'}
+
+
+def output_paths(stem, formats):
+    """Map each requested output format to its file path ({format: stem + extension})"""
+    unknown = [fmt for fmt in formats if fmt not in GEO_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown output format(s): {unknown} (expected any of {list(GEO_FORMATS)})")
+    return {fmt: stem + GEO_FORMATS[fmt] for fmt in formats}
+
+
+def write_layer(gdf, path, shp_columns=None):
+    """Write a GeoDataFrame in the format given by the file extension
+
+    shp_columns renames columns for shapefiles only, whose field names are limited to 10 characters.
+    """
+    if path.endswith('.parquet'):
+        gdf.to_parquet(path, index=False)
+    elif path.endswith('.gpkg'):
+        gdf.to_file(path, driver="GPKG")
+    elif path.endswith('.shp'):
+        (gdf.rename(columns=shp_columns) if shp_columns else gdf).to_file(path, driver="ESRI Shapefile")
+    else:
+        raise ValueError(f"Unsupported output file: {path} (expected one of {list(GEO_FORMATS.values())})")
+
+
+def write_layers(gdf, stem, formats, shp_columns=None):
+    """Write a GeoDataFrame once per requested format and return the {format: path} written"""
+    paths = output_paths(stem, formats)
+    for path in paths.values():
+        write_layer(gdf, path, shp_columns=shp_columns)
+    return paths
+
+
+def read_layer(path, columns=None):
+    """Read a layer written by write_layer; GeoParquet is read column-wise through Arrow"""
+    if path.endswith('.parquet'):
+        return gpd.read_parquet(path, columns=columns)
+    return gpd.read_file(path, columns=columns)
+
+
+def _geoparquet_table(gdf):
+    """Arrow table of a GeoDataFrame (WKB geometry) carrying the GeoParquet 'geo' schema metadata"""
+    table = pa.table(gdf.to_arrow(index=False, geometry_encoding='WKB'))
+    geo_metadata = {
+        'version': '1.0.0',
+        'primary_column': gdf.geometry.name,
+        'columns': {gdf.geometry.name: {
+            'encoding': 'WKB',
+            'geometry_types': [],
+            'crs': gdf.crs.to_json_dict() if gdf.crs is not None else None,
+        }},
+    }
+    return table.replace_schema_metadata({**(table.schema.metadata or {}), b'geo': json.dumps(geo_metadata)})
+
+
+class LayerAppender:
+    """Append GeoDataFrames to one layer file as they are produced
+
+    GeoParquet files get one row group per append through a single Arrow writer; other formats are appended with OGR.
+    The Parquet schema comes from template (an empty GeoDataFrame with the layer's columns and dtypes) or else from the
+    first append; columns that are all null there are written as strings. If nothing is appended, the template (or an
+    empty geometry-only layer) is written on close, so the file always exists. Any existing file at the path is
+    replaced. Use as a context manager so the Parquet footer is always written.
+    """
+
+    def __init__(self, path, template=None):
+        self.path = path
+        self.template = template
+        self._writer = None
+        self._schema = None
+        self._written = False
+        if os.path.exists(path):
+            os.remove(path)
+
+    def append(self, gdf):
+        self._written = True
+        if not self.path.endswith('.parquet'):
+            gdf.to_file(self.path, mode='a' if os.path.exists(self.path) else 'w')
+            return
+
+        table = _geoparquet_table(gdf)
+        if self._writer is None:
+            schema = _geoparquet_table(self.template).schema if self.template is not None else table.schema
+            # Arrow types all-null object columns as null, which later chunks with values could not be cast to
+            self._schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                      for field in schema], metadata=schema.metadata)
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        self._writer.write_table(table.cast(self._schema))
+
+    def close(self):
+        if not self._written:
+            write_layer(self.template if self.template is not None else gpd.GeoDataFrame(geometry=[]), self.path)
+            self._written = True
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
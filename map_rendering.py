@@ -0,0 +1,277 @@
+import io
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import closing
+
+import geopandas as gpd
+import numpy as np
+import requests
+import shapely
+from matplotlib.figure import Figure
+from PIL import Image
+from tqdm import tqdm
+
+# Half the width of the Web Mercator (EPSG:3857) world in metres; tile (0, 0) of every zoom starts at (-ORIGIN, ORIGIN)
+WEB_MERCATOR_ORIGIN = 20037508.342789244
+
+# Ecozone colours organized by groups
+ECOZONE_GROUPS = {
+    'Arctic': {
+        'Arctic Cordillera': '#bac3e0',
+        'Northern Arctic': '#FAF9F6',
+        'Southern Arctic': '#e6f1ff',
+    },
+    'Subarctic': {
+        'Taiga Shield': '#ffe4c9',
+        'Hudson Plain': '#98d4ff',
+    },
+    'Forested': {
+        'MixedWood Plain': '#818c3c',
+        'Boreal Shield': '#25591f',
+        'Boreal Plain': '#487a67',
+        'Taiga Cordillera': '#a7bc30',
+        'Taiga Plain': '#b5d79f',
+        'Boreal Cordillera': '#147453',
+    },
+    'Mountain': {
+        'Montane Cordillera': '#969797',
+    },
+    'Prairie': {
+        'Prairie': '#b08962',
+    },
+    'Maritime': {
+        'Pacific Maritime': '#064273',
+        'Atlantic Maritime': '#1da2d8',
+    }
+}
+
+# Flattened {ecozone: colour} for plotting
+ECOZONE_COLOURS = {zone: color for group in ECOZONE_GROUPS.values() for zone, color in group.items()}
+
+## ----------------------------------------------------- Map Layers ----------------------------------------------------
+# region
+
+
+def ecozone_province_layer(zones, provinces, display_tolerance, zone_column='ZONE_NAME'):
+    """Zones clipped to the province boundaries once, one row per zone piece and province (PRUID as int)
+
+    display_geometry is a simplified tier (tolerance in units of the provinces CRS) for the national and regional maps.
+    It is simplified as a coverage, so neighbouring pieces keep shared edges; each region is then a PRUID filter.
+    """
+    zones = zones[[zone_column, 'geometry']].to_crs(provinces.crs)
+    layer = gpd.overlay(zones, provinces[['PRUID', 'geometry']], how='intersection', keep_geom_type=True)
+    layer['PRUID'] = layer['PRUID'].astype(int)
+    layer['display_geometry'] = layer.geometry.simplify_coverage(display_tolerance)
+    return layer
+
+# endregion
+
+## ---------------------------------------------------- Tile Cache -----------------------------------------------------
+# region
+
+
+def auto_zoom(bounds, max_zoom=19):
+    """Tile zoom for a Web Mercator view, as contextily picks it: two to four tiles across the longer side"""
+    span = max(bounds[2] - bounds[0], bounds[3] - bounds[1])
+    return int(min(max(np.ceil(np.log2(4 * WEB_MERCATOR_ORIGIN / span)), 0), max_zoom))
+
+
+def tiles_for_bounds(bounds, zoom):
+    """(zoom, x, y) of every XYZ tile covering Web Mercator bounds (minx, miny, maxx, maxy)"""
+    n = 2 ** zoom
+    tile_size = 2 * WEB_MERCATOR_ORIGIN / n
+    x0, x1 = np.clip(np.floor((np.array(bounds)[[0, 2]] + WEB_MERCATOR_ORIGIN) / tile_size).astype(int), 0, n - 1)
+    y0, y1 = np.clip(np.floor((WEB_MERCATOR_ORIGIN - np.array(bounds)[[3, 1]]) / tile_size).astype(int), 0, n - 1)
+    return [(zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+
+def read_tile(tile_source, zoom, x, y):
+    """Encoded image of one XYZ tile from a tile directory ({z}/{x}/{y}.png) or an MBTiles file, or None if absent"""
+    if tile_source.endswith('.mbtiles'):
+        # MBTiles rows are numbered from the south (TMS)
+        with closing(sqlite3.connect(f'file:{tile_source}?mode=ro', uri=True)) as connection:
+            row = connection.execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                     'AND tile_row = ?', (zoom, x, 2 ** zoom - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    path = os.path.join(tile_source, str(zoom), str(x), f'{y}.png')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def prefetch_tiles(tile_source, tiles, tile_url, timeout=10):
+    """Download the tiles missing from a tile directory once, so rendering itself never touches the network
+
+    Fetching stops at the first network error (e.g. when offline); maps are then drawn with the tiles already cached.
+    MBTiles files are read-only. Returns the number of tiles downloaded.
+    """
+    if tile_source.endswith('.mbtiles'):
+        return 0
+
+    missing = [tile for tile in dict.fromkeys(tiles) if read_tile(tile_source, *tile) is None]
+    fetched = 0
+    with requests.Session() as session:
+        session.headers['User-Agent'] = 'urban-forest-census-maps'
+        for zoom, x, y in missing:
+            try:
+                response = session.get(tile_url.format(z=zoom, x=x, y=y), timeout=timeout)
+                response.raise_for_status()
+            except requests.RequestException as error:
+                print(f"⚠️  Stopped fetching basemap tiles ({len(missing) - fetched} still missing): "
+                      f"{error.__class__.__name__}")
+                break
+
+            path = os.path.join(tile_source, str(zoom), str(x), f'{y}.png')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(response.content)
+            fetched += 1
+    return fetched
+
+
+def basemap_mosaic(tile_source, bounds, zoom):
+    """RGBA mosaic of the cached tiles covering bounds and its extent (left, right, bottom, top) in EPSG:3857
+
+    Missing tiles stay transparent; returns (None, None) when no tile is cached.
+    """
+    tiles = tiles_for_bounds(bounds, zoom)
+    images = {}
+    for tile in tiles:
+        data = read_tile(tile_source, *tile)
+        if data is not None:
+            images[tile[1:]] = np.asarray(Image.open(io.BytesIO(data)).convert('RGBA'))
+    if not images:
+        return None, None
+
+    tile_px = next(iter(images.values())).shape[0]
+    xs = sorted({x for _, x, _ in tiles})
+    ys = sorted({y for _, _, y in tiles})
+    mosaic = np.zeros((len(ys) * tile_px, len(xs) * tile_px, 4), dtype=np.uint8)
+    for (x, y), image in images.items():
+        row, column = (y - ys[0]) * tile_px, (x - xs[0]) * tile_px
+        mosaic[row:row + tile_px, column:column + tile_px] = image
+
+    # Crop to the pixels covering bounds, so matplotlib resamples only what is shown
+    pixel_size = 2 * WEB_MERCATOR_ORIGIN / 2 ** zoom / tile_px
+    left, top = xs[0] * tile_px * pixel_size - WEB_MERCATOR_ORIGIN, WEB_MERCATOR_ORIGIN - ys[0] * tile_px * pixel_size
+    col0, col1 = np.clip([np.floor((bounds[0] - left) / pixel_size), np.ceil((bounds[2] - left) / pixel_size)],
+                         0, mosaic.shape[1]).astype(int)
+    row0, row1 = np.clip([np.floor((top - bounds[3]) / pixel_size), np.ceil((top - bounds[1]) / pixel_size)],
+                         0, mosaic.shape[0]).astype(int)
+    extent = (left + col0 * pixel_size, left + col1 * pixel_size, top - row1 * pixel_size, top - row0 * pixel_size)
+    return mosaic[row0:row1, col0:col1], extent
+
+# endregion
+
+## ------------------------------------------------ Multi-Ecozone Maps -------------------------------------------------
+# region
+
+
+def multi_ecozone_jobs(csds, zones, zone_column='ZONE_NAME', buffer_fraction=0.1):
+    """One picklable job per CSD: its outline, the zones clipped to the map view and label points, all in EPSG:3857
+
+    The view is the CSD extent plus buffer_fraction of its longer side. Zones are clipped slightly beyond the view, so
+    workers only receive the pieces they draw.
+    """
+    csds_3857 = csds.to_crs(epsg=3857)
+    zones_3857 = zones.to_crs(epsg=3857)
+    csd_idx, zone_idx = zones.sindex.query(csds.geometry.values, predicate='intersects')
+
+    # Label points: centroids of the CSD/zone intersections, in the CSD CRS as before and then projected
+    label_points = gpd.GeoSeries(
+        shapely.centroid(shapely.intersection(csds.geometry.values[csd_idx], zones.geometry.values[zone_idx])),
+        crs=csds.crs
+    ).to_crs(epsg=3857).values
+
+    jobs = []
+    for position, (_, row) in enumerate(csds_3857.iterrows()):
+        minx, miny, maxx, maxy = row.geometry.bounds
+        buffer = max(maxx - minx, maxy - miny) * buffer_fraction
+        view = (minx - buffer, miny - buffer, maxx + buffer, maxy + buffer)
+
+        pairs = np.flatnonzero(csd_idx == position)
+        zone_geoms = shapely.clip_by_rect(zones_3857.geometry.values[zone_idx[pairs]], view[0] - buffer,
+                                          view[1] - buffer, view[2] + buffer, view[3] + buffer)
+        labels = [(name, point.x, point.y) for name, point in
+                  zip(zones[zone_column].values[zone_idx[pairs]], label_points[pairs]) if not point.is_empty]
+        jobs.append({'CSDUID': row['CSDUID'], 'CSDNAME': row['CSDNAME'], 'all_ecozone': row['all_ecozone'],
+                     'geometry': row.geometry, 'view': view, 'zone_names': zones[zone_column].values[zone_idx[pairs]],
+                     'zone_geoms': zone_geoms, 'labels': labels})
+    return jobs
+
+
+def render_multi_ecozone_map(job, output_path, tile_source=None, colours=ECOZONE_COLOURS, dpi=150):
+    """Draw one CSD over the ecozones it spans (and the cached basemap) with the Agg canvas and save it"""
+    fig = Figure(figsize=(12, 10))
+    ax = fig.subplots()
+
+    # Plot the ecozones that intersect this CSD with custom colors
+    for zone_name, color in colours.items():
+        zone_geoms = job['zone_geoms'][job['zone_names'] == zone_name]
+        if len(zone_geoms):
+            gpd.GeoSeries(zone_geoms).plot(ax=ax, color=color, alpha=0.35, edgecolor='black', linewidth=2)
+
+    # Plot the CSD boundary on top
+    gpd.GeoSeries([job['geometry']]).plot(ax=ax, edgecolor='red', facecolor='none', linewidth=4)
+
+    # Add ecozone labels
+    for zone_name, x, y in job['labels']:
+        ax.annotate(zone_name, xy=(x, y), fontsize=12, fontweight='bold', ha='center',
+                    bbox=dict(boxstyle='round,pad=0.5', facecolor='yellow', alpha=0.7))
+
+    # Zoom to CSD extent with buffer
+    minx, miny, maxx, maxy = job['view']
+    ax.set_xlim(minx, maxx)
+    ax.set_ylim(miny, maxy)
+
+    # Add basemap from the local tile cache
+    if tile_source is not None:
+        mosaic, extent = basemap_mosaic(tile_source, job['view'], auto_zoom(job['view']))
+        if mosaic is not None:
+            ax.imshow(mosaic, extent=extent, interpolation='bilinear', zorder=0)
+            ax.set_xlim(minx, maxx)
+            ax.set_ylim(miny, maxy)
+
+    # Set title and formatting
+    ax.set_title(f"{job['CSDNAME']} (CSDUID: {job['CSDUID']})\nEcozones: {job['all_ecozone']}",
+                 fontsize=14, fontweight='bold', pad=20)
+    ax.set_axis_off()
+
+    fig.tight_layout()
+    fig.savefig(output_path, dpi=dpi, bbox_inches='tight')
+    return output_path
+
+
+def render_multi_ecozone_maps(csds, zones, output_dir, tile_source=None, tile_url=None, n_workers=1,
+                              zone_column='ZONE_NAME'):
+    """Render one PNG per CSD (<CSDUID>_<CSDNAME>.png in output_dir) across a process pool; returns the paths
+
+    Basemap tiles are read from tile_source (a {z}/{x}/{y}.png directory or an .mbtiles file). With a tile_url,
+    tiles missing from a tile directory are downloaded once up front; workers only read the local cache.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = multi_ecozone_jobs(csds, zones, zone_column)
+    output_paths = [os.path.join(output_dir, re.sub(r'[\\/:*?"<>|]', '_', f"{job['CSDUID']}_{job['CSDNAME']}.png"))
+                    for job in jobs]
+
+    if tile_source is not None and tile_url is not None:
+        tiles = [tile for job in jobs for tile in tiles_for_bounds(job['view'], auto_zoom(job['view']))]
+        fetched = prefetch_tiles(tile_source, tiles, tile_url)
+        print(f"Basemap tiles: {len(set(tiles))} needed, {fetched} downloaded to {tile_source}")
+
+    if n_workers <= 1:
+        return [render_multi_ecozone_map(job, path, tile_source) for job, path in
+                tqdm(zip(jobs, output_paths), total=len(jobs), desc="Rendering maps")]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(render_multi_ecozone_map, job, path, tile_source)
+                   for job, path in zip(jobs, output_paths)]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering maps"):
+            future.result()
+    return output_paths
+
+# endregion
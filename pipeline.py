@@ -0,0 +1,224 @@
+import inspect
+import io
+import os
+import pickle
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import redirect_stdout
+
+from pipeline_cache import file_fingerprint, fingerprint, is_cached, load_manifest, record_stage
+
+## ------------------------------------------------------ Stages -------------------------------------------------------
+# region
+
+
+class Stage:
+    """A named pipeline step whose result is cached between runs
+
+    func is called with the results of the `inputs` stages as keyword arguments (by stage name). The stage key hashes
+    the source of func, the content of `files` (missing files included as absent), `params` and the keys of its
+    inputs; the stage is re-run when its key changes or one of its `outputs` files is missing. result_outputs maps the
+    result to further files the stage wrote whose names depend on the data (e.g. one per CSD); they are recorded with
+    the stage and checked the same way. on_demand stages run only when targeted; main_thread stages (e.g. pyplot
+    drawing, which is not thread-safe) never run on a worker thread.
+    """
+
+    def __init__(self, name, func, inputs=(), files=(), params=None, outputs=(), result_outputs=None, on_demand=False,
+                 main_thread=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.files = list(files)
+        self.params = params
+        self.outputs = list(outputs)
+        self.result_outputs = result_outputs
+        self.on_demand = on_demand
+        self.main_thread = main_thread
+
+
+def topological_order(stages):
+    """Stages sorted so that every stage comes after its inputs; raises ValueError on unknown inputs or cycles"""
+    by_name = {stage.name: stage for stage in stages}
+    ordered, visiting, done = [], set(), set()
+
+    def visit(stage):
+        if stage.name in done:
+            return
+        if stage.name in visiting:
+            raise ValueError(f"Pipeline cycle through stage '{stage.name}'")
+        visiting.add(stage.name)
+        for upstream in stage.inputs:
+            if upstream not in by_name:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{upstream}'")
+            visit(by_name[upstream])
+        visiting.discard(stage.name)
+        done.add(stage.name)
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+def stage_keys(stages, manifest, code_version=None):
+    """Cache key of every stage (in topological order), chained through the keys of its inputs"""
+    keys = {}
+    for stage in topological_order(stages):
+        files = [file_fingerprint(path, manifest) if os.path.exists(path) else None for path in stage.files]
+        keys[stage.name] = fingerprint(stage.name, code_version, inspect.getsource(stage.func), stage.params, files,
+                                       [keys[upstream] for upstream in stage.inputs])
+    return keys
+
+
+def _ancestors(stages, name):
+    selected, queue = set(), [name]
+    while queue:
+        current = queue.pop()
+        if current not in selected:
+            selected.add(current)
+            queue.extend(stages[current].inputs)
+    return selected
+
+# endregion
+
+## ------------------------------------------------------ Runner -------------------------------------------------------
+# region
+
+
+class _StageOutput:
+    """sys.stdout stand-in that holds back what a worker-thread stage prints; other threads write straight through"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    def capture(self):
+        self._local.buffer = io.StringIO()
+
+    def release(self):
+        buffer, self._local.buffer = self._local.buffer, None
+        return buffer.getvalue()
+
+    def write(self, text):
+        buffer = getattr(self._local, 'buffer', None)
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _run_stage(stage, kwargs, result_path, output=None):
+    """Run one stage and pickle its result atomically; returns (result, seconds, printed text)
+
+    With output (the _StageOutput installed as sys.stdout), the stage's prints are returned instead of written, so they
+    can be shown as one block; a failing stage writes them out before its error propagates.
+    """
+    if output is not None:
+        output.capture()
+    try:
+        start = time.perf_counter()
+        result = stage.func(**kwargs)
+
+        tmp_path = result_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, result_path)
+        seconds = time.perf_counter() - start
+    except BaseException:
+        if output is not None:
+            output.stream.write(output.release())
+        raise
+    return result, seconds, output.release() if output is not None else ''
+
+
+def run_pipeline(stages, cache_dir, target=None, force=False, max_workers=None, code_version=None):
+    """Run the stages that are out of date, independent ones concurrently on a thread pool
+
+    Without a target every stage except on_demand ones is brought up to date; with a target only that stage and its
+    upstream stages are. force re-runs the target (or every selected stage) even when cached. Results of up-to-date
+    stages are unpickled from cache_dir only when a re-run stage needs them. Returns {stage name: result} for the
+    stages that were run or loaded.
+    """
+    stages = {stage.name: stage for stage in topological_order(stages)}
+    if target is not None and target not in stages:
+        raise ValueError(f"Unknown stage: {target!r} (expected one of {list(stages)})")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    keys = stage_keys(stages.values(), manifest, code_version)
+
+    def result_path(name):
+        return os.path.join(cache_dir, f'{name}.pkl')
+
+    def stage_outputs(name):
+        return stages[name].outputs + [result_path(name)]
+
+    def recorded_outputs(name):
+        return manifest.get('stages', {}).get(name, {}).get('outputs', [])
+
+    if target is not None:
+        selected = _ancestors(stages, target)
+    else:
+        selected = set().union(*(_ancestors(stages, name) for name, stage in stages.items() if not stage.on_demand))
+
+    # Stage keys chain through their inputs, so any change upstream also changes the key of every downstream stage
+    pending = [name for name in stages if name in selected
+               and (force and target in (None, name)
+                    or not is_cached(manifest, name, keys[name], stage_outputs(name) + recorded_outputs(name)))]
+    for name in stages:
+        if name in selected and name not in pending:
+            print(f"⏭️  Stage '{name}' is up to date")
+
+    results = {}
+
+    def load_result(name):
+        if name not in results:
+            with open(result_path(name), 'rb') as f:
+                results[name] = pickle.load(f)
+        return results[name]
+
+    def finish(name, outcome):
+        results[name], seconds, printed = outcome
+        print(printed, end='')
+        outputs = stage_outputs(name)
+        if stages[name].result_outputs is not None:
+            outputs = list(dict.fromkeys(outputs + list(stages[name].result_outputs(results[name]))))
+        record_stage(manifest, name, keys[name], outputs, manifest_path)
+        print(f"✅ Stage '{name}' finished in {seconds:.1f} s")
+
+    running = {}
+    # Stages on worker threads print into their own buffer, shown as one block when the stage finishes, so concurrent
+    # reports never interleave; the main thread prints live
+    with redirect_stdout(_StageOutput(sys.stdout)) as output, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            blocked = set(pending) | set(running.values())
+            ready = [name for name in pending if not blocked.intersection(stages[name].inputs)]
+            on_main_thread = []
+            for name in ready:
+                pending.remove(name)
+                kwargs = {upstream: load_result(upstream) for upstream in stages[name].inputs}
+                print(f"▶️  Running stage '{name}'")
+                # main_thread stages stay on the main thread however many stages are ready, as does a lone stage
+                if stages[name].main_thread or len(ready) == 1 and not running:
+                    on_main_thread.append((name, kwargs))
+                else:
+                    running[executor.submit(_run_stage, stages[name], kwargs, result_path(name), output)] = name
+
+            # Run alongside the stages just submitted to the pool
+            for name, kwargs in on_main_thread:
+                finish(name, _run_stage(stages[name], kwargs, result_path(name)))
+
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(running.pop(future), future.result())
+
+    return results
+
+# endregion
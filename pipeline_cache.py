@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+
+# Sidecar files that belong to the content of a shapefile
+SHAPEFILE_SIDECARS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def fingerprint(*parts):
+    """Stable hash of any JSON-serializable parts (strings, numbers, lists, dicts, other fingerprints)"""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def data_fingerprint(chunks):
+    """Content hash of in-memory data given as an iterable of bytes-like chunks (e.g. WKB geometries)"""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_file(path, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_fingerprint(path, manifest=None):
+    """Content hash of a file, including the sidecars of a shapefile
+
+    When a manifest is given, the hash of a file whose size and modification time are unchanged is reused instead of
+    re-reading the file.
+    """
+    if path.lower().endswith('.shp'):
+        stem = os.path.splitext(path)[0]
+        paths = [stem + ext for ext in SHAPEFILE_SIDECARS if os.path.exists(stem + ext)]
+    else:
+        paths = [path]
+
+    known = manifest.setdefault('files', {}) if manifest is not None else {}
+    hashes = []
+    for file_path in paths:
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime_ns]
+        entry = known.get(file_path)
+        if entry is None or entry['signature'] != signature:
+            entry = {'signature': signature, 'hash': _hash_file(file_path)}
+            known[file_path] = entry
+        hashes.append(entry['hash'])
+
+    return fingerprint(hashes)
+
+
+def load_manifest(path):
+    """Load a cache manifest, or start an empty one"""
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'files': {}, 'stages': {}}
+
+
+def save_manifest(manifest, path):
+    """Write a cache manifest atomically so an interrupted run never leaves it half-written"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_cached(manifest, stage, key, outputs):
+    """True if the stage was last built from exactly this key and all of its outputs still exist"""
+    entry = manifest.get('stages', {}).get(stage)
+    return (entry is not None and entry['key'] == key
+            and all(os.path.exists(output) for output in outputs))
+
+
+def record_stage(manifest, stage, key, outputs, manifest_path):
+    """Record a freshly built stage and persist the manifest"""
+    manifest.setdefault('stages', {})[stage] = {'key': key, 'outputs': list(outputs)}
+    save_manifest(manifest, manifest_path)
@@ -0,0 +1,302 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+from tqdm import tqdm
+
+from geo_io import LayerAppender
+
+## ------------------------------------------------- Spatial Filtering -------------------------------------------------
+# region
+
+
+def intersecting_road_indices(road_geoms, csd_geoms):
+    """Return the positions of roads intersecting any CSD polygon from one bulk STRtree query"""
+    # Prepared CSD polygons make the exact intersects test cheap for every bounding-box candidate
+    shapely.prepare(csd_geoms)
+    tree = shapely.STRtree(csd_geoms)
+
+    road_idx, csd_idx = tree.query(road_geoms)
+    hits = shapely.intersects(csd_geoms[csd_idx], road_geoms[road_idx])
+
+    return np.unique(road_idx[hits])
+
+
+def available_road_attributes(roads_path, attributes):
+    """Keep the requested road attributes that exist in the road layer, warning about any that are missing"""
+    fields = set(pyogrio.read_info(roads_path)['fields'])
+    missing = [attribute for attribute in attributes if attribute not in fields]
+    if missing:
+        print(f"Warning: road attribute(s) {missing} not found in {roads_path}; skipping them")
+    return [attribute for attribute in attributes if attribute in fields]
+
+
+def source_crs_windows(csd, source_crs, margin=1000, n_vertices=64):
+    """Conservative windows around every CSD in another CRS, for prefiltering roads before they are reprojected
+
+    Each CSD bounding box is expanded by margin (CSD CRS units), densified to n_vertices per edge so its curved outline
+    survives the reprojection, and replaced by the envelope of the result. A road intersecting a CSD once reprojected
+    lies (at least partly) inside its window, so only the exact test after reprojection can drop it.
+    """
+    boxes = shapely.box(*(shapely.bounds(np.asarray(csd.geometry.values)) + [-margin, -margin, margin, margin]).T)
+    sizes = shapely.bounds(boxes)[:, 2:] - shapely.bounds(boxes)[:, :2]
+    densified = shapely.segmentize(boxes, sizes.max(axis=1) / n_vertices)
+    return np.asarray(gpd.GeoSeries(densified, crs=csd.crs).to_crs(source_crs).envelope.values)
+
+
+def read_intersecting_roads(roads_path, csd, columns=None):
+    """Read only the roads intersecting a CSD: prefilter in the road layer's own CRS, then test exactly in the CSD CRS
+
+    Returns the intersecting roads in the CSD CRS and the total number of features in the road layer.
+    """
+    roads_info = pyogrio.read_info(roads_path)
+
+    # Conservative windows let GDAL skip most rural roads before they become Python objects
+    read_mask = shapely.union_all(source_crs_windows(csd, roads_info['crs']))
+    roads = gpd.read_file(roads_path, columns=columns, mask=read_mask).to_crs(csd.crs)
+
+    # The exact test runs against the CSD polygons in their own CRS, so no road crossing a CSD edge is lost
+    road_positions = intersecting_road_indices(np.asarray(roads.geometry.values), np.asarray(csd.geometry.values))
+    roads_intersecting = roads.iloc[road_positions]
+
+    return roads_intersecting, roads_info['features']
+
+
+def clip_road_pairs(road_geoms, csd_geoms, road_idx, csd_idx, chunk_size=None):
+    """Clip roads to CSD polygons for each (road, CSD) index pair with array-level shapely operations"""
+    n_pairs = len(road_idx)
+    chunk_size = chunk_size or max(n_pairs, 1)
+
+    clipped = np.empty(n_pairs, dtype=object)
+    for start in tqdm(range(0, n_pairs, chunk_size), desc="Clipping roads"):
+        stop = start + chunk_size
+        clipped[start:stop] = shapely.intersection(road_geoms[road_idx[start:stop]], csd_geoms[csd_idx[start:stop]])
+
+    return clipped
+
+# endregion
+
+## -------------------------------------------------- Streaming Ingest -------------------------------------------------
+# region
+
+
+def chunk_rows_for_memory(roads_path, memory_limit_gb, expansion=10):
+    """Rows per streamed chunk so that a chunk and its working copies use at most half of the memory ceiling
+
+    The in-memory size of a road is estimated as `expansion` times its average size on disk.
+    """
+    roads_info = pyogrio.read_info(roads_path)
+    stem, ext = os.path.splitext(roads_path)
+    data_files = [stem + '.shp', stem + '.dbf'] if ext.lower() == '.shp' else [roads_path]
+    n_bytes = sum(os.path.getsize(path) for path in data_files if os.path.exists(path))
+
+    bytes_per_road = max(n_bytes / max(roads_info['features'], 1), 1) * expansion
+    return max(int(memory_limit_gb * 1024 ** 3 / 2 / bytes_per_road), 1)
+
+
+def empty_roads(roads_path, attributes, crs, csduid=False):
+    """Empty road layer with the columns (and road layer dtypes) of the intersecting or, with csduid, clipped roads"""
+    dtypes = dict(zip(*(pyogrio.read_info(roads_path)[key] for key in ('fields', 'dtypes'))))
+    columns = {'CSDUID': pd.Series(dtype='int64')} if csduid else {}
+    columns.update({attribute: pd.Series(dtype=dtypes[attribute]) for attribute in attributes})
+    return gpd.GeoDataFrame(columns, geometry=gpd.GeoSeries([], crs=crs), crs=crs)
+
+
+def stream_clip_roads(roads_path, csd, chunk_rows, intersecting_path, clipped_path, attributes=()):
+    """Read the road layer in row ranges and push each chunk through the spatial filter and the clip
+
+    Only the geometry and `attributes` are read, and the attributes are carried onto the clipped roads. Intersecting and
+    clipped roads are appended to their output files chunk by chunk (empty layers when no road intersects a CSD), so
+    only one chunk of the national network is held in memory at a time. Returns the number of roads, intersecting roads
+    and clipped roads written.
+    """
+    roads_info = pyogrio.read_info(roads_path)
+    n_roads = roads_info['features']
+    csd_geoms = np.asarray(csd.geometry.values)
+    windows = shapely.STRtree(source_crs_windows(csd, roads_info['crs']))
+
+    intersecting_template = empty_roads(roads_path, attributes, csd.crs)
+    clipped_template = empty_roads(roads_path, attributes, csd.crs, csduid=True)
+
+    n_intersecting = n_clipped = 0
+    with LayerAppender(intersecting_path, template=intersecting_template) as intersecting_out, \
+            LayerAppender(clipped_path, template=clipped_template) as clipped_out:
+        for start in tqdm(range(0, n_roads, chunk_rows), desc="Streaming road chunks"):
+            chunk = gpd.read_file(roads_path, rows=slice(start, start + chunk_rows), columns=list(attributes))
+
+            # Conservative bounding-box prefilter in the source CRS, so only candidate roads are reprojected
+            candidates = np.unique(windows.query(np.asarray(chunk.geometry.values))[0])
+            if len(candidates) == 0:
+                continue
+            candidate_roads = chunk.iloc[candidates].to_crs(csd.crs)
+            del chunk
+
+            # Exact test in the CSD CRS
+            road_positions = intersecting_road_indices(np.asarray(candidate_roads.geometry.values), csd_geoms)
+            if len(road_positions) == 0:
+                continue
+            roads_intersecting = candidate_roads.iloc[road_positions]
+
+            intersecting_out.append(roads_intersecting)
+            n_intersecting += len(roads_intersecting)
+
+            road_geoms = np.asarray(roads_intersecting.geometry.values)
+            road_idx, csd_idx = csd.sindex.query(road_geoms, predicate='intersects')
+            clipped_geoms = shapely.intersection(road_geoms[road_idx], csd_geoms[csd_idx])
+            keep = ~shapely.is_empty(clipped_geoms)
+
+            clipped_out.append(gpd.GeoDataFrame({'CSDUID': csd['CSDUID'].values[csd_idx[keep]],
+                                                 **{attribute: roads_intersecting[attribute].values[road_idx[keep]]
+                                                    for attribute in attributes}},
+                                                geometry=clipped_geoms[keep], crs=csd.crs))
+            n_clipped += int(keep.sum())
+
+    return n_roads, n_intersecting, n_clipped
+
+# endregion
+
+## -------------------------------------------------- Road Buffering ---------------------------------------------------
+# region
+
+
+def buffer_segments(road_geoms, csd_geoms, buffer_distance):
+    """Buffer every road segment and clip each buffer back to its CSD polygon (element-wise)"""
+    # quad_segs matches the GeoSeries.buffer default
+    return shapely.intersection(shapely.buffer(road_geoms, buffer_distance, quad_segs=16), csd_geoms)
+
+
+def merge_lines_by_csd(road_geoms, csd_idx, n_csds):
+    """Merge the clipped road lines of each CSD into one MultiLineString (None for CSDs without roads)
+
+    Only LineString parts are kept; points and other artefacts left by clipping along CSD boundaries are dropped.
+    """
+    parts, part_idx = shapely.get_parts(road_geoms, return_index=True)
+    is_line = shapely.get_type_id(parts) == shapely.GeometryType.LINESTRING
+    owner = csd_idx[part_idx[is_line]]
+    order = np.argsort(owner, kind='stable')
+
+    merged = np.full(n_csds, None, dtype=object)
+    shapely.multilinestrings(parts[is_line][order], indices=owner[order], out=merged)
+
+    # Joining contiguous segments leaves fewer, longer lines for the buffer to node
+    return shapely.line_merge(merged)
+
+
+def buffer_merged_lines(merged_lines, csd_geoms, buffer_distance):
+    """Buffer each CSD's merged road lines once and clip the (already dissolved) result to the CSD polygon"""
+    return shapely.intersection(shapely.buffer(merged_lines, buffer_distance, quad_segs=16), csd_geoms)
+
+# endregion
+
+## -------------------------------------------- Sharded Per-CSD Processing ---------------------------------------------
+# region
+
+
+def build_csd_shards(road_geoms, csd_geoms, csduids, road_idx, csd_idx):
+    """Group (road, CSD) index pairs into one shard per CSDUID, ordered largest first by vertex count
+
+    Each shard is (CSDUID, CSD polygon, road geometries, road positions in road_geoms).
+    """
+    n_vertices = np.bincount(csd_idx, weights=shapely.get_num_coordinates(road_geoms[road_idx]),
+                             minlength=len(csd_geoms))
+
+    order = np.argsort(csd_idx, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(csd_idx[order])) + 1)
+
+    shards = [(csduids[csd_idx[group[0]]], csd_geoms[csd_idx[group[0]]], road_geoms[road_idx[group]], road_idx[group])
+              for group in groups if len(group) > 0]
+    shard_vertices = [n_vertices[csd_idx[group[0]]] for group in groups if len(group) > 0]
+
+    return [shards[i] for i in np.argsort(shard_vertices, kind='stable')[::-1]]
+
+
+def process_csd_shard(csduid, csd_geom, road_geoms, buffer_distances, clip=True, buffer_mode='merged'):
+    """Clip the roads of a single CSD, then produce one dissolved, clipped-back buffer per buffer distance
+
+    Runs inside a worker process. Returns the clipped roads, the mask of input roads they came from and a
+    {distance: dissolved buffer} dict.
+    """
+    kept = np.ones(len(road_geoms), dtype=bool)
+    if clip:
+        road_geoms = shapely.intersection(road_geoms, csd_geom)
+        kept = ~shapely.is_empty(road_geoms)
+        road_geoms = road_geoms[kept]
+
+    if buffer_mode == 'merged':
+        merged_lines = merge_lines_by_csd(road_geoms, np.zeros(len(road_geoms), dtype=int), 1)[0]
+
+    dissolved = {}
+    for buffer_distance in buffer_distances:
+        if buffer_mode == 'merged':
+            dissolved[buffer_distance] = (shapely.GeometryCollection() if merged_lines is None else
+                                          buffer_merged_lines(merged_lines, csd_geom, buffer_distance))
+        else:
+            buffers = buffer_segments(road_geoms, csd_geom, buffer_distance)
+            dissolved[buffer_distance] = shapely.union_all(buffers[~shapely.is_empty(buffers)])
+
+    return csduid, road_geoms, kept, dissolved
+
+
+def run_sharded_pipeline(shards, buffer_distances, n_workers, crs, buffers_paths, clipped_path=None, clip=True,
+                         buffer_mode='merged', road_attributes=None):
+    """Run the per-CSD clip → buffer → dissolve shards across a process pool
+
+    Finished shards are streamed into the output files ({distance: path} in buffers_paths) as they complete. Columns of
+    road_attributes (rows aligned with the shard road positions) are carried onto the clipped roads.
+    Returns the clipped roads and a {distance: dissolved buffers} dict, one row per CSDUID in each GeoDataFrame; when
+    no shard produces roads or buffers, these (and the files written) are empty with the same columns.
+    """
+    # Empty layers with the output columns, for distances (or clipped roads) that no shard produces
+    empty_columns = {'CSDUID': pd.Series(dtype='int64')}
+    empty_buffers = gpd.GeoDataFrame(empty_columns, geometry=gpd.GeoSeries([], crs=crs), crs=crs)
+    if road_attributes is not None:
+        empty_columns.update({column: pd.Series(dtype=dtype) for column, dtype in road_attributes.dtypes.items()})
+    empty_clipped = gpd.GeoDataFrame(empty_columns, geometry=gpd.GeoSeries([], crs=crs), crs=crs)
+
+    clipped_parts = []
+    buffer_parts = {buffer_distance: [] for buffer_distance in buffer_distances}
+    with ExitStack() as outputs, ProcessPoolExecutor(max_workers=n_workers) as executor:
+        buffers_out = {buffer_distance: outputs.enter_context(LayerAppender(path, template=empty_buffers))
+                       for buffer_distance, path in buffers_paths.items()}
+        clipped_out = (outputs.enter_context(LayerAppender(clipped_path, template=empty_clipped))
+                       if clip and clipped_path else None)
+
+        # Shards are submitted largest first so the biggest CSDs never end up as stragglers
+        futures = {executor.submit(process_csd_shard, csduid, csd_geom, road_geoms, buffer_distances, clip,
+                                   buffer_mode): road_positions
+                   for csduid, csd_geom, road_geoms, road_positions in shards}
+
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing CSD shards"):
+            csduid, clipped_geoms, kept, dissolved = future.result()
+
+            clipped_columns = {'CSDUID': np.repeat(csduid, len(clipped_geoms))}
+            if road_attributes is not None:
+                clipped_rows = road_attributes.iloc[futures[future][kept]]
+                clipped_columns.update({column: clipped_rows[column].values for column in road_attributes.columns})
+            clipped_part = gpd.GeoDataFrame(clipped_columns, geometry=clipped_geoms, crs=crs)
+            clipped_parts.append(clipped_part)
+            if clipped_out is not None and len(clipped_part) > 0:
+                clipped_out.append(clipped_part)
+
+            for buffer_distance, buffer_geom in dissolved.items():
+                if buffer_geom.is_empty:
+                    continue
+                buffer_part = gpd.GeoDataFrame({'CSDUID': [csduid]}, geometry=[buffer_geom], crs=crs)
+                buffer_parts[buffer_distance].append(buffer_part)
+                buffers_out[buffer_distance].append(buffer_part)
+
+    clipped_roads_gdf = gpd.GeoDataFrame(pd.concat(clipped_parts or [empty_clipped], ignore_index=True), crs=crs)
+    road_buffers = {
+        buffer_distance: gpd.GeoDataFrame(pd.concat(parts or [empty_buffers], ignore_index=True), crs=crs)
+        .sort_values('CSDUID').reset_index(drop=True)
+        for buffer_distance, parts in buffer_parts.items()
+    }
+
+    return clipped_roads_gdf, road_buffers
+
+# endregion
@@ -1,239 +1,385 @@
 import geopandas as gpd
+import numpy as np
+import shapely
 from shapely.ops import unary_union
 from tqdm import tqdm
 import os
+import time
 import pandas as pd
 
-BUFFER_DISTANCE_M = 20  # either 10 or 20
-
-print("Loading data...")
-roads = gpd.read_file('Datasets/Inputs/roads/roads.shp')
-csd = gpd.read_file('Datasets/Outputs/urban_csds/urban_csds.gpkg')
-
-# Ensure CSDUID is int64
-csd['CSDUID'] = csd['CSDUID'].astype('int64')
-
-print(f"Original roads: {len(roads)}")
-print(f"Roads CRS: {roads.crs}")
-print(f"CSD CRS: {csd.crs}")
-
-## ----------------------------------------- Reproject Roads to Match CSD CRS ------------------------------------------
-# region
-
-print("\nReprojecting roads to match CSD CRS...")
-roads = roads.to_crs(csd.crs)
-print(f"Roads reprojected to: {roads.crs}")
-
-# endregion
-
-## --------------------------------- Filter Roads that Intersect CSDs (spatial filter) ---------------------------------
-# region
-
-intersecting_roads_path = 'Datasets/Outputs/roads/intersecting_roads.gpkg'
-
-if os.path.exists(intersecting_roads_path):
-    print(f"\nLoading pre-filtered intersecting roads from: {intersecting_roads_path}")
-    roads_intersecting = gpd.read_file(intersecting_roads_path)
-    print(f"Loaded {len(roads_intersecting)} intersecting roads")
-else:
-    print("\nFiltering roads that intersect urban CSDs...")
-
-    # Create a union of all CSD geometries for efficient filtering
-    csd_union = unary_union(csd.geometry.values)
-
-    # Use spatial index for efficient filtering with progress bar
-    tqdm.pandas(desc="Checking intersections")
-    roads['intersects'] = roads.geometry.progress_apply(lambda geom: geom.intersects(csd_union))
-    roads_intersecting = roads[roads['intersects']].copy()
-    roads_intersecting = roads_intersecting.drop(columns=['intersects'])
-
-    print(f"Roads after filtering: {len(roads_intersecting)} (removed {len(roads) - len(roads_intersecting)})")
-
-    # Save for future use
-    print(f"Saving intersecting roads to: {intersecting_roads_path}")
-    roads_intersecting.to_file(intersecting_roads_path, driver="GPKG")
-    print("Saved successfully")
-
-# endregion
-
-## ------------------------------------------------ Clip Roads by CSDs -------------------------------------------------
-# region
-
-clipped_roads_path = 'Datasets/Outputs/roads/clipped_roads.gpkg'
-
-if os.path.exists(clipped_roads_path):
-    print(f"\nLoading pre-clipped roads from: {clipped_roads_path}")
-    clipped_roads_gdf = gpd.read_file(clipped_roads_path)
-    print(f"Loaded {len(clipped_roads_gdf)} clipped road segments")
-else:
-    print("\nClipping roads to CSD boundaries...")
-
-    # Perform spatial join to identify which CSD each road intersects
-    roads_csd_join = gpd.sjoin(roads_intersecting, csd[['CSDUID', 'geometry']], how='inner', predicate='intersects')
-
-    # Clip each road segment to its intersecting CSD(s)
-    clipped_roads = []
-    for idx, road_row in tqdm(roads_csd_join.iterrows(), total=len(roads_csd_join), desc="Clipping roads"):
-        road_geom = road_row.geometry
-        csduid = road_row['CSDUID']
-
-        # Get the CSD polygon
-        csd_geom = csd[csd['CSDUID'] == csduid].iloc[0].geometry
-
-        # Clip the road to the CSD boundary
-        clipped_geom = road_geom.intersection(csd_geom)
-
-        if not clipped_geom.is_empty:
-            clipped_roads.append({
-                'CSDUID': csduid,
-                'geometry': clipped_geom
-            })
-
-    clipped_roads_gdf = gpd.GeoDataFrame(clipped_roads, crs=csd.crs)
-    print(f"Clipped road segments: {len(clipped_roads_gdf)}")
-
-    # Save for future use
-    print(f"Saving clipped roads to: {clipped_roads_path}")
-    clipped_roads_gdf.to_file(clipped_roads_path, driver="GPKG")
-    print("Saved successfully")
-
-# endregion
-
-## ----------------------------------------------- Calculate Road Lengths ----------------------------------------------
-# region
-
-print("\nCalculating road lengths by CSDUID...")
-
-# Calculate length in meters for each road segment
-clipped_roads_gdf['road_length_m'] = clipped_roads_gdf.geometry.length
-
-# Sum lengths by CSDUID and convert to kilometers
-road_lengths = clipped_roads_gdf.groupby('CSDUID')['road_length_m'].sum().reset_index()
-road_lengths['road_length_km'] = road_lengths['road_length_m'] / 1000
-road_lengths = road_lengths[['CSDUID', 'road_length_km']]
-
-# Merge with CSD names for reference
-csd_names = csd[['CSDUID', 'CSDNAME']].copy()
-road_lengths = road_lengths.merge(csd_names, on='CSDUID', how='left')
-
-# Reorder columns
-road_lengths = road_lengths[['CSDUID', 'CSDNAME', 'road_length_km']]
-
-# Save to CSV
-road_lengths_csv_path = 'Datasets/Outputs/roads/road_lengths_by_csd.csv'
-road_lengths.to_csv(road_lengths_csv_path, index=False)
-print(f"Saved road lengths to: {road_lengths_csv_path}")
-
-# Print summary statistics
-print(f"\nRoad Length Summary:")
-print(f"Total CSDs with roads: {len(road_lengths)}")
-print(f"Mean road length: {road_lengths['road_length_km'].mean():.2f} km")
-print(f"Median road length: {road_lengths['road_length_km'].median():.2f} km")
-print(f"Min road length: {road_lengths['road_length_km'].min():.2f} km")
-print(f"Max road length: {road_lengths['road_length_km'].max():.2f} km")
-
-# Check for CSDs with less than 100 km of roads
-low_road_csds = road_lengths[road_lengths['road_length_km'] < 100]
-if len(low_road_csds) > 0:
-    print(f"\n*** WARNING: {len(low_road_csds)} CSDs have less than 100 km of roads ***")
-    print(low_road_csds.to_string(index=False))
-else:
-    print("\nAll CSDs have at least 100 km of roads.")
-
-# endregion
-
-# --------------------------------------------------- Buffer Roads ----------------------------------------------------
-# region
-
-# Create buffer-specific output directory and file paths
-buffer_dir = f'Datasets/Outputs/roads/road_buffers_{BUFFER_DISTANCE_M}m'
-os.makedirs(buffer_dir, exist_ok=True)
-
-buffered_roads_gpkg = os.path.join(buffer_dir, f'buffered_roads_{BUFFER_DISTANCE_M}m.gpkg')
-
-if os.path.exists(buffered_roads_gpkg):
-    print(f"\nLoading pre-buffered roads from: {buffered_roads_gpkg}")
-    road_buffers_gdf = gpd.read_file(buffered_roads_gpkg)
-    print(f"Loaded {len(road_buffers_gdf)} buffered road segments")
-else:
-    print(f"\nBuffering roads by {BUFFER_DISTANCE_M} meters...")
-    buffered_roads_gdf = clipped_roads_gdf.copy()
-
-    # use the variable here
-    buffered_roads_gdf['geometry'] = buffered_roads_gdf.geometry.buffer(BUFFER_DISTANCE_M)
-
-    print("\nClipping buffers to CSD boundaries...")
-
-    final_buffers = []
-    for idx, buffer_row in tqdm(buffered_roads_gdf.iterrows(), total=len(buffered_roads_gdf), desc="Clipping buffers"):
-        buffer_geom = buffer_row.geometry
-        csduid = buffer_row['CSDUID']
-
-        # Safe lookup of CSD polygon (ensure matching types)
-        # If your csd['CSDUID'] is not int, coerce both sides consistently earlier
-        csd_match = csd.loc[csd['CSDUID'] == csduid, 'geometry']
-        if csd_match.empty:
-            # fallback: try numeric comparison if types mismatch
-            try:
-                csd_match = csd.loc[pd.to_numeric(csd['CSDUID'], errors='coerce') == int(csduid), 'geometry']
-            except Exception:
-                csd_match = csd_match  # stay empty
-        if csd_match.empty:
-            # warn and skip if no CSD polygon found
-            print(f"Warning: no CSD polygon found for CSDUID {csduid}; skipping buffer idx {idx}")
+import road_processing
+from geo_io import output_paths, read_layer, write_layer
+from pipeline_cache import file_fingerprint, fingerprint, is_cached, load_manifest, record_stage
+from road_processing import (available_road_attributes, build_csd_shards, buffer_merged_lines, buffer_segments,
+                             clip_road_pairs, chunk_rows_for_memory, intersecting_road_indices, merge_lines_by_csd,
+                             read_intersecting_roads, run_sharded_pipeline, stream_clip_roads)
+
+BUFFER_DISTANCES_M = [10, 20]  # every distance is produced in a single run from the same clipped roads
+CLIP_CHUNK_SIZE = 250_000  # road/CSD pairs clipped per batch (None clips every pair in one call)
+INGEST_MODE = 'filter_first'  # 'filter_first' (prefilter in road CRS, test in CSD CRS), 'stream' or 'reproject_first'
+MEMORY_LIMIT_GB = 4  # memory ceiling that sizes the row chunks read in 'stream' ingest mode
+ROAD_ATTRIBUTES = ['CLASS', 'PAVSTATUS']  # road attributes read and carried through clipping (lengths by attribute)
+PREFILTER_MODE = 'strtree'  # 'strtree' (bulk spatial-tree query) or 'union' (legacy unary_union + per-road test)
+BUFFER_MODE = 'merged'  # 'merged' (buffer one multiline per CSD) or 'segment' (buffer, clip back, dissolve segments)
+N_WORKERS = 1  # >1 runs clip → buffer → dissolve per CSD across a pool of worker processes (e.g. os.cpu_count())
+OUTPUT_FORMATS = ['parquet', 'gpkg', 'shp']  # GeoParquet first (primary); the Earth Engine export reads the shp
+CACHE_VERSION = 1  # bump when stage logic in this script changes so cached intermediates are rebuilt
+
+ROADS_PATH = 'Datasets/Inputs/roads/roads.shp'
+CSD_PATH = 'Datasets/Outputs/urban_csds/urban_csds.parquet'
+CACHE_MANIFEST_PATH = 'Datasets/Outputs/roads/cache_manifest.json'
+
+
+def main():
+    if INGEST_MODE not in ('filter_first', 'stream', 'reproject_first'):
+        raise ValueError(f"Unknown INGEST_MODE: {INGEST_MODE!r} "
+                         f"(expected 'filter_first', 'stream' or 'reproject_first')")
+    if BUFFER_MODE not in ('merged', 'segment'):
+        raise ValueError(f"Unknown BUFFER_MODE: {BUFFER_MODE!r} (expected 'merged' or 'segment')")
+
+    print("Loading data...")
+    csd = read_layer(CSD_PATH)
+
+    # Ensure CSDUID is int64
+    csd['CSDUID'] = csd['CSDUID'].astype('int64')
+
+    print(f"CSD CRS: {csd.crs}")
+
+    # Only the geometry and these attributes are read from the road network; missing ones are skipped with a warning
+    road_attributes = available_road_attributes(ROADS_PATH, ROAD_ATTRIBUTES)
+
+    # Intermediates are reused only when the input files, CRS, ingest mode and code they were built from are unchanged
+    manifest = load_manifest(CACHE_MANIFEST_PATH)
+    code_version = fingerprint(CACHE_VERSION, file_fingerprint(road_processing.__file__, manifest))
+    intersecting_key = fingerprint('intersecting_roads', file_fingerprint(ROADS_PATH, manifest),
+                                   file_fingerprint(CSD_PATH, manifest), csd.crs.to_string(), road_attributes,
+                                   INGEST_MODE, code_version)
+    clipped_key = fingerprint('clipped_roads', intersecting_key)
+
+    ## --------------------------------------- Reproject Roads to Match CSD CRS ----------------------------------------
+    # region
+
+    intersecting_roads_path = 'Datasets/Outputs/roads/intersecting_roads.parquet'
+    clipped_roads_path = 'Datasets/Outputs/roads/clipped_roads.parquet'
+    intersecting_cached = is_cached(manifest, 'intersecting_roads', intersecting_key, [intersecting_roads_path])
+
+    # The whole national road network is only reprojected when the intersecting roads are rebuilt the legacy way;
+    # the other ingest modes reproject just the roads that survive the spatial filter below
+    if not intersecting_cached and INGEST_MODE == 'reproject_first':
+        roads = gpd.read_file(ROADS_PATH, columns=road_attributes)
+        print(f"Original roads: {len(roads)}")
+        print(f"Roads CRS: {roads.crs}")
+
+        print("\nReprojecting roads to match CSD CRS...")
+        roads = roads.to_crs(csd.crs)
+        print(f"Roads reprojected to: {roads.crs}")
+
+    # endregion
+
+    ## ------------------------------- Filter Roads that Intersect CSDs (spatial filter) -------------------------------
+    # region
+
+    # Set directly when the roads are streamed through the filter and clip stages in one pass
+    clipped_roads_gdf = None
+
+    if intersecting_cached:
+        print(f"\nLoading pre-filtered intersecting roads from: {intersecting_roads_path}")
+        roads_intersecting = read_layer(intersecting_roads_path)
+        print(f"Loaded {len(roads_intersecting)} intersecting roads")
+    elif INGEST_MODE == 'stream':
+        chunk_rows = chunk_rows_for_memory(ROADS_PATH, MEMORY_LIMIT_GB)
+        print(f"\nStreaming roads through the filter and clip in chunks of {chunk_rows} rows "
+              f"(memory limit {MEMORY_LIMIT_GB} GB)...")
+
+        start_time = time.perf_counter()
+        n_roads, n_intersecting, n_clipped = stream_clip_roads(ROADS_PATH, csd, chunk_rows, intersecting_roads_path,
+                                                               clipped_roads_path, attributes=road_attributes)
+        elapsed = time.perf_counter() - start_time
+
+        print(f"Original roads: {n_roads}")
+        print(f"Streamed in {elapsed:.1f} s; kept {n_intersecting / max(n_roads, 1) * 100:.2f}% of roads")
+        print(f"Roads after filtering: {n_intersecting} (removed {n_roads - n_intersecting})")
+        print(f"Clipped road segments: {n_clipped}")
+        print(f"Streamed intersecting roads to: {intersecting_roads_path}")
+        print(f"Streamed clipped roads to: {clipped_roads_path}")
+        record_stage(manifest, 'intersecting_roads', intersecting_key, [intersecting_roads_path], CACHE_MANIFEST_PATH)
+        record_stage(manifest, 'clipped_roads', clipped_key, [clipped_roads_path], CACHE_MANIFEST_PATH)
+
+        # Only the clipped roads (a small fraction of the network) are read back for the length and buffer stages
+        clipped_roads_gdf = read_layer(clipped_roads_path)
+    elif INGEST_MODE == 'filter_first':
+        print("\nPrefiltering roads in the road layer's CRS, then filtering roads that intersect urban CSDs...")
+
+        start_time = time.perf_counter()
+        roads_intersecting, n_roads = read_intersecting_roads(ROADS_PATH, csd, columns=road_attributes)
+        elapsed = time.perf_counter() - start_time
+
+        print(f"Original roads: {n_roads}")
+        print(f"Read, filtered and reprojected in {elapsed:.1f} s; kept "
+              f"{len(roads_intersecting) / max(n_roads, 1) * 100:.2f}% of roads")
+    else:
+        print("\nFiltering roads that intersect urban CSDs...")
+        n_roads = len(roads)
+
+        start_time = time.perf_counter()
+
+        if PREFILTER_MODE == 'strtree':
+            road_positions = intersecting_road_indices(np.asarray(roads.geometry.values),
+                                                       np.asarray(csd.geometry.values))
+            roads_intersecting = roads.iloc[road_positions].copy()
+        elif PREFILTER_MODE == 'union':
+            # Create a union of all CSD geometries for efficient filtering
+            csd_union = unary_union(csd.geometry.values)
+
+            # Use spatial index for efficient filtering with progress bar
+            tqdm.pandas(desc="Checking intersections")
+            roads['intersects'] = roads.geometry.progress_apply(lambda geom: geom.intersects(csd_union))
+            roads_intersecting = roads[roads['intersects']].copy()
+            roads_intersecting = roads_intersecting.drop(columns=['intersects'])
+        else:
+            raise ValueError(f"Unknown PREFILTER_MODE: {PREFILTER_MODE!r} (expected 'strtree' or 'union')")
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Prefilter ({PREFILTER_MODE}) took {elapsed:.1f} s and kept "
+              f"{len(roads_intersecting) / max(n_roads, 1) * 100:.2f}% of roads")
+
+    if not intersecting_cached and clipped_roads_gdf is None:
+        print(f"Roads after filtering: {len(roads_intersecting)} (removed {n_roads - len(roads_intersecting)})")
+
+        # Save for future use
+        print(f"Saving intersecting roads to: {intersecting_roads_path}")
+        write_layer(roads_intersecting, intersecting_roads_path)
+        record_stage(manifest, 'intersecting_roads', intersecting_key, [intersecting_roads_path], CACHE_MANIFEST_PATH)
+        print("Saved successfully")
+
+    # endregion
+
+    ## ---------------------------------------------- Clip Roads by CSDs -----------------------------------------------
+    # region
+
+    clipped_cached = is_cached(manifest, 'clipped_roads', clipped_key, [clipped_roads_path])
+
+    # Create buffer-specific output directories and file paths
+    buffer_dirs = {d: f'Datasets/Outputs/roads/road_buffers_{d}m' for d in BUFFER_DISTANCES_M}
+    for buffer_dir in buffer_dirs.values():
+        os.makedirs(buffer_dir, exist_ok=True)
+    buffer_output_paths = {d: output_paths(os.path.join(buffer_dirs[d], f'road_buffers_{d}m'), OUTPUT_FORMATS)
+                           for d in BUFFER_DISTANCES_M}
+    # The sharded pipeline streams the primary (first) output format as shards finish
+    streamed_paths = {d: paths[OUTPUT_FORMATS[0]] for d, paths in buffer_output_paths.items()}
+
+    # {distance: dissolved buffers}; filled directly by the sharded pipeline, otherwise by the buffer stage
+    road_buffers_dissolved = {}
+
+    if N_WORKERS > 1:
+        print(f"\nRunning sharded clip → buffer → dissolve pipeline on {N_WORKERS} worker processes...")
+        csd_geoms = np.asarray(csd.geometry.values)
+
+        if clipped_cached:
+            # Streamed roads are already clipped, so the shards skip straight to buffering
+            if clipped_roads_gdf is None:
+                print(f"Loading pre-clipped roads from: {clipped_roads_path}")
+                clipped_roads_gdf = read_layer(clipped_roads_path)
+            road_idx = np.arange(len(clipped_roads_gdf))
+            csd_idx = pd.Index(csd['CSDUID']).get_indexer(clipped_roads_gdf['CSDUID'].astype('int64'))
+            shards = build_csd_shards(np.asarray(clipped_roads_gdf.geometry.values), csd_geoms, csd['CSDUID'].values,
+                                      road_idx[csd_idx >= 0], csd_idx[csd_idx >= 0])
+            _, road_buffers_dissolved = run_sharded_pipeline(shards, BUFFER_DISTANCES_M, N_WORKERS, csd.crs,
+                                                             streamed_paths, clip=False, buffer_mode=BUFFER_MODE)
+        else:
+            road_idx, csd_idx = csd.sindex.query(roads_intersecting.geometry.values, predicate='intersects')
+            shards = build_csd_shards(np.asarray(roads_intersecting.geometry.values), csd_geoms, csd['CSDUID'].values,
+                                      road_idx, csd_idx)
+            clipped_roads_gdf, road_buffers_dissolved = run_sharded_pipeline(
+                shards, BUFFER_DISTANCES_M, N_WORKERS, csd.crs, streamed_paths, clipped_path=clipped_roads_path,
+                buffer_mode=BUFFER_MODE, road_attributes=roads_intersecting[road_attributes]
+            )
+            record_stage(manifest, 'clipped_roads', clipped_key, [clipped_roads_path], CACHE_MANIFEST_PATH)
+            print(f"Clipped road segments: {len(clipped_roads_gdf)} (streamed to {clipped_roads_path})")
+
+        for buffer_distance, buffers_gdf in road_buffers_dissolved.items():
+            print(f"Dissolved {buffer_distance} m road buffers: {len(buffers_gdf)} "
+                  f"(streamed to {streamed_paths[buffer_distance]})")
+
+    elif clipped_roads_gdf is not None:
+        print(f"\nUsing the {len(clipped_roads_gdf)} road segments clipped while streaming")
+    elif clipped_cached:
+        print(f"\nLoading pre-clipped roads from: {clipped_roads_path}")
+        clipped_roads_gdf = read_layer(clipped_roads_path)
+        print(f"Loaded {len(clipped_roads_gdf)} clipped road segments")
+    else:
+        print("\nClipping roads to CSD boundaries...")
+
+        # Spatial join (positional index pairs) to identify which CSD each road intersects
+        road_idx, csd_idx = csd.sindex.query(roads_intersecting.geometry.values, predicate='intersects')
+        print(f"Road/CSD pairs to clip: {len(road_idx)}")
+
+        # Clip every road segment to its intersecting CSD(s) in vectorized chunks
+        clipped_geoms = clip_road_pairs(np.asarray(roads_intersecting.geometry.values), np.asarray(csd.geometry.values),
+                                        road_idx, csd_idx, chunk_size=CLIP_CHUNK_SIZE)
+        keep = ~shapely.is_empty(clipped_geoms)
+
+        # Road attributes follow each clipped piece so lengths can be broken down without re-clipping
+        clipped_roads_gdf = gpd.GeoDataFrame({'CSDUID': csd['CSDUID'].values[csd_idx[keep]],
+                                              **{attribute: roads_intersecting[attribute].values[road_idx[keep]]
+                                                 for attribute in road_attributes}},
+                                             geometry=clipped_geoms[keep], crs=csd.crs)
+        print(f"Clipped road segments: {len(clipped_roads_gdf)}")
+
+        # Save for future use
+        print(f"Saving clipped roads to: {clipped_roads_path}")
+        write_layer(clipped_roads_gdf, clipped_roads_path)
+        record_stage(manifest, 'clipped_roads', clipped_key, [clipped_roads_path], CACHE_MANIFEST_PATH)
+        print("Saved successfully")
+
+    # endregion
+
+    ## --------------------------------------------- Calculate Road Lengths --------------------------------------------
+    # region
+
+    print("\nCalculating road lengths by CSDUID...")
+
+    # Calculate length in meters for each road segment
+    clipped_roads_gdf['road_length_m'] = clipped_roads_gdf.geometry.length
+
+    # Sum lengths by CSDUID and convert to kilometers
+    road_lengths = clipped_roads_gdf.groupby('CSDUID')['road_length_m'].sum().reset_index()
+    road_lengths['road_length_km'] = road_lengths['road_length_m'] / 1000
+    road_lengths = road_lengths[['CSDUID', 'road_length_km']]
+
+    # Merge with CSD names for reference
+    csd_names = csd[['CSDUID', 'CSDNAME']].copy()
+    road_lengths = road_lengths.merge(csd_names, on='CSDUID', how='left')
+
+    # Reorder columns
+    road_lengths = road_lengths[['CSDUID', 'CSDNAME', 'road_length_km']]
+
+    # Save to CSV
+    road_lengths_csv_path = 'Datasets/Outputs/roads/road_lengths_by_csd.csv'
+    road_lengths.to_csv(road_lengths_csv_path, index=False)
+    print(f"Saved road lengths to: {road_lengths_csv_path}")
+
+    # Break the same lengths down by every carried road attribute (e.g. class and surface type) in one pivot
+    if road_attributes:
+        segment_attributes = clipped_roads_gdf[['CSDUID', 'road_length_m', *road_attributes]].melt(
+            id_vars=['CSDUID', 'road_length_m'], var_name='attribute', value_name='value'
+        )
+        segment_attributes['value'] = segment_attributes['value'].astype(str).where(
+            segment_attributes['value'].notna(), 'unknown')
+
+        road_lengths_by_class = segment_attributes.pivot_table(index='CSDUID', columns=['attribute', 'value'],
+                                                               values='road_length_m', aggfunc='sum', fill_value=0)
+        road_lengths_by_class.columns = [f"{attribute}_{value}_km"
+                                         for attribute, value in road_lengths_by_class.columns]
+        road_lengths_by_class = road_lengths.merge(road_lengths_by_class / 1000, left_on='CSDUID', right_index=True,
+                                                   how='left')
+
+        road_lengths_by_class_csv_path = 'Datasets/Outputs/roads/road_lengths_by_class.csv'
+        road_lengths_by_class.to_csv(road_lengths_by_class_csv_path, index=False)
+        print(f"Saved road lengths by {', '.join(road_attributes)} to: {road_lengths_by_class_csv_path}")
+
+    # Print summary statistics
+    print(f"\nRoad Length Summary:")
+    print(f"Total CSDs with roads: {len(road_lengths)}")
+    print(f"Mean road length: {road_lengths['road_length_km'].mean():.2f} km")
+    print(f"Median road length: {road_lengths['road_length_km'].median():.2f} km")
+    print(f"Min road length: {road_lengths['road_length_km'].min():.2f} km")
+    print(f"Max road length: {road_lengths['road_length_km'].max():.2f} km")
+
+    # Check for CSDs with less than 100 km of roads
+    low_road_csds = road_lengths[road_lengths['road_length_km'] < 100]
+    if len(low_road_csds) > 0:
+        print(f"\n*** WARNING: {len(low_road_csds)} CSDs have less than 100 km of roads ***")
+        print(low_road_csds.to_string(index=False))
+    else:
+        print("\nAll CSDs have at least 100 km of roads.")
+
+    # endregion
+
+    # ------------------------------------------- Buffer and Dissolve Roads -------------------------------------------
+    # region
+
+    if N_WORKERS <= 1:
+        # Look up the CSD polygon of every clipped segment once; reused for each buffer distance
+        csd_geoms = np.asarray(csd.geometry.values)
+        segment_csd_idx = pd.Index(csd['CSDUID']).get_indexer(clipped_roads_gdf['CSDUID'].astype('int64'))
+        if (segment_csd_idx < 0).any():
+            print(f"Warning: no CSD polygon found for {(segment_csd_idx < 0).sum()} clipped segments; skipping them")
+        segments = clipped_roads_gdf[segment_csd_idx >= 0]
+        segment_csd_idx = segment_csd_idx[segment_csd_idx >= 0]
+
+        if BUFFER_MODE == 'merged':
+            print("\nMerging road lines within each CSD...")
+            merged_lines = merge_lines_by_csd(np.asarray(segments.geometry.values), segment_csd_idx, len(csd))
+            has_roads = ~shapely.is_missing(merged_lines)
+
+    for buffer_distance in BUFFER_DISTANCES_M:
+        # Already buffered and dissolved by the sharded pipeline
+        if buffer_distance in road_buffers_dissolved:
             continue
 
-        csd_geom = csd_match.iloc[0]
-
-        # Clip the buffer to the CSD boundary
-        clipped_buffer = buffer_geom.intersection(csd_geom)
+        if BUFFER_MODE == 'merged':
+            # One buffer per CSD is already dissolved, so no per-segment buffers or dissolve are needed
+            print(f"\nBuffering merged road lines by {buffer_distance} meters and clipping to CSD boundaries...")
+            buffer_geoms = buffer_merged_lines(merged_lines[has_roads], csd_geoms[has_roads], buffer_distance)
+            keep = ~shapely.is_empty(buffer_geoms)
 
-        if not clipped_buffer.is_empty:
-            final_buffers.append({
-                'CSDUID': csduid,
-                'geometry': clipped_buffer
-            })
+            road_buffers_dissolved[buffer_distance] = gpd.GeoDataFrame(
+                {'CSDUID': csd['CSDUID'].values[has_roads][keep]}, geometry=buffer_geoms[keep], crs=csd.crs
+            ).sort_values('CSDUID').reset_index(drop=True)
+            print(f"Dissolved road buffers: {len(road_buffers_dissolved[buffer_distance])}")
+            continue
 
-    road_buffers_gdf = gpd.GeoDataFrame(final_buffers, crs=csd.crs)
-    print(f"Final road buffers: {len(road_buffers_gdf)}")
+        buffered_roads_path = os.path.join(buffer_dirs[buffer_distance], f'buffered_roads_{buffer_distance}m.parquet')
+        buffered_stage = f'buffered_roads_{buffer_distance}m'
+        buffered_key = fingerprint(buffered_stage, clipped_key, buffer_distance)
 
-    # Save for future use (explicit file)
-    print(f"Saving buffered roads to: {buffered_roads_gpkg}")
-    road_buffers_gdf.to_file(buffered_roads_gpkg, driver="GPKG")
-    print("Saved successfully")
+        if is_cached(manifest, buffered_stage, buffered_key, [buffered_roads_path]):
+            print(f"\nLoading pre-buffered roads from: {buffered_roads_path}")
+            road_buffers_gdf = read_layer(buffered_roads_path)
+            print(f"Loaded {len(road_buffers_gdf)} buffered road segments")
+        else:
+            print(f"\nBuffering roads by {buffer_distance} meters and clipping buffers to CSD boundaries...")
+            clipped_buffers = buffer_segments(np.asarray(segments.geometry.values), csd_geoms[segment_csd_idx],
+                                              buffer_distance)
+            keep = ~shapely.is_empty(clipped_buffers)
 
-# endregion
+            road_buffers_gdf = gpd.GeoDataFrame({'CSDUID': segments['CSDUID'].values[keep]},
+                                                geometry=clipped_buffers[keep], crs=csd.crs)
+            print(f"Final road buffers: {len(road_buffers_gdf)}")
 
-# ------------------------------------------------- Dissolve Buffers --------------------------------------------------
-# region
+            # Save for future use (explicit file)
+            print(f"Saving buffered roads to: {buffered_roads_path}")
+            write_layer(road_buffers_gdf, buffered_roads_path)
+            record_stage(manifest, buffered_stage, buffered_key, [buffered_roads_path], CACHE_MANIFEST_PATH)
+            print("Saved successfully")
 
-print("\nDissolving overlapping buffers within each CSD...")
-road_buffers_dissolved = road_buffers_gdf.dissolve(by='CSDUID').reset_index()
-print(f"Dissolved road buffers: {len(road_buffers_dissolved)}")
-print(f"Columns in dissolved data: {road_buffers_dissolved.columns.tolist()}")
+        print(f"Dissolving overlapping {buffer_distance} m buffers within each CSD...")
+        road_buffers_dissolved[buffer_distance] = road_buffers_gdf.dissolve(by='CSDUID').reset_index()
+        print(f"Dissolved road buffers: {len(road_buffers_dissolved[buffer_distance])}")
 
-# Verify CSDUID is present
-print("\nSample of dissolved buffers with CSDUID:")
-print(road_buffers_dissolved[['CSDUID']].head())
+    # Verify CSDUID is present
+    for buffer_distance, buffers_gdf in road_buffers_dissolved.items():
+        print(f"\nSample of dissolved {buffer_distance} m buffers with CSDUID "
+              f"(columns: {buffers_gdf.columns.tolist()}):")
+        print(buffers_gdf[['CSDUID']].head())
 
-# endregion
+    # endregion
 
-# ---------------------------------------------------- Save Output ----------------------------------------------------
-# region
+    # -------------------------------------------------- Save Output ---------------------------------------------------
+    # region
 
-# Rename columns for shapefile compatibility
-road_buffers_shp = road_buffers_dissolved.copy()
+    for buffer_distance, buffers_gdf in road_buffers_dissolved.items():
+        for output_format, output_path in buffer_output_paths[buffer_distance].items():
+            # The sharded pipeline has already streamed the primary format
+            if not (N_WORKERS > 1 and output_path == streamed_paths[buffer_distance]):
+                write_layer(buffers_gdf, output_path)
+            print(f"Saved {buffer_distance} m road buffers ({output_format}) to: {output_path}")
 
-# Save as GeoPackage (file inside buffer_dir)
-output_gpkg_path = os.path.join(buffer_dir, f'road_buffers_{BUFFER_DISTANCE_M}m.gpkg')
-road_buffers_dissolved.to_file(output_gpkg_path, driver="GPKG")
-print(f"\nSaved road buffers (geopackage) to: {output_gpkg_path}")
+    print("\nProcessing complete.\n")
 
-# Save as Shapefile (shapefile will create multiple files in the same folder)
-output_shp_path = os.path.join(buffer_dir, f'road_buffers_{BUFFER_DISTANCE_M}m.shp')
-road_buffers_shp.to_file(output_shp_path, driver="ESRI Shapefile")
-print(f"Saved road buffers (shapefile) to: {output_shp_path}")
+    # endregion
 
-print("\nProcessing complete.\n")
 
-# endregion
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from geo_io import read_layer
+from road_processing import buffer_merged_lines, buffer_segments, merge_lines_by_csd
+
+BUFFER_DISTANCES_M = [10, 20]
+
+## --------------------------------------------------- LOAD DATASETS ---------------------------------------------------
+#region
+
+clipped_roads_path = 'Datasets/Outputs/roads/clipped_roads.parquet'
+benchmark_csv_path = 'Datasets/Outputs/roads/buffer_mode_benchmark.csv'
+
+print("Loading data...")
+csd = read_layer('Datasets/Outputs/urban_csds/urban_csds.parquet')
+csd['CSDUID'] = csd['CSDUID'].astype('int64')
+
+if not os.path.exists(clipped_roads_path):
+    raise FileNotFoundError(f"{clipped_roads_path} not found - run roads.py first to create the clipped roads")
+clipped_roads = read_layer(clipped_roads_path)
+print(f"Loaded {len(clipped_roads)} clipped road segments for {clipped_roads['CSDUID'].nunique()} CSDs")
+
+csd_geoms = np.asarray(csd.geometry.values)
+segment_csd_idx = pd.Index(csd['CSDUID']).get_indexer(clipped_roads['CSDUID'].astype('int64'))
+clipped_roads = clipped_roads[segment_csd_idx >= 0]
+segment_csd_idx = segment_csd_idx[segment_csd_idx >= 0]
+segment_geoms = np.asarray(clipped_roads.geometry.values)
+
+#endregion
+
+## -------------------------------------------- COMPARE BUFFERING MODES ------------------------------------------------
+#region
+
+# Line merging does not depend on the buffer distance, so it is timed once and charged to every distance
+start_time = time.perf_counter()
+merged_lines = merge_lines_by_csd(segment_geoms, segment_csd_idx, len(csd))
+has_roads = ~shapely.is_missing(merged_lines)
+merge_seconds = time.perf_counter() - start_time
+
+area_tables = []
+runtime_rows = []
+for buffer_distance in BUFFER_DISTANCES_M:
+    print(f"\n------- {buffer_distance} m buffers -------")
+
+    # Current path: buffer every segment, clip each buffer back to its CSD, then dissolve by CSDUID
+    start_time = time.perf_counter()
+    segment_buffers = buffer_segments(segment_geoms, csd_geoms[segment_csd_idx], buffer_distance)
+    keep = ~shapely.is_empty(segment_buffers)
+    segment_dissolved = gpd.GeoDataFrame({'CSDUID': clipped_roads['CSDUID'].values[keep]},
+                                         geometry=segment_buffers[keep], crs=csd.crs).dissolve(by='CSDUID')
+    segment_seconds = time.perf_counter() - start_time
+
+    # Merged path: buffer one multiline per CSD and intersect it with the CSD once
+    start_time = time.perf_counter()
+    merged_buffers = buffer_merged_lines(merged_lines[has_roads], csd_geoms[has_roads], buffer_distance)
+    merged_seconds = time.perf_counter() - start_time + merge_seconds
+
+    areas = pd.DataFrame({
+        'CSDUID': csd['CSDUID'].values[has_roads],
+        'buffer_m': buffer_distance,
+        'merged_area_km2': shapely.area(merged_buffers) / 1_000_000,
+    }).merge(pd.DataFrame({'CSDUID': segment_dissolved.index,
+                           'segment_area_km2': segment_dissolved.area.values / 1_000_000}),
+             on='CSDUID', how='outer')
+    areas['area_diff_pct'] = (areas['merged_area_km2'] - areas['segment_area_km2']) / areas['segment_area_km2'] * 100
+    area_tables.append(areas)
+
+    runtime_rows.append({
+        'buffer_m': buffer_distance,
+        'segment_seconds': segment_seconds,
+        'merged_seconds': merged_seconds,
+        'speedup': segment_seconds / merged_seconds if merged_seconds > 0 else np.nan,
+        'segment_total_km2': areas['segment_area_km2'].sum(),
+        'merged_total_km2': areas['merged_area_km2'].sum(),
+        'max_abs_area_diff_pct': areas['area_diff_pct'].abs().max(),
+    })
+
+    print(f"Segment path: {segment_seconds:.1f} s | Merged path: {merged_seconds:.1f} s "
+          f"(incl. {merge_seconds:.1f} s line merging)")
+    print(f"Total area: segment {areas['segment_area_km2'].sum():.3f} km² | "
+          f"merged {areas['merged_area_km2'].sum():.3f} km²")
+    print(f"Largest per-CSD area difference: {areas['area_diff_pct'].abs().max():.4f}%")
+
+#endregion
+
+## --------------------------------------------------- SAVE RESULTS ----------------------------------------------------
+#region
+
+runtime_summary = pd.DataFrame(runtime_rows)
+print("\nBenchmark summary:")
+print(runtime_summary.to_string(index=False))
+
+benchmark = pd.concat(area_tables, ignore_index=True)
+benchmark.to_csv(benchmark_csv_path, index=False)
+print(f"\nSaved per-CSD area comparison to: {benchmark_csv_path}")
+
+#endregion
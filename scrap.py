@@ -1,7 +1,9 @@
 import rasterio
-from pyproj import Transformer
+from pyproj import CRS
 import numpy as np
 
+from climate_extraction import row_pixel_areas_km2
+
 # Open the raster
 precip_path = 'Datasets/Inputs/climate/average_annual_precip_mm_1991_2020.tif'
 
@@ -22,61 +24,29 @@ with rasterio.open(precip_path) as src:
     if crs.is_geographic:
         print("\n--- Geographic CRS Detected (lat/lon in degrees) ---")
 
-        # Get center of raster to calculate at representative latitude
-        center_lon = (bounds.left + bounds.right) / 2
-        center_lat = (bounds.bottom + bounds.top) / 2
-        print(f"\nRaster center: {center_lat:.2f}°N, {center_lon:.2f}°W")
-
-        # Calculate pixel size at the center latitude
-        # Create transformer to convert degrees to meters (using EPSG:3857 Web Mercator as proxy)
-        transformer = Transformer.from_crs(crs, "EPSG:3857", always_xy=True)
-
-        # Get corners of a single pixel at the center of the raster
-        pixel_corners = [
-            (center_lon, center_lat),  # Bottom-left
-            (center_lon + res[0], center_lat),  # Bottom-right
-            (center_lon, center_lat + abs(res[1])),  # Top-left
-            (center_lon + res[0], center_lat + abs(res[1]))  # Top-right
-        ]
-
-        # Transform to meters
-        corners_meters = [transformer.transform(lon, lat) for lon, lat in pixel_corners]
+        # Geodesic area of one pixel in every raster row, on the CRS ellipsoid
+        row_areas_km2 = row_pixel_areas_km2(src.transform, src.height, crs)
+        row_lats = src.transform.f + src.transform.e * (np.arange(src.height) + 0.5)
+        center_row = src.height // 2
+        center_lat = row_lats[center_row]
 
-        # Calculate pixel dimensions in meters
-        width_m = corners_meters[1][0] - corners_meters[0][0]
-        height_m = corners_meters[2][1] - corners_meters[0][1]
-
-        # Convert to km
-        width_km = width_m / 1000
-        height_km = height_m / 1000
-        pixel_area_km2 = (width_km * height_km)
+        # Pixel width along the parallel and height along the meridian at the centre row, on the same CRS ellipsoid
+        geod = CRS.from_user_input(crs.to_wkt()).get_geod()
+        width_km = geod.inv(0, center_lat, res[0], center_lat)[2] / 1000
+        height_km = geod.inv(0, center_lat - abs(res[1]) / 2, 0, center_lat + abs(res[1]) / 2)[2] / 1000
+        pixel_area_km2 = row_areas_km2[center_row]
 
         print(f"\n📏 ACTUAL PIXEL SIZE (at raster center, ~{center_lat:.0f}°N):")
         print(f"   Width:  {width_km:.2f} km")
         print(f"   Height: {height_km:.2f} km")
         print(f"   Area:   {pixel_area_km2:.2f} km²")
 
-        # Also calculate at typical Canadian latitudes
-        print(f"\n📏 PIXEL SIZE AT DIFFERENT CANADIAN LATITUDES:")
+        # Pixel area shrinks with latitude; census_data.py uses the per-row areas for each CSD
+        print(f"\n📏 PIXEL AREA AT DIFFERENT CANADIAN LATITUDES (geodesic):")
 
         for lat in [45, 50, 55, 60]:
-            transformer = Transformer.from_crs(crs, "EPSG:3857", always_xy=True)
-
-            pixel_corners = [
-                (center_lon, lat),
-                (center_lon + res[0], lat),
-                (center_lon, lat + abs(res[1])),
-                (center_lon + res[0], lat + abs(res[1]))
-            ]
-
-            corners_meters = [transformer.transform(lon, lat) for lon, lat in pixel_corners]
-            width_m = corners_meters[1][0] - corners_meters[0][0]
-            height_m = corners_meters[2][1] - corners_meters[0][1]
-            width_km = width_m / 1000
-            height_km = height_m / 1000
-            area_km2 = width_km * height_km
-
-            print(f"   {lat}°N: {width_km:.2f} km × {height_km:.2f} km = {area_km2:.2f} km²")
+            area_km2 = row_areas_km2[np.abs(row_lats - lat).argmin()]
+            print(f"   {lat}°N: {area_km2:.2f} km²")
 
         # Compare with simple degree approximation
         print(f"\n⚠️  COMPARISON:")
@@ -84,11 +54,11 @@ with rasterio.open(precip_path) as src:
         simple_km = res[0] * 111
         simple_area = simple_km ** 2
         print(f"      {simple_km:.2f} km × {simple_km:.2f} km = {simple_area:.2f} km²")
-        print(f"   Accurate calculation at {center_lat:.0f}°N:")
+        print(f"   Geodesic calculation at {center_lat:.0f}°N:")
         print(f"      {width_km:.2f} km × {height_km:.2f} km = {pixel_area_km2:.2f} km²")
 
-        print(f"\n✅ RECOMMENDED VALUE FOR YOUR CODE:")
-        print(f"   Use: ~{width_km:.1f} km × {height_km:.1f} km (~{pixel_area_km2:.0f} km² per pixel)")
+        print(f"\n✅ PIXEL AREA RANGE OVER THE RASTER:")
+        print(f"   {row_areas_km2.min():.2f} - {row_areas_km2.max():.2f} km² per pixel (varies by row)")
 
     else:
         print("\n--- Projected CRS Detected ---")